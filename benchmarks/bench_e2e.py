@@ -0,0 +1,241 @@
+"""End-to-end benchmark scenarios - synthetic captures through DNSReputationAnalyzer.analyze
+against a local mock of the reputation API
+
+Usage: python benchmarks/bench_e2e.py [--scenario NAME ...] [--scale X] [--output FILE]
+                                      [--compare BASELINE.json [--threshold R]]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import yaml
+
+from mock_api import MockServer
+from pcap_generator import write_capture
+from utils.config import Config
+
+# capture: pcap_generator.write_capture arguments, api: mock_api.create_app arguments,
+# config: overrides of the analyzer config, by section
+SCENARIOS = {
+    'baseline': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5},
+        'config': {}
+    },
+    'lognormal_latency': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 20, 'distribution': 'lognormal', 'sigma': 1.0},
+        'config': {}
+    },
+    'throttled': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5, 'error_429': 0.05, 'retry_after': 0.05},
+        'config': {}
+    },
+    'server_errors': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5, 'error_5xx': 0.05},
+        'config': {}
+    },
+    'batch': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5},
+        'config': {'api': {'batch_size': 50}}
+    },
+    'pipeline_fast_parser': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5},
+        'config': {'performance': {'pipeline': True, 'pcap_parser': 'fast'}}
+    },
+    'lookup_workers': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5},
+        'config': {'performance': {'lookup_workers': 4}}
+    },
+    # the same as baseline where uvloop is not installed
+    'uvloop': {
+        'capture': {'domains': 2000, 'duplication': 0.8},
+        'api': {'latency_ms': 5},
+        'config': {'performance': {'event_loop': 'uvloop'}}
+    },
+}
+
+# The analyzer config of every scenario, before its overrides
+BASE_CONFIG = {
+    'api': {'retry_delay': 0.01, 'max_retries': 3},
+    'performance': {'requests_per_second': 5000, 'max_concurrent_requests': 50},
+    'rate_control': {'max_backoff': 1},
+    'cache': {'backend': 'memory'},
+}
+
+# Whether a larger value of a recorded metric is better - for the regression comparison
+HIGHER_IS_BETTER = {'packets_per_second': True, 'lookups_per_second': True,
+                    'p99_response_time': False, 'peak_rss_mb': False, 'peak_rss_children_mb': False,
+                    'cold_start': False}
+
+
+def scenario_config(api_url: str, workdir: str, overrides: Dict[str, Dict[str, Any]]) -> str:
+    """Write the config file of a scenario, returns its path"""
+    data = Config('/nonexistent.yaml').data
+    for layer in (BASE_CONFIG, overrides):
+        for section, values in layer.items():
+            data[section].update(values)
+    data['api']['base_url'] = api_url
+    data['output']['results_file'] = os.path.join(workdir, 'results')
+    data['checkpoint']['journal_file'] = os.path.join(workdir, 'dns_checkpoint.jsonl')
+
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f)
+    return path
+
+
+def run_scenario(config_path: str, pcap_file: str) -> Dict[str, Any]:
+    """Process pool entry point - run the analysis in a fresh process, so that its peak RSS is its own"""
+    import main
+    from utils.event_loop import use_event_loop
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        analyzer = main.DNSReputationAnalyzer(config_path)
+        event_loop = use_event_loop(analyzer.config.data['performance'].get('event_loop', 'asyncio'))
+        # extraction imports scapy (both parsers need it) and tqdm when it starts - imported
+        # here, so that packets_per_second measures the parsing alone
+        import_start = time.perf_counter()
+        from scapy.layers import dns  # noqa: F401
+        from scapy.utils import PcapReader  # noqa: F401
+        import tqdm  # noqa: F401
+        lazy_import = time.perf_counter() - import_start
+        start = time.perf_counter()
+        asyncio.run(analyzer.analyze(pcap_file))
+        elapsed = time.perf_counter() - start
+        analyzer.reputation_client.cache.close()
+    # the extraction pool is shut down without waiting - its processes count once they are reaped
+    for child in multiprocessing.active_children():
+        child.join()
+
+    metrics = analyzer.metrics
+    pcap_manager = analyzer.pcap_manager
+    extraction = pcap_manager.end_time - pcap_manager.start_time
+    percentiles = metrics.get_percentiles()
+    # the successful lookups the API answered, not the ones served from the cache
+    lookups = metrics.successful_requests - metrics.cached_requests
+    return {
+        'runtime': elapsed,
+        'packets': pcap_manager.packets_sent,
+        'packets_per_second': pcap_manager.packets_sent / extraction if extraction > 0 else 0,
+        'lookups': lookups,
+        'lookups_per_second': lookups / elapsed,
+        'failed_requests': metrics.failed_requests,
+        # summed over the lookup workers, if any
+        'http_requests': metrics.get_stats()['http_requests'],
+        'p50_response_time': percentiles[50],
+        'p99_response_time': percentiles[99],
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # of the largest extraction or lookup worker process - not a sum over them
+        'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        # from the import of main to the first lookup answered, extraction included - None
+        # when no lookup was answered
+        'cold_start': metrics.first_request_time - main.STARTED if metrics.first_request_time is not None else None,
+        'import_time': main.IMPORTED - main.STARTED,
+        # 0 when this module's own imports (the capture generator) loaded them already
+        'lazy_import_time': lazy_import,
+        'event_loop': event_loop,
+        'shutdown_reason': analyzer.shutdown_reason or 'completed'
+    }
+
+
+def run(names, scale: float) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            scenario = SCENARIOS[name]
+            capture = dict(scenario['capture'])
+            capture['domains'] = max(int(capture['domains'] * scale), 1)
+            pcap_file = os.path.join(tmp, f"{name}.pcap")
+            packets = write_capture(pcap_file, packets=capture.pop('packets', 0), **capture)
+
+            workdir = os.path.join(tmp, name)
+            os.mkdir(workdir)
+            with MockServer(**scenario['api']) as api:
+                config_path = scenario_config(api.url, workdir, scenario['config'])
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    result = pool.submit(run_scenario, config_path, pcap_file).result()
+                result['api'] = api.stats()
+
+            result['domains'] = capture['domains']
+            results[name] = result
+            print(f"{name:>22}: {result['packets_per_second']:>9,.0f} packets/sec "
+                  f"({packets} packets), {result['lookups_per_second']:>7,.0f} lookups/sec, "
+                  f"p99 {result['p99_response_time']:>6.1f}ms, peak RSS {result['peak_rss_mb']:.0f}MB "
+                  f"(workers {result['peak_rss_children_mb']:.0f}MB), cold start "
+                  + (f"{result['cold_start']:.2f}s" if result['cold_start'] is not None else 'n/a'))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline_file: str, threshold: float) -> int:
+    """Print the changes from a baseline run, returns the number of regressions over threshold"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)['scenarios']
+
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in HIGHER_IS_BETTER.items():
+            before, after = baseline[name].get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                regressions += 1
+                flag = '  REGRESSION'
+            print(f"{name:>22} {metric:<20} {before:>10.1f} -> {after:>10.1f} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help='scenario to run, may be repeated (default: all)')
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='multiplies the domains of every scenario')
+    arg_parser.add_argument('--output', default='bench_e2e.json', help='JSON file to record the results to')
+    arg_parser.add_argument('--compare', help='JSON file of a previous run to compare to')
+    arg_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='relative change that counts as a regression (default: 0.1)')
+    args = arg_parser.parse_args()
+
+    results = run(args.scenario or list(SCENARIOS), args.scale)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+            'scenarios': results
+        }, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark the scapy and fast PCAP parsers on a synthetic DNS capture
+
+Usage: python benchmarks/bench_parsers.py [--packets N] [--domains N] [--workers N]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from monitoring.metrics import MetricsCollector
+from pcap_generator import write_capture
+from traffic_replay.pcap_manager import PCAPManager
+
+
+async def run(parser: str, pcap_file: str, packets: int, workers: int = 1):
+    manager = PCAPManager(MetricsCollector(), parser, workers)
+    start = time.perf_counter()
+    # keep the progress bar out of the benchmark output
+    with contextlib.redirect_stderr(io.StringIO()):
+        domains = await manager.extract_domains(pcap_file)
+    elapsed = time.perf_counter() - start
+    print(f"{parser:>6} x{workers:<2}: {packets / elapsed:>10,.0f} packets/sec "
+          f"({elapsed:.2f}s, {len(domains)} domains, {manager.fallbacks} fallbacks)")
+    return domains
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--packets', type=int, default=20000)
+    arg_parser.add_argument('--domains', type=int, default=2000)
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='also run both parsers sharded over this many processes')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pcap_file = str(Path(tmp) / 'bench.pcap')
+        write_capture(pcap_file, args.packets, args.domains)
+
+        scapy_domains = asyncio.run(run('scapy', pcap_file, args.packets))
+        fast_domains = asyncio.run(run('fast', pcap_file, args.packets))
+        assert scapy_domains == fast_domains, "the parsers extracted different domains"
+
+        if args.workers > 1:
+            for parser in ('scapy', 'fast'):
+                domains = asyncio.run(run(parser, pcap_file, args.packets, args.workers))
+                assert domains == fast_domains, "sharded extraction extracted different domains"
+
+
+if __name__ == '__main__':
+    main()
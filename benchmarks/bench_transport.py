@@ -0,0 +1,113 @@
+"""Benchmark the reputation API transport against a local aiohttp stub server
+
+Usage: python benchmarks/bench_transport.py [--requests N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import aiohttp
+from aiohttp import web
+
+from reputation.transport import ReputationTransport
+from utils.config import Config
+
+
+def serve(port: int):
+    """A stub of the reputation API, in its own process so it does not share the client's event loop"""
+    body = b'{"reputation": 75, "categories": ["news", "media"]}'
+
+    async def ranking(request):
+        return web.Response(body=body, content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/domain/ranking/{domain}', ranking)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(port: int):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError('the stub server did not start')
+
+
+async def run_workers(requests: int, concurrency: int, request):
+    """Run requests through a fixed pool of workers, like ReputationClient does"""
+    domains = iter(range(requests))
+
+    async def worker():
+        for i in domains:
+            await request(f"host{i}.example.com")
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    # the stub server shares the machine, the client CPU time isolates the cost of the transport
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+async def baseline(config: Config, requests: int, concurrency: int):
+    """The previous request path - a default session and per-request headers and timeout"""
+    base_url = config.data['api']['base_url']
+
+    async with aiohttp.ClientSession() as session:
+        async def request(domain):
+            url = f"{base_url}/domain/ranking/{domain}"
+            headers = {'Authorization': f"Token {config.data['api']['auth_token']}"}
+            timeout = aiohttp.ClientTimeout(total=config.data['api']['timeout'])
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                await response.json()
+
+        return await run_workers(requests, concurrency, request)
+
+
+async def transport(config: Config, requests: int, concurrency: int):
+    async with ReputationTransport(config) as client:
+        times = await run_workers(requests, concurrency, client.get_ranking)
+        stats = client.get_stats()
+    print(f"{'':>11}{stats['connections_created']} connections opened, "
+          f"{stats['connections_reused']} reused")
+    return times
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--requests', type=int, default=5000)
+    arg_parser.add_argument('--concurrency', type=int, default=50)
+    args = arg_parser.parse_args()
+
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    try:
+        config = Config('/nonexistent.yaml')
+        config.data['api']['base_url'] = f'http://127.0.0.1:{port}'
+        config.data['performance']['max_concurrent_requests'] = args.concurrency
+        asyncio.run(wait_for(port))
+
+        for name, bench in (('baseline', baseline), ('transport', transport)):
+            elapsed, cpu = asyncio.run(bench(config, args.requests, args.concurrency))
+            print(f"{name:>9}: {args.requests / elapsed:>8,.0f} requests/sec ({elapsed:.2f}s), "
+                  f"{cpu / args.requests * 1e6:.0f}us client CPU/request")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Local mock of the reputation API, with latency distributions and error injection
+
+Usage: python benchmarks/mock_api.py [--port N] [--latency-ms MS] [--distribution D]
+                                     [--error-429 RATE] [--error-5xx RATE]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import time
+import urllib.request
+from typing import Dict, Any, Optional
+
+from aiohttp import web
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+
+
+def create_app(latency_ms: float = 5, distribution: str = 'fixed', sigma: float = 0.5,
+               error_429: float = 0.0, error_5xx: float = 0.0, retry_after: Optional[float] = None,
+               seed: int = 0) -> web.Application:
+    """The mock API. Every request (a batch counts as one) waits a latency drawn from the
+    distribution - latency_ms is its mean, or its median for lognormal - and fails with a
+    429 (with a Retry-After header, if given) or a 503 at the given rates.
+    GET /stats returns the counts of the responses."""
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"unknown latency distribution: {distribution}")
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'domains': 0, 'throttled': 0, 'errors': 0}
+    throttled_headers = {'Retry-After': f"{retry_after:g}"} if retry_after is not None else {}
+
+    def latency() -> float:
+        mean = latency_ms / 1000
+        if distribution == 'uniform':
+            return rng.uniform(0, 2 * mean)
+        if distribution == 'exponential':
+            return rng.expovariate(1 / mean) if mean else 0
+        if distribution == 'lognormal':
+            return rng.lognormvariate(0, sigma) * mean
+        return mean
+
+    def rank(domain: str) -> Dict[str, Any]:
+        return {'reputation': sum(domain.encode()) % 101, 'categories': ['benchmark']}
+
+    async def respond(domains: int) -> Optional[web.Response]:
+        """Wait the latency of a request, and return the injected error response, if any"""
+        stats['requests'] += 1
+        delay = latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        draw = rng.random()
+        if draw < error_429:
+            stats['throttled'] += 1
+            return web.Response(status=429, headers=throttled_headers)
+        if draw < error_429 + error_5xx:
+            stats['errors'] += 1
+            return web.Response(status=503)
+        stats['domains'] += domains
+        return None
+
+    async def ranking(request):
+        error = await respond(1)
+        if error is not None:
+            return error
+        return web.json_response(rank(request.match_info['domain']))
+
+    async def batch(request):
+        domains = (await request.json())['domains']
+        error = await respond(len(domains))
+        if error is not None:
+            return error
+        return web.json_response({domain: rank(domain) for domain in domains})
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get('/domain/ranking/{domain}', ranking)
+    app.router.add_post('/domain/ranking/batch', batch)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+def serve(port: int, profile: Dict[str, Any]):
+    web.run_app(create_app(**profile), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class MockServer:
+    """Runs the mock API in a process of its own, so that it does not share the
+    event loop (or the CPU time and RSS measurements) of the code under test"""
+
+    def __init__(self, **profile):
+        self.profile = profile
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+
+    def __enter__(self) -> 'MockServer':
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=serve, args=(self.port, self.profile), daemon=True)
+        self.process.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                    return self
+            except OSError:
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    self.process.terminate()
+                    raise RuntimeError('the mock API did not start')
+                time.sleep(0.05)
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self) -> Dict[str, int]:
+        with urllib.request.urlopen(f"{self.url}/stats") as response:
+            return json.load(response)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--latency-ms', type=float, default=5)
+    arg_parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='fixed')
+    arg_parser.add_argument('--sigma', type=float, default=0.5, help='shape of the lognormal distribution')
+    arg_parser.add_argument('--error-429', type=float, default=0.0, help='share of 429 responses')
+    arg_parser.add_argument('--error-5xx', type=float, default=0.0, help='share of 503 responses')
+    arg_parser.add_argument('--retry-after', type=float, help='Retry-After of the 429 responses (seconds)')
+    args = arg_parser.parse_args()
+
+    print(f"Mock reputation API on http://127.0.0.1:{args.port}")
+    serve(args.port, {'latency_ms': args.latency_ms, 'distribution': args.distribution, 'sigma': args.sigma,
+                      'error_429': args.error_429, 'error_5xx': args.error_5xx, 'retry_after': args.retry_after})
+
+
+if __name__ == '__main__':
+    main()
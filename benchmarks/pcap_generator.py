@@ -0,0 +1,77 @@
+"""Generate synthetic DNS captures for the benchmarks
+
+Usage: python benchmarks/pcap_generator.py OUTPUT [--domains N] [--duplication R] [--responses R]
+"""
+import argparse
+import math
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from scapy.layers.dns import DNS, DNSQR, DNSRR, dns_compress
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.utils import PcapWriter
+
+
+def domain_names(domains: int):
+    return [f"host{i}.example{i % 97}.com" for i in range(domains)]
+
+
+def write_capture(path: str, packets: int, domains: int, response_ratio: float = 0.5,
+                  duplication: float = None, seed: int = 0) -> int:
+    """Write a capture of DNS queries and compressed responses over a pool of domains.
+    response_ratio is the share of responses among the packets. With duplication (the share
+    of the packets whose domain was already seen), every domain appears and packets is
+    derived from it. Returns the number of packets written."""
+    rng = random.Random(seed)
+    names = domain_names(domains)
+    if duplication is not None:
+        if not 0 <= duplication < 1:
+            raise ValueError("duplication must be in [0, 1)")
+        packets = math.ceil(domains / (1 - duplication))
+
+    # building packets with scapy is slow, every name gets pre-built query/response frames
+    frames = {}
+    seen = 0
+    with PcapWriter(path, linktype=1) as writer:
+        for i in range(packets):
+            if duplication is None:
+                name = rng.choice(names)
+            else:
+                # the new domains are spread over the capture, and all of them make it in
+                new_left = domains - seen
+                if new_left and (not seen or new_left >= packets - i or rng.random() >= duplication):
+                    name = names[seen]
+                    seen += 1
+                else:
+                    name = names[rng.randrange(seen)]
+            if name not in frames:
+                frames[name] = (
+                    bytes(Ether() / IP() / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname=name))),
+                    bytes(dns_compress(Ether() / IP() / UDP(sport=53, dport=40000) /
+                                       DNS(qr=1, qd=DNSQR(qname=name), an=DNSRR(rrname=name, rdata='192.0.2.1')))))
+            writer.write(frames[name][rng.random() < response_ratio])
+    return packets
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('output')
+    arg_parser.add_argument('--domains', type=int, default=2000, help='unique domains')
+    arg_parser.add_argument('--packets', type=int, default=20000,
+                            help='packets, when no --duplication is given')
+    arg_parser.add_argument('--duplication', type=float,
+                            help='share of the packets that repeat an already seen domain')
+    arg_parser.add_argument('--responses', type=float, default=0.5, help='share of responses among the packets')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    packets = write_capture(args.output, args.packets, args.domains, args.responses, args.duplication, args.seed)
+    print(f"{args.output}: {packets} packets, {args.domains} domains")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,40 @@
 """
 Main entry point for DNS Reputation Analysis Tool
 """
+import time
+
+# the cold start is measured from the first import - heavy dependencies (scapy, aiohttp,
+# tqdm) are imported where they are first needed, to keep it short
+STARTED = time.time()
+
 import asyncio
+import os
 import signal
 import sys
-import time
+from datetime import datetime
 from pathlib import Path
+from typing import Dict, Any, Optional
 import click
 from colorama import init, Fore
 
-from traffic_replay.pcap_manager import PCAPManager
+from traffic_replay.domain_filter import create_filter
+from traffic_replay.pcap_manager import PCAPManager, LOOKUP_ORDERS, order_domains
+from traffic_replay.replayer import TrafficReplayer, parse_speed
 from reputation.api_client import ReputationClient
+from reputation.hedging import create_hedge_policy
+from reputation.lookup_pool import LookupPool
 from monitoring.metrics import MetricsCollector
 from monitoring.reporter import Reporter
+from monitoring.profiler import SamplingProfiler
+from monitoring.tracing import tracer
 from utils.config import Config
+from utils.event_loop import EVENT_LOOPS, use_event_loop
+from utils.journal import RunJournal
 
 init(autoreset=True)  # Initialize colorama
 
+IMPORTED = time.time()
+
 
 
 class DNSReputationAnalyzer:
@@ -24,14 +42,38 @@ class DNSReputationAnalyzer:
         self.config = Config(config_path)
         self.metrics = MetricsCollector()
         self.reporter = Reporter(self.metrics, self.config)
-        self.pcap_manager = PCAPManager(self.metrics)
+        self.pcap_manager = PCAPManager(self.metrics,
+                                        self.config.data['performance'].get('pcap_parser', 'scapy'),
+                                        self.config.data['performance'].get('extraction_workers', 1),
+                                        create_filter(self.config))
         self.reputation_client = ReputationClient(self.config, self.metrics)
+        self.metrics.track(self.reputation_client.cache)
+        self.metrics.track(self.reputation_client.rate_controller)
+        self.metrics.track(self.reputation_client.transport)
+        self.metrics.track(self.reputation_client)
+        self.metrics.track(self.pcap_manager)
+        self.metrics.track(self.pcap_manager.domain_filter)
+        self.replayer = None
+        # looks the domains up in worker processes, with --lookup-workers
+        self.lookup_pool = None
+        # completed lookups are checkpointed with --checkpoint, for --resume
+        self.journal = None
+        # sightings in the capture of the domains whose results were written
+        self.covered_queries = 0
         self.shutdown_reason = None
         self.start_time = None
 
-    async def analyze(self, pcap_file: str, timeout: int = None):
-        """Main analysis workflow"""
+    async def analyze(self, pcap_file: str, timeout: int = None, resume: bool = False):
+        """Main analysis workflow - resume continues the run checkpointed in the journal"""
         self.start_time = time.time()
+        follow = self.config.data.get('follow', {}).get('enabled', False)
+        replay = self.config.data.get('replay', {}).get('enabled', False)
+        checkpoint = self.config.data.get('checkpoint', {})
+        # the other modes have no end to resume from
+        if (checkpoint.get('enabled', False) or resume) and not (follow or replay):
+            self.journal = RunJournal(checkpoint.get('journal_file', 'dns_checkpoint.jsonl'),
+                                      checkpoint.get('interval', 5.0))
+            self.metrics.track(self.journal)
 
         print(f"{Fore.GREEN}Starting DNS Reputation Analysis...")
         print(f"{Fore.CYAN}PCAP File: {pcap_file}")
@@ -42,33 +84,82 @@ class DNSReputationAnalyzer:
         signal.signal(signal.SIGINT, self._handle_interrupt)
         signal.signal(signal.SIGTERM, self._handle_interrupt)
 
-        try:
-            # Start monitoring
-            monitor_task = asyncio.create_task(self.reporter.start_monitoring())
+        # Results are written as they arrive
+        self.reporter.open_results()
+
+        # Serve the live metrics to scrapers, if configured
+        metrics_port = self.config.data['monitoring'].get('metrics_port', 0)
+        metrics_server = None
+        if metrics_port:
+            # aiohttp.web is only imported when the endpoint is served
+            from monitoring.prometheus import MetricsServer
+            metrics_server = MetricsServer(self.metrics,
+                                           self.config.data['monitoring'].get('metrics_host', '127.0.0.1'),
+                                           metrics_port)
+            await metrics_server.start()
+            print(f"{Fore.CYAN}Metrics: http://{metrics_server.host}:{metrics_server.port}/metrics")
 
+        # Start monitoring
+        monitor_task = asyncio.create_task(self.reporter.start_monitoring())
+        # Expire cached entries in the background
+        sweep_task = asyncio.create_task(self.reputation_client.cache.sweep(
+            self.config.data.get('cache', {}).get('sweep_interval', 60)))
+
+        timeout_task = None
+        checkpoint_task = None
+        try:
             # Set timeout if specified
             if timeout:
-                asyncio.create_task(self._timeout_handler(timeout))
+                timeout_task = asyncio.create_task(self._timeout_handler(timeout, asyncio.current_task()))
 
-            # Extract domains from PCAP
-            print(f"{Fore.BLUE}Extracting DNS queries from PCAP...")
-            domains = await self.pcap_manager.extract_domains(pcap_file)
+            if self.journal is not None:
+                if resume:
+                    self._resume(pcap_file)
+                elif os.path.exists(self.journal.path):
+                    raise ValueError(f"{self.journal.path} holds the checkpoint of an unfinished run - "
+                                     f"continue it with --resume or remove it")
+                self.journal.start(pcap_file)
+                checkpoint_task = asyncio.create_task(self.journal.checkpoint())
 
-            if not domains:
-                print(f"{Fore.RED}No DNS queries found in PCAP file")
-                return
+            # replay looks every packet up in this process
+            workers = self.config.data['performance'].get('lookup_workers', 1)
+            if workers > 1 and not replay:
+                # started before extraction, which hides their start-up
+                self.lookup_pool = LookupPool(self.reputation_client, workers).start()
+                self.metrics.track(self.lookup_pool)
+                print(f"{Fore.CYAN}Lookup workers: {workers}")
 
-            print(f"{Fore.GREEN}Found {len(domains)} unique domains")
+            if follow:
+                await self._follow(pcap_file)
+            elif replay:
+                await self._replay(pcap_file)
+            elif self.journal is not None and self.journal.domains is not None:
+                # resumed after extraction - the lookups left are those not journaled as done
+                domains = [domain for domain in self.journal.domains if domain not in self.journal.done]
+                print(f"{Fore.BLUE}Resuming reputation lookups ({len(domains)} of "
+                      f"{len(self.journal.domains)} domains left)...")
+                await self._check_and_write(domains)
+            elif self.config.data['performance'].get('pipeline', False) and not resume:
+                await self._extract_and_check(pcap_file)
+            else:
+                # Extract domains from PCAP
+                print(f"{Fore.BLUE}Extracting DNS queries from PCAP...")
+                domains = await self.pcap_manager.extract_domains(pcap_file)
 
-            # Process domains
-            print(f"{Fore.BLUE}Starting reputation lookups...")
-            results = await self.reputation_client.check_domains(domains)
+                if not domains:
+                    print(f"{Fore.RED}No DNS queries found in PCAP file")
+                    return
 
-            # Save results
-            await self.reporter.save_results(results)
+                print(f"{Fore.GREEN}Found {len(domains)} unique domains")
 
-            # Cancel monitoring
-            monitor_task.cancel()
+                # Process domains - in priority order, so that a timeout cuts the least traffic
+                order = self.config.data['performance'].get('lookup_order', 'count')
+                ordered = order_domains(domains, order)
+                if self.journal is not None:
+                    self.journal.record_domains(domains, ordered)
+                    ordered = [domain for domain in ordered if domain not in self.journal.done]
+                print(f"{Fore.BLUE}Starting reputation lookups (by {order})...")
+                await self._check_and_write(ordered)
 
         except asyncio.CancelledError:
             pass
@@ -76,13 +167,126 @@ class DNSReputationAnalyzer:
             print(f"{Fore.RED}Error: {e}")
             self.shutdown_reason = "error"
         finally:
+            # Cancel monitoring
+            monitor_task.cancel()
+            sweep_task.cancel()
+            if timeout_task is not None:
+                timeout_task.cancel()
+            if checkpoint_task is not None:
+                checkpoint_task.cancel()
+                await asyncio.gather(checkpoint_task, return_exceptions=True)
+            if self.lookup_pool is not None:
+                self.lookup_pool.close()
+            if metrics_server is not None:
+                await metrics_server.stop()
             await self._shutdown()
 
-    async def _timeout_handler(self, timeout: int):
+    async def _extract_and_check(self, pcap_file: str):
+        """Pipelined mode - look domains up while the PCAP is still being parsed"""
+        print(f"{Fore.BLUE}Extracting DNS queries and starting reputation lookups...")
+        # bounded, so that parsing cannot race ahead of the lookups
+        queue = asyncio.Queue(maxsize=self.config.data['performance'].get('pipeline_queue_size', 1000))
+        extraction = asyncio.create_task(self.pcap_manager.extract_domains(pcap_file, queue))
+
+        try:
+            await self._check_and_write(queue, extraction)
+            domains = await extraction
+        finally:
+            extraction.cancel()
+
+        print(f"{Fore.GREEN}Found {len(domains)} unique domains")
+        if self.journal is not None:
+            self.journal.record_domains(domains, list(domains))
+
+    def _resume(self, pcap_file: str):
+        """Load the journal of the interrupted run and write its results again, into this run's output"""
+        journal = self.journal
+        if not journal.load():
+            print(f"{Fore.YELLOW}No checkpoint found in {journal.path}, starting over")
+            return
+        if journal.pcap != os.path.realpath(pcap_file):
+            raise ValueError(f"the checkpoint in {journal.path} is of {journal.pcap}, not of {pcap_file}")
+
+        if journal.domains is not None:
+            self.pcap_manager.domains = journal.domains
+        for result in journal.results:
+            self.reporter.write_result(result)
+            self.covered_queries += result.get('query_count', 0)
+        print(f"{Fore.GREEN}Resuming from {journal.path}: {len(journal.results)} domains done" +
+              ('' if journal.domains is not None else ', extracting the capture again'))
+
+    async def _follow(self, pcap_file: str):
+        """Follow mode - look the new domains of growing/rotated captures up until stopped"""
+        print(f"{Fore.BLUE}Following {pcap_file} for new DNS queries...")
+        queue = asyncio.Queue(maxsize=self.config.data['performance'].get('pipeline_queue_size', 1000))
+        # a domain seen within the cache TTL is not looked up again
+        follower = asyncio.create_task(self.pcap_manager.follow(
+            pcap_file, queue,
+            ttl=self.config.data['performance']['cache_ttl'],
+            max_entries=self.config.data.get('cache', {}).get('max_entries', 0),
+            poll_interval=self.config.data['follow'].get('poll_interval', 1.0)))
+        checker = asyncio.create_task(self._check_and_write(queue))
+
+        try:
+            # neither ends on its own - unless it fails
+            done, _ = await asyncio.wait({follower, checker}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            follower.cancel()
+            checker.cancel()
+            await asyncio.gather(follower, checker, return_exceptions=True)
+
+    async def _replay(self, pcap_file: str):
+        """Replay mode - look every DNS packet up at its original time, scaled by the replay speed"""
+        replay = self.config.data['replay']
+        speed = parse_speed(replay.get('speed', 1))
+        self.replayer = TrafficReplayer(self.pcap_manager, self.reputation_client, speed,
+                                        replay.get('max_outstanding', 10000), replay.get('use_cache', False))
+        self.metrics.track(self.replayer)
+        print(f"{Fore.BLUE}Replaying DNS traffic at {f'{speed:g}x' if speed else 'max'} speed...")
+        await self.replayer.replay(pcap_file, self.reporter.write_result)
+
+    async def _check_and_write(self, domains, extraction: Optional[asyncio.Task] = None):
+        """Look the domains (a list, or a queue in pipelined mode) up and write each result as it arrives.
+        While the `extraction` feeding the queue runs, the results are held back: the sightings
+        of their domains are still being counted, they are written once the counts are complete."""
+        # the total is unknown while the PCAP is parsed into a queue
+        total = None if isinstance(domains, asyncio.Queue) else len(domains)
+        from tqdm import tqdm
+        lookups = self.lookup_pool or self.reputation_client
+        held = []
+        try:
+            with tqdm(total=total, desc="Processing domains") as progress:
+                async for result in lookups.iter_results(domains, progress.update):
+                    held.append(result)
+                    if extraction is None or extraction.done():
+                        for result in held:
+                            self._write_result(result)
+                        held = []
+        finally:
+            # the extraction is over - or stopped (e.g. on timeout), the counts so far are kept
+            for result in held:
+                self._write_result(result)
+
+    def _write_result(self, result: Dict[str, Any]):
+        """Write a lookup result with the sighting counts of its domain, and checkpoint it"""
+        # extraction starts a new dict
+        info = self.pcap_manager.domains.get(result['domain'])
+        if info is not None:
+            self.covered_queries += info.count
+            # the result may be shared with the cache
+            result = {**result, **info.as_row()}
+        self.reporter.write_result(result)
+        if self.journal is not None:
+            self.journal.record_result(result)
+
+    async def _timeout_handler(self, timeout: int, analysis: asyncio.Task):
         """Handle timeout"""
         await asyncio.sleep(timeout)
         self.shutdown_reason = "timeout"
-        raise asyncio.CancelledError()
+        # stop the analysis, the results written so far are kept
+        analysis.cancel()
 
     def _handle_interrupt(self, signum, frame):
         """Handle keyboard interrupt"""
@@ -93,6 +297,9 @@ class DNSReputationAnalyzer:
     async def _shutdown(self):
         """Graceful shutdown"""
         runtime = time.time() - self.start_time if self.start_time else 0
+        # complete the results file(s) - the writer thread is joined off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.reporter.close_results)
+        self.close_journal()
 
         print(f"\n{Fore.YELLOW}{'=' * 50}")
         print(f"{Fore.RED}Test is over! Reason: {self.shutdown_reason or 'completed'}")
@@ -101,16 +308,108 @@ class DNSReputationAnalyzer:
         print(f"Domains processed: {self.metrics.successful_requests}")
         print(f"Average response time: {self.metrics.get_avg_response_time():.0f} ms")
         print(f"Max response time: {self.metrics.get_max_response_time():.1f} sec")
+        percentiles = self.metrics.get_percentiles()
+        print("Response time percentiles: " +
+              ", ".join(f"p{percent:g}={value:.0f}ms" for percent, value in percentiles.items()))
+        print(f"Cached requests: {self.metrics.cached_requests}")
+        if self.metrics.first_request_time is not None:
+            print(f"Cold start: {self.metrics.first_request_time - STARTED:.2f} seconds to the first lookup "
+                  f"(imports {(IMPORTED - STARTED) * 1000:.0f} ms)")
+        filtered = self.pcap_manager.domain_filter.filtered
+        if filtered:
+            print(f"Names filtered out: {sum(filtered.values())} (" +
+                  ", ".join(f"{reason}: {count}" for reason, count in filtered.most_common()) + ")")
+        sightings = sum(info.count for info in self.pcap_manager.domains.values())
+        if sightings:
+            print(f"Traffic covered: {self.covered_queries / sightings:.1%} "
+                  f"({self.covered_queries} of {sightings} domain sightings)")
+        cache = self.reputation_client.cache
+        print(f"Cache hit ratio: {cache.hit_ratio():.1%} ({cache.hits} hits, {cache.misses} misses, "
+              f"{cache.evictions} evictions, {cache.expirations} expirations)")
+        # merged with those of the lookup workers, if any
+        transport = self.metrics.get_stats()
+        print(f"Connections: {transport['connections_created']} opened, "
+              f"{transport['connections_reused']} reused ({transport['connection_reuse_ratio']:.1%})")
+        if 'hedges' in transport:
+            budget = self.config.data['hedging'].get('budget', 0.05)
+            print(f"Hedging: {transport['hedges']} of {transport['hedge_requests']} requests hedged "
+                  f"({transport['hedge_rate']:.1%}, budget {budget:.0%}), {transport['hedge_wins']} won by the hedge, "
+                  f"delay {transport['hedge_delay']:.0f}ms")
+            print(f"Request p99: {transport['hedged_p99']:.0f}ms hedged, "
+                  f"at least {transport['unhedged_p99']:.0f}ms unhedged")
+        if self.replayer is not None:
+            replay = self.replayer.get_stats()
+            target = replay['replay_target_rate']
+            print(f"Replay: {replay['replay_achieved_rate']:.1f} lookups/sec completed, " +
+                  (f"{target:.1f} targeted ({replay['replay_achieved_rate'] / target:.0%}), " if target else '') +
+                  f"{replay['replay_issue_rate']:.1f} issued, {replay['replay_dropped']} dropped, "
+                  f"schedule lag p99={replay['replay_lag_p99']:.0f}ms")
+            print(f"Replay latency from schedule: p50={replay['replay_latency_p50']:.0f}ms, "
+                  f"p99={replay['replay_latency_p99']:.0f}ms")
         print(f"{Fore.YELLOW}{'=' * 50}")
 
+    def close_journal(self):
+        """Checkpoint the results written so far - the journal of a completed run is removed"""
+        if self.journal is None:
+            return
+        journal, self.journal = self.journal, None
+        if journal.close(completed=self.shutdown_reason is None):
+            print(f"{Fore.CYAN}Checkpoint saved to {journal.path} - run again with --resume to continue")
+
+
+def save_trace(config):
+    """Export the recorded spans as Chrome trace event JSON"""
+    tracer.disable()
+    filename = f"{config.data['monitoring'].get('trace_file', 'dns_trace')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    tracer.export(filename, {'command': ' '.join(sys.argv)})
+    print(f"{Fore.GREEN}Trace saved to {filename} ({len(tracer.events)} events) - "
+          f"open it in chrome://tracing or https://ui.perfetto.dev")
+
+
+def save_profile(profiler: SamplingProfiler, config):
+    """Stop the sampling profiler, print the top hot spots and save the full table"""
+    profiler.stop()
+    filename = f"{config.data['monitoring'].get('profile_file', 'dns_profile')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    with open(filename, 'w') as f:
+        f.write(profiler.report(limit=100))
+    print(f"{Fore.CYAN}Hot spots:\n{profiler.report(limit=10)}")
+    print(f"{Fore.GREEN}Profile saved to {filename}")
+
+
 @click.command()
-@click.option('--pcap', '-p', required=True, help='Path to PCAP file')
+@click.option('--pcap', '-p', required=True, help='Path to PCAP file or directory of rotated captures')
 @click.option('--config', '-c', default='config.yaml', help='Path to config file')
 @click.option('--timeout', '-t', type=int, help='Timeout in seconds')
-@click.option('--output-format', '-o', type=click.Choice(['csv', 'json']), default='csv')
-def main(pcap, config, timeout, output_format):
+@click.option('--output-format', '-o', type=click.Choice(['csv', 'json', 'jsonl']), default='csv')
+@click.option('--gzip', 'compress', is_flag=True, default=None, help='Gzip the results files (overrides config)')
+@click.option('--parser', type=click.Choice(['scapy', 'fast']), help='PCAP parser (overrides config)')
+@click.option('--workers', '-w', type=click.IntRange(min=1), help='PCAP extraction processes (overrides config)')
+@click.option('--pipeline/--no-pipeline', default=None,
+              help='Look domains up while the PCAP is parsed (overrides config)')
+@click.option('--order', type=click.Choice(LOOKUP_ORDERS),
+              help='Lookup order of the extracted domains (overrides config)')
+@click.option('--lookup-workers', type=click.IntRange(min=1),
+              help='Lookup processes, the domains are sharded over them (overrides config)')
+@click.option('--batch-size', type=click.IntRange(min=0), help='Domains per batch lookup, 0 to disable (overrides config)')
+@click.option('--hedge', is_flag=True, default=None,
+              help='Send a second request for lookups slower than the live p95 (overrides config)')
+@click.option('--loop', 'event_loop', type=click.Choice(EVENT_LOOPS),
+              help='Event loop implementation, uvloop if installed (overrides config)')
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535),
+              help='Serve OpenMetrics on this port, 0 to disable (overrides config)')
+@click.option('--follow', '-f', is_flag=True, default=None,
+              help='Keep following a growing capture or a directory of rotated captures (overrides config)')
+@click.option('--speed', help='Replay the DNS packets at their capture times, scaled: 1x, 10x, max...')
+@click.option('--checkpoint', is_flag=True, default=None,
+              help='Checkpoint the results to a journal, for --resume (overrides config)')
+@click.option('--resume', is_flag=True, help='Continue the interrupted run checkpointed in the journal')
+@click.option('--trace', is_flag=True, help='Record per-stage spans and export them as a Chrome trace')
+@click.option('--profile', is_flag=True, help='Run a sampling profiler and report the hot spots')
+def main(pcap, config, timeout, output_format, compress, parser, workers, pipeline, order, lookup_workers, batch_size,
+         hedge, event_loop, metrics_port, follow, speed, checkpoint, resume, trace, profile):
     """DNS Reputation Analysis Tool"""
-    if not Path(pcap).exists():
+    # a followed capture may not have been created yet
+    if not Path(pcap).exists() and not follow:
         print(f"{Fore.RED}Error: PCAP file not found: {pcap}")
         sys.exit(1)
 
@@ -119,10 +418,81 @@ def main(pcap, config, timeout, output_format):
     if output_format:
         analyzer.config.data['output']['format'] = output_format
 
+    if compress:
+        analyzer.config.data['output']['compress'] = True
+
+    if parser:
+        analyzer.pcap_manager.parser = parser
+
+    if workers:
+        analyzer.pcap_manager.workers = workers
+
+    if pipeline is not None:
+        analyzer.config.data['performance']['pipeline'] = pipeline
+
+    if order:
+        analyzer.config.data['performance']['lookup_order'] = order
+
+    if lookup_workers:
+        analyzer.config.data['performance']['lookup_workers'] = lookup_workers
+
+    if batch_size is not None:
+        analyzer.reputation_client.batch_size = batch_size
+
+    if hedge:
+        analyzer.config.data.setdefault('hedging', {})['enabled'] = True
+        analyzer.reputation_client.hedge_policy = create_hedge_policy(analyzer.config)
+
+    if event_loop:
+        analyzer.config.data['performance']['event_loop'] = event_loop
+
+    if metrics_port is not None:
+        analyzer.config.data['monitoring']['metrics_port'] = metrics_port
+
+    if follow:
+        analyzer.config.data.setdefault('follow', {})['enabled'] = True
+
+    if speed is not None:
+        try:
+            parse_speed(speed)
+        except ValueError:
+            print(f"{Fore.RED}Error: invalid replay speed: {speed}")
+            sys.exit(1)
+        analyzer.config.data.setdefault('replay', {}).update({'enabled': True, 'speed': speed})
+
+    if checkpoint:
+        analyzer.config.data.setdefault('checkpoint', {})['enabled'] = True
+
+    if resume and (follow or speed is not None):
+        print(f"{Fore.RED}Error: --resume does not apply to follow or replay mode")
+        sys.exit(1)
+
+    if trace:
+        tracer.enable()
+
+    profiler = None
+    if profile:
+        profiler = SamplingProfiler(analyzer.config.data['monitoring'].get('profile_interval', 0.005)).start()
+
+    event_loop = analyzer.config.data['performance'].get('event_loop', 'asyncio')
+    if use_event_loop(event_loop) != event_loop:
+        print(f"{Fore.YELLOW}uvloop is not installed (pip install uvloop), using the asyncio event loop")
+        # the lookup workers too
+        analyzer.config.data['performance']['event_loop'] = 'asyncio'
+
     try:
-        asyncio.run(analyzer.analyze(pcap, timeout))
+        asyncio.run(analyzer.analyze(pcap, timeout, resume))
     except KeyboardInterrupt:
         pass
+    finally:
+        # complete the results file(s) and persist the pending cache entries, also on interrupt
+        analyzer.reporter.close_results()
+        analyzer.close_journal()
+        analyzer.reputation_client.cache.close()
+        if trace:
+            save_trace(analyzer.config)
+        if profiler is not None:
+            save_profile(profiler, analyzer.config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+"""Constant-memory latency histogram and sliding-window rate"""
+import math
+import time
+from array import array
+from typing import Dict, Iterable, List
+
+
+class LatencyHistogram:
+    """Log-bucketed (HDR-style) histogram. Bucket bounds grow geometrically by 1 + precision,
+    so a percentile is known within `precision` relative error. Recording is O(1) and memory
+    is fixed by the value range - about 2000 buckets for 10us..1h at 1%."""
+
+    def __init__(self, lowest: float = 0.01, highest: float = 3_600_000, precision: float = 0.01):
+        self.lowest = lowest
+        self.precision = precision
+        self._scale = 1 / math.log1p(precision)
+        # bucket 0 holds the values under lowest, the last one the values over highest
+        self.counts = array('Q', bytes(8 * (self._index(highest) + 2)))
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, value: float) -> int:
+        if value < self.lowest:
+            return 0
+        return int(math.log(value / self.lowest) * self._scale) + 1
+
+    def record(self, value: float):
+        """Record a value"""
+        self.counts[min(self._index(value), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+    def percentiles(self, percents: Iterable[float]) -> Dict[float, float]:
+        """The values under which percent% of the values fall, in one pass over the buckets"""
+        percents = sorted(percents)
+        result = {percent: 0.0 for percent in percents}
+        if not self.count:
+            return result
+
+        pending = iter(percents)
+        percent = next(pending)
+        rank = max(math.ceil(percent / 100 * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            while seen >= rank:
+                result[percent] = self._value(index)
+                percent = next(pending, None)
+                if percent is None:
+                    return result
+                rank = max(math.ceil(percent / 100 * self.count), 1)
+        return result
+
+    def cumulative(self, bounds: Iterable[float]) -> List[int]:
+        """Number of values under each of the (sorted) bounds, in one pass over the buckets"""
+        limits = [min(self._index(bound), len(self.counts) - 1) for bound in bounds]
+        result, seen, index = [], 0, 0
+        for limit in limits:
+            # the bucket of a bound holds values on both of its sides, it is counted as under it
+            while index <= limit:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def percentile(self, percent: float) -> float:
+        return self.percentiles([percent])[percent]
+
+    def _value(self, index: int) -> float:
+        """The value representing a bucket - its geometric middle, within the recorded range"""
+        if index == 0:
+            return self.min
+        if index == len(self.counts) - 1:
+            return self.max
+        value = self.lowest * (1 + self.precision) ** (index - 0.5)
+        return min(max(value, self.min), self.max)
+
+
+class SlidingWindowRate:
+    """Events per second over the last `window` seconds, in per-second buckets"""
+
+    def __init__(self, window: int = 10):
+        self.window = window
+        self.counts = [0] * window
+        self.current = int(time.time())
+        self.start = time.time()
+
+    def add(self, count: int = 1):
+        self._advance(int(time.time()))
+        self.counts[self.current % self.window] += count
+
+    def _advance(self, second: int):
+        """Clear the buckets of the seconds that went by without events"""
+        if second == self.current:
+            return
+        for passed in range(self.current + 1, min(second, self.current + self.window) + 1):
+            self.counts[passed % self.window] = 0
+        self.current = second
+
+    def rate(self) -> float:
+        now = time.time()
+        self._advance(int(now))
+        # the current second is only partly over, and the run may be younger than the window
+        span = min(self.window - 1 + now % 1, now - self.start)
+        return sum(self.counts) / span if span > 0 else 0
@@ -1,7 +1,13 @@
 """Metrics collection for monitoring"""
 import time
-from typing import List, Dict, Any
-import statistics
+from typing import Dict, Any
+
+from monitoring.histogram import LatencyHistogram, SlidingWindowRate
+
+# Latency percentiles that are reported
+PERCENTILES = (50, 90, 99, 99.9)
+# Seconds over which QPS and request rates are measured
+RATE_WINDOW = 10
 
 
 class MetricsCollector:
@@ -9,54 +15,84 @@ class MetricsCollector:
         self.total_requests = 0
         self.successful_requests = 0
         self.failed_requests = 0
-        self.response_times: List[float] = []
-        self.current_qps = 0
+        # requests answered from the cache, they are kept out of the API latencies
+        self.cached_requests = 0
+        # API response times (ms) in constant memory
+        self.response_times = LatencyHistogram()
         self.queries_count = 0
+        self.query_rate = SlidingWindowRate(RATE_WINDOW)
+        self.request_rate = SlidingWindowRate(RATE_WINDOW)
         self.start_time = time.time()
+        # when the first lookup was answered (from the cache or not), for the cold start time
+        self.first_request_time = None
+        # components (cache, rate controller...) whose get_stats() are reported along with the request metrics
+        self.sources = []
+
+    @property
+    def current_qps(self) -> float:
+        """DNS queries per second, over the last RATE_WINDOW seconds"""
+        return self.query_rate.rate()
 
-    def add_request(self, response_time: float, success: bool = True):
-        """Record a request"""
+    def add_request(self, response_time: float, success: bool = True, cached: bool = False):
+        """Record a request - response_time is in ms, 0 if unknown"""
+        if not self.total_requests:
+            self.first_request_time = time.time()
         self.total_requests += 1
-        self.response_times.append(response_time)
+        self.request_rate.add()
+
+        if cached:
+            self.cached_requests += 1
+        elif response_time > 0:
+            self.response_times.record(response_time)
 
         if success:
             self.successful_requests += 1
         else:
             self.failed_requests += 1
 
-    def add_query(self):
-        """Record a DNS query"""
-        self.queries_count += 1
-        elapsed = time.time() - self.start_time
-        if elapsed > 0:
-            self.current_qps = self.queries_count / elapsed
+    def add_query(self, count: int = 1):
+        """Record DNS queries"""
+        self.queries_count += count
+        self.query_rate.add(count)
+
+    def track(self, source):
+        """Report the get_stats() of a component, e.g. the cache hit/miss/eviction/expiry counters"""
+        self.sources.append(source)
 
     def get_avg_response_time(self) -> float:
         """Get average response time in ms"""
-        if self.response_times:
-            return statistics.mean(self.response_times)
-        return 0
+        return self.response_times.mean()
 
     def get_max_response_time(self) -> float:
         """Get max response time in seconds"""
-        if self.response_times:
-            return max(self.response_times) / 1000
-        return 0
+        return self.response_times.max / 1000
 
     def get_min_response_time(self) -> float:
         """Get min response time in ms"""
-        if self.response_times:
-            return min(self.response_times)
-        return 0
+        return self.response_times.min if self.response_times.count else 0
+
+    def get_percentiles(self) -> Dict[float, float]:
+        """Get the response time percentiles in ms"""
+        return self.response_times.percentiles(PERCENTILES)
 
     def get_stats(self) -> Dict[str, Any]:
         """Get current statistics"""
-        return {
+        percentiles = self.get_percentiles()
+        stats = {
             'qps': self.current_qps,
+            'request_rate': self.request_rate.rate(),
             'total_requests': self.total_requests,
             'successful_requests': self.successful_requests,
             'failed_requests': self.failed_requests,
+            'cached_requests': self.cached_requests,
             'avg_response_time': self.get_avg_response_time(),
             'max_response_time': self.get_max_response_time(),
-            'min_response_time': self.get_min_response_time()
-        }
\ No newline at end of file
+            'min_response_time': self.get_min_response_time(),
+            'p50_response_time': percentiles[50],
+            'p90_response_time': percentiles[90],
+            'p99_response_time': percentiles[99],
+            'p999_response_time': percentiles[99.9]
+        }
+        for source in self.sources:
+            stats.update(source.get_stats())
+        return stats
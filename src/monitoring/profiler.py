@@ -0,0 +1,72 @@
+"""Sampling profiler for finding the hot spots of a run"""
+import os
+import sys
+import threading
+from collections import Counter
+from typing import List, Tuple
+
+
+class SamplingProfiler:
+    """Samples the stacks of all the other threads every `interval` seconds from a
+    background thread. Unlike cProfile it does not hook every call, so the run keeps
+    its speed - the price is statistical, not exact, counts.
+    A thread that has not moved since the previous sample is taken as idle (blocked on a
+    lock, a queue or select) and is not counted, so the hot spots are where the work is."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.idle = 0
+        # samples by (file, line, function) - own: on top of the stack, total: anywhere in it
+        self.own = Counter()
+        self.total = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self) -> 'SamplingProfiler':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        positions = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                position = (id(frame), frame.f_lasti)
+                if positions.get(thread_id) == position:
+                    self.idle += 1
+                    continue
+                positions[thread_id] = position
+                self.samples += 1
+                self.own[self._key(frame)] += 1
+                # a recursive function is counted once per sample
+                seen = set()
+                while frame is not None:
+                    seen.add(self._key(frame))
+                    frame = frame.f_back
+                self.total.update(seen)
+
+    @staticmethod
+    def _key(frame) -> Tuple[str, int, str]:
+        code = frame.f_code
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def hot_spots(self, limit: int = 20) -> List[Tuple[str, int, int]]:
+        """The functions most often on top of the stack, as (function, own samples, total samples)"""
+        return [(f"{name} ({os.path.basename(filename)}:{line})", count, self.total[(filename, line, name)])
+                for (filename, line, name), count in self.own.most_common(limit)]
+
+    def report(self, limit: int = 20) -> str:
+        """The hot spots as a text table"""
+        lines = [f"{self.samples} samples every {self.interval * 1000:g}ms ({self.idle} idle samples left out)",
+                 f"{'own':>7} {'total':>7}  function"]
+        for function, own, total in self.hot_spots(limit):
+            lines.append(f"{own / self.samples:>7.1%} {total / self.samples:>7.1%}  {function}")
+        return '\n'.join(lines) + '\n'
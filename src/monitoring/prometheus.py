@@ -0,0 +1,117 @@
+"""OpenMetrics endpoint for live metrics"""
+import time
+from typing import List, Optional
+
+from aiohttp import web
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PREFIX = 'dns_analyzer_'
+# Upper bounds (seconds) of the exported response time buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Scrapes within that many seconds of the previous one get the same rendering
+MIN_RENDER_INTERVAL = 1.0
+
+# (stats key, metric name, type, help)
+METRICS = [
+    ('qps', 'dns_queries_per_second', 'gauge', 'DNS queries extracted per second, over the last 10 seconds'),
+    ('request_rate', 'lookups_per_second', 'gauge', 'Reputation lookups per second, over the last 10 seconds'),
+    ('in_flight_requests', 'in_flight_requests', 'gauge', 'HTTP requests to the reputation API in flight'),
+    ('lookup_queue_depth', 'lookup_queue_depth', 'gauge', 'Domains waiting for a lookup worker'),
+    ('pipeline_queue_depth', 'pipeline_queue_depth', 'gauge', 'Extracted domains waiting in the pipeline queue'),
+    ('packets_sent', 'pcap_packets', 'counter', 'DNS packets read from the PCAP'),
+    ('packets_per_second', 'pcap_packets_per_second', 'gauge', 'DNS packets read from the PCAP per second'),
+    ('bytes_read', 'pcap_read_bytes', 'counter', 'Bytes of the PCAP read'),
+    ('errors', 'pcap_errors', 'counter', 'PCAP packets that could not be processed'),
+    ('rate_limit', 'rate_limit_rps', 'gauge', 'Current request rate of the adaptive rate control'),
+    ('rate_ceiling', 'rate_ceiling_rps', 'gauge', 'Configured requests per second ceiling'),
+    ('cache_size', 'cache_entries', 'gauge', 'Entries in the reputation cache'),
+    ('cache_bytes', 'cache_bytes', 'gauge', 'Estimated memory held by the reputation cache'),
+    ('cache_hits', 'cache_hits', 'counter', 'Reputation cache hits'),
+    ('cache_negative_hits', 'cache_negative_hits', 'counter', 'Reputation cache hits on failed lookups'),
+    ('cache_misses', 'cache_misses', 'counter', 'Reputation cache misses'),
+    ('cache_evictions', 'cache_evictions', 'counter', 'Reputation cache LRU evictions'),
+    ('cache_expirations', 'cache_expirations', 'counter', 'Reputation cache entries expired'),
+    ('connections_created', 'http_connections_created', 'counter', 'HTTP connections opened'),
+    ('connections_reused', 'http_connections_reused', 'counter', 'HTTP requests sent on a pooled connection'),
+    ('hedges', 'hedged_requests', 'counter', 'Second requests sent for lookups slower than the hedge delay'),
+    ('hedge_wins', 'hedge_wins', 'counter', 'Hedged lookups answered by the second request first'),
+]
+
+
+def render_openmetrics(metrics) -> str:
+    """Render the MetricsCollector statistics (and those of the components it tracks) as OpenMetrics text"""
+    stats = metrics.get_stats()
+    lines: List[str] = []
+
+    def family(name: str, metric_type: str, help_text: str):
+        lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+        lines.append(f"# HELP {PREFIX}{name} {help_text}")
+
+    family('requests', 'counter', 'Reputation lookups by result')
+    for result, key in (('success', 'successful_requests'), ('failure', 'failed_requests'),
+                        ('cached', 'cached_requests')):
+        lines.append(f'{PREFIX}requests_total{{result="{result}"}} {stats[key]}')
+
+    # response times are recorded in ms, OpenMetrics wants seconds
+    histogram = metrics.response_times
+    family('request_duration_seconds', 'histogram', 'Response time of the reputation API calls')
+    counts = histogram.cumulative([bound * 1000 for bound in LATENCY_BUCKETS])
+    for bound, count in zip(LATENCY_BUCKETS, counts):
+        lines.append(f'{PREFIX}request_duration_seconds_bucket{{le="{bound}"}} {count}')
+    lines.append(f'{PREFIX}request_duration_seconds_bucket{{le="+Inf"}} {histogram.count}')
+    lines.append(f'{PREFIX}request_duration_seconds_count {histogram.count}')
+    lines.append(f'{PREFIX}request_duration_seconds_sum {histogram.total / 1000}')
+
+    family('retries', 'counter', 'Retried reputation API calls by HTTP status (timeout/error without a response)')
+    for status, count in sorted(stats.get('retries_by_status', {}).items()):
+        lines.append(f'{PREFIX}retries_total{{status="{status}"}} {count}')
+
+    family('filtered_names', 'counter', 'Extracted names not looked up, by reason (reserved, allowlist, denylist...)')
+    for reason, count in sorted(stats.get('filtered_by_reason', {}).items()):
+        lines.append(f'{PREFIX}filtered_names_total{{reason="{reason}"}} {count}')
+
+    for key, name, metric_type, help_text in METRICS:
+        if key in stats:
+            family(name, metric_type, help_text)
+            suffix = '_total' if metric_type == 'counter' else ''
+            lines.append(f'{PREFIX}{name}{suffix} {stats[key]}')
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves the live metrics on /metrics for Prometheus-compatible scrapers.
+    A scrape renders at most once per MIN_RENDER_INTERVAL, so frequent scrapers
+    cannot take time from the lookups."""
+
+    def __init__(self, metrics, host: str, port: int):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+        self._body = b''
+        self._rendered = 0
+
+    async def start(self):
+        """Start serving"""
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        # the actual port, when binding to port 0
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        """Stop serving"""
+        if self.runner is not None:
+            runner, self.runner = self.runner, None
+            await runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        now = time.monotonic()
+        if now - self._rendered >= MIN_RENDER_INTERVAL:
+            self._body = render_openmetrics(self.metrics).encode()
+            self._rendered = now
+        return web.Response(body=self._body, headers={'Content-Type': CONTENT_TYPE})
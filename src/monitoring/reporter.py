@@ -1,70 +1,81 @@
 """Reporting and output management"""
 import asyncio
-import json
-import csv
-from datetime import datetime
 from typing import List, Dict, Any
 from colorama import Fore
 
+from monitoring.result_writer import ResultWriter
+from monitoring.tracing import tracer
+
 
 class Reporter:
     def __init__(self, metrics, config):
         self.metrics = metrics
         self.config = config
         self.monitoring = True
+        self.writer = None
 
     async def start_monitoring(self):
         """Start real-time monitoring"""
         update_interval = self.config.data['monitoring']['update_interval']
 
         while self.monitoring:
-            stats = self.metrics.get_stats()
+            with tracer.span('reporter.update'):
+                self._print_stats()
+            await asyncio.sleep(update_interval)
 
-            # Clear line and print stats
-            print(f"\r{Fore.GREEN}QPS: {stats['qps']:.1f} | "
-                  f"{Fore.CYAN}Requests: {stats['total_requests']} | "
-                  f"{Fore.YELLOW}Success: {stats['successful_requests']} | "
-                  f"{Fore.RED}Failed: {stats['failed_requests']} | "
-                  f"{Fore.MAGENTA}Avg RT: {stats['avg_response_time']:.0f}ms",
-                  end='', flush=True)
+    def _print_stats(self):
+        """Print the live statistics line"""
+        stats = self.metrics.get_stats()
 
-            await asyncio.sleep(update_interval)
+        # the effective rate of the adaptive rate control, out of the configured ceiling
+        rate = (f"{Fore.BLUE}RPS: {stats['rate_limit']:.0f}/{stats['rate_ceiling']:.0f} | "
+                if 'rate_limit' in stats else '')
 
-    async def save_results(self, results: List[Dict[str, Any]]):
-        """Save results to file"""
-        if not results:
-            return
+        # the lookups/sec a timed replay achieves, out of the capture's own rate
+        replay = (f"{Fore.BLUE}Replay: {stats['replay_achieved_rate']:.0f}/{stats['replay_target_rate']:.0f}/s | "
+                  if 'replay_target_rate' in stats else '')
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{self.config.data['output']['results_file']}_{timestamp}"
-        format_type = self.config.data['output']['format']
+        # Clear line and print stats
+        print(f"\r{Fore.GREEN}QPS: {stats['qps']:.1f} | "
+              f"{rate}"
+              f"{replay}"
+              f"{Fore.CYAN}Requests: {stats['total_requests']} | "
+              f"{Fore.YELLOW}Success: {stats['successful_requests']} | "
+              f"{Fore.RED}Failed: {stats['failed_requests']} | "
+              f"{Fore.MAGENTA}Avg RT: {stats['avg_response_time']:.0f}ms | "
+              f"p99: {stats['p99_response_time']:.0f}ms",
+              end='', flush=True)
 
-        if format_type == 'json':
-            await self._save_json(results, f"{filename}.json")
-        else:
-            await self._save_csv(results, f"{filename}.csv")
+    def open_results(self) -> ResultWriter:
+        """Start streaming results to the output file(s)"""
+        output = self.config.data['output']
+        self.writer = ResultWriter(output['results_file'], output['format'],
+                                   compress=output.get('compress', False),
+                                   rotate_bytes=output.get('rotate_bytes', 0),
+                                   flush_rows=output.get('flush_rows', 500),
+                                   flush_interval=output.get('flush_interval', 1.0)).start()
+        return self.writer
 
-        print(f"\n{Fore.GREEN}Results saved to {filename}.{format_type}")
+    def write_result(self, result: Dict[str, Any]):
+        """Append a result to the output file(s)"""
+        self.writer.write(result)
 
-    async def _save_json(self, results: List[Dict[str, Any]], filename: str):
-        """Save results as JSON"""
-        with open(filename, 'w') as f:
-            json.dump(results, f, indent=2, default=str)
+    def close_results(self):
+        """Complete the output file(s) with the results written so far"""
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        writer.close()
+        for filename in writer.files:
+            print(f"\n{Fore.GREEN}Results saved to {filename}")
 
-    async def _save_csv(self, results: List[Dict[str, Any]], filename: str):
-        """Save results as CSV"""
+    async def save_results(self, results: List[Dict[str, Any]]):
+        """Save results to file"""
         if not results:
             return
 
-        keys = ['domain', 'reputation', 'classification', 'categories',
-                'query_source', 'response_time']
-
-        with open(filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=keys)
-            writer.writeheader()
-
-            for result in results:
-                # Convert categories list to string
-                if 'categories' in result and isinstance(result['categories'], list):
-                    result['categories'] = ', '.join(result['categories'])
-                writer.writerow(result)
\ No newline at end of file
+        self.open_results()
+        for result in results:
+            self.write_result(result)
+        # the writer thread is joined off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close_results)
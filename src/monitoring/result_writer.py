@@ -0,0 +1,145 @@
+"""Streaming writer for the lookup results"""
+import csv
+import gzip
+import io
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from monitoring.tracing import tracer
+
+CSV_FIELDS = ['domain', 'reputation', 'classification', 'categories',
+              'query_source', 'response_time', 'query_count', 'first_seen', 'last_seen']
+EXTENSIONS = {'csv': '.csv', 'json': '.json', 'jsonl': '.jsonl'}
+
+# Put into the rows queue to stop the writer thread
+_CLOSE = object()
+
+
+class ResultWriter:
+    """Appends results to CSV, JSON or JSON Lines files (optionally gzipped) as they arrive.
+    Rows are formatted and written from a background thread in buffered batches - once
+    flush_rows rows are pending or flush_interval seconds after the first of them - so the
+    event loop never blocks on the disk. Every batch is flushed to the OS, so the files are
+    complete so far at any time. With rotate_bytes, a new file is started once a file reaches
+    that size on disk."""
+
+    def __init__(self, prefix: str, format_type: str = 'csv', compress: bool = False,
+                 rotate_bytes: int = 0, flush_rows: int = 500, flush_interval: float = 1.0):
+        self.prefix = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.format_type = format_type
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.files: List[str] = []
+        self.written = 0
+        self.error: Optional[Exception] = None
+
+        self.rows = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+        self.raw = None
+        self.stream = None
+        self.csv_writer = None
+        self.rows_in_file = 0
+
+    def start(self) -> 'ResultWriter':
+        """Start the writer thread"""
+        self.thread.start()
+        return self
+
+    def write(self, result: Dict[str, Any]):
+        """Queue a result to be written - never blocks"""
+        self.rows.put(result)
+
+    def close(self):
+        """Write the pending results, complete the current file and stop the writer thread"""
+        if self.thread.is_alive():
+            self.rows.put(_CLOSE)
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        """Writer thread - collect the queued rows in batches and write them"""
+        batch, deadline = [], 0
+        try:
+            while True:
+                try:
+                    row = self.rows.get(timeout=max(deadline - time.monotonic(), 0) if batch else None)
+                except queue.Empty:
+                    row = None
+                if row is _CLOSE:
+                    self._write_batch(batch)
+                    return
+                if row is not None:
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append(row)
+                    if len(batch) < self.flush_rows:
+                        continue
+                self._write_batch(batch)
+                batch = []
+        except Exception as e:
+            self.error = e
+        finally:
+            self._close_file()
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """Write a batch of rows and flush them to the OS, then rotate the file if it is full"""
+        if not batch:
+            return
+        with tracer.span('results.write', rows=len(batch), format=self.format_type):
+            if self.stream is None:
+                self._open_file()
+
+            for result in batch:
+                if self.format_type == 'csv':
+                    # the result may be shared with the cache - format a copy
+                    if isinstance(result.get('categories'), list):
+                        result = {**result, 'categories': ', '.join(result['categories'])}
+                    self.csv_writer.writerow(result)
+                elif self.format_type == 'json':
+                    self.stream.write(('[\n' if self.rows_in_file == 0 else ',\n') +
+                                      json.dumps(result, indent=2, default=str))
+                else:
+                    self.stream.write(json.dumps(result, default=str) + '\n')
+                self.rows_in_file += 1
+            self.written += len(batch)
+
+            # also sync-flushes a gzip stream, which makes the data compressed so far decompressible
+            self.stream.flush()
+            self.raw.flush()
+            if self.rotate_bytes and self.raw.tell() >= self.rotate_bytes:
+                self._close_file()
+
+    def _open_file(self):
+        """Open the next file of the results"""
+        part = f".{len(self.files)}" if self.files else ''
+        path = f"{self.prefix}{part}{EXTENSIONS[self.format_type]}{'.gz' if self.compress else ''}"
+        self.raw = open(path, 'wb')
+        binary = gzip.GzipFile(fileobj=self.raw, mode='wb') if self.compress else self.raw
+        self.stream = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        self.rows_in_file = 0
+        self.files.append(path)
+
+        if self.format_type == 'csv':
+            self.csv_writer = csv.DictWriter(self.stream, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            self.csv_writer.writeheader()
+
+    def _close_file(self):
+        """Complete and close the current file"""
+        if self.stream is None:
+            return
+        try:
+            if self.format_type == 'json':
+                self.stream.write('\n]\n')
+            # closes the gzip stream too, which writes its trailer
+            self.stream.close()
+        finally:
+            self.raw.close()
+            self.stream = self.raw = self.csv_writer = None
@@ -0,0 +1,152 @@
+"""Per-stage tracing, exported as Chrome trace event JSON"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from typing import Dict, Any, List, Optional, Tuple
+
+# Events kept at most - a long run keeps its first MAX_EVENTS events and counts the others.
+# They are kept as tuples of about 250 bytes (60MB at most), the event dicts are only built by export()
+MAX_EVENTS = 250_000
+
+
+class _NullSpan:
+    """The span of a disabled tracer - does nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """A timed stage, recorded as a complete ('X') event when it exits"""
+    __slots__ = ('tracer', 'name', 'args', 'lane', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.lane = self.tracer._lane()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._record(('X', self.name, self.start, end - self.start, self.lane, self.args or None))
+        return False
+
+
+class _TracedWait:
+    """Async context manager that traces the time spent entering another one"""
+    __slots__ = ('tracer', 'context', 'name', 'args')
+
+    def __init__(self, tracer: 'Tracer', context, name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.context = context
+        self.name = name
+        self.args = args
+
+    async def __aenter__(self):
+        with self.tracer.span(self.name, **self.args):
+            return await self.context.__aenter__()
+
+    async def __aexit__(self, *exc_info):
+        return await self.context.__aexit__(*exc_info)
+
+
+class Tracer:
+    """Records spans of the analysis stages while enabled, for chrome://tracing or Perfetto.
+    Every asyncio task and every thread gets a lane (tid) of its own, so the spans of a
+    lane nest like a call stack. A disabled tracer hands out a shared no-op span."""
+
+    def __init__(self):
+        self.enabled = False
+        # (phase, name, start, duration, lane, args) - see export()
+        self.events: List[Tuple] = []
+        self.dropped = 0
+        self.start = 0.0
+        self.pid = os.getpid()
+        self.lanes = weakref.WeakKeyDictionary()
+        self._lane_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Start recording, from a clean trace"""
+        self.events = []
+        self.dropped = 0
+        self.lanes = weakref.WeakKeyDictionary()
+        self.start = time.perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording, the recorded events are kept"""
+        self.enabled = False
+
+    def span(self, name: str, **args):
+        """Context manager timing a stage - the part of name before the first '.' is its category"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def wait(self, context, name: str, **args):
+        """Trace the time an async context manager (a semaphore, the rate control...) takes to enter"""
+        if not self.enabled:
+            return context
+        return _TracedWait(self, context, name, args)
+
+    def _lane(self) -> int:
+        """The lane of the current asyncio task, or of the current thread outside of one"""
+        try:
+            owner = asyncio.current_task()
+        except RuntimeError:
+            owner = None
+        if owner is not None:
+            name = owner.get_name()
+        else:
+            owner = threading.current_thread()
+            name = owner.name
+
+        lane = self.lanes.get(owner)
+        if lane is None:
+            with self._lock:
+                lane = self.lanes[owner] = next(self._lane_ids)
+            self._record(('M', 'thread_name', None, None, lane, {'name': name}))
+        return lane
+
+    def _record(self, event: Tuple):
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def export(self, path: str, metadata: Optional[Dict[str, Any]] = None):
+        """Write the recorded events as Chrome trace event JSON"""
+        events = []
+        for phase, name, start, duration, lane, args in self.events:
+            event = {'name': name, 'ph': phase, 'pid': self.pid, 'tid': lane, 'args': args or {}}
+            if phase == 'X':
+                event.update(cat=name.split('.', 1)[0], ts=(start - self.start) * 1e6, dur=duration * 1e6)
+            events.append(event)
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+                'otherData': {**(metadata or {}), 'dropped_events': self.dropped}
+            }, f, default=str)
+
+
+# The process-wide tracer the stages are instrumented with
+tracer = Tracer()
@@ -1,107 +1,357 @@
 """Asynchronous reputation API client"""
 import asyncio
-import aiohttp
+import itertools
 import time
-from typing import List, Dict, Any, Set
-from asyncio_throttle import Throttler
-from reputation.cache import ReputationCache
+from collections import Counter
+from collections.abc import Sized
+from typing import List, Dict, Any, Iterable, Union, Optional, Callable, AsyncIterator
+from monitoring.tracing import tracer
+from reputation.cache import create_cache, NEGATIVE
+from reputation.hedging import create_hedge_policy
+from reputation.rate_control import AdaptiveRateController, backoff_delay, parse_retry_after
+from reputation.transport import ReputationTransport
+
+# How many domains are looked up in the cache at once
+CACHE_BATCH = 256
 
 
 class ReputationClient:
     def __init__(self, config, metrics):
         self.config = config
         self.metrics = metrics
-        self.cache = ReputationCache(ttl=config.data['performance']['cache_ttl'])
-        self.base_url = config.data['api']['base_url']
-        self.auth_token = config.data['api']['auth_token']
+        self.cache = create_cache(config)
+        self.transport = ReputationTransport(config)
         self.timeout = config.data['api']['timeout']
         self.max_retries = config.data['api']['max_retries']
         self.retry_delay = config.data['api']['retry_delay']
 
-        # Rate limiting
+        # Rate limiting - requests_per_second is the ceiling of the adaptive rate
+        rate_control = config.data.get('rate_control', {})
         self.rps = config.data['performance']['requests_per_second']
-        self.throttler = Throttler(rate_limit=self.rps)
+        self.rate_controller = AdaptiveRateController(
+            self.rps,
+            min_rate=rate_control.get('min_rps', 1),
+            initial_rate=rate_control.get('initial_rps', 0),
+            additive_increase=rate_control.get('additive_increase', 5),
+            multiplicative_decrease=rate_control.get('multiplicative_decrease', 0.5),
+            latency_spike_factor=rate_control.get('latency_spike_factor', 3.0))
+        self.max_backoff = rate_control.get('max_backoff', 30)
+        # a second request for the single lookups slower than usual - None when disabled
+        self.hedge_policy = create_hedge_policy(config)
+
+        # Batch mode - 0 looks every domain up on its own
+        self.batch_size = config.data['api'].get('batch_size', 0)
+        self.batch_timeout = config.data['api'].get('batch_timeout', 0.05)
+        # cleared once the server has no batch endpoint
+        self.batch_supported = True
+        self.batch_fallbacks = 0
+        self.batch_failures = 0
+
+        # retried attempts by HTTP status ('timeout'/'error' when there was no response)
+        self.retries = Counter()
+        self.lookup_queue: Optional[asyncio.Queue] = None
         self.max_concurrent = config.data['performance']['max_concurrent_requests']
 
-    async def check_domains(self, domains: Set[str]) -> List[Dict[str, Any]]:
-        """Check reputation for multiple domains"""
-        results = []
+    async def check_domains(self, domains: Union[Iterable[str], asyncio.Queue]) -> List[Dict[str, Any]]:
+        """Check reputation for multiple domains, from an iterable or from a queue (None ends the stream)"""
+        # Process domains with progress tracking - the total is unknown while a PCAP is parsed into a queue
+        from tqdm import tqdm
+        total = len(domains) if isinstance(domains, Sized) else None
+        with tqdm(total=total, desc="Processing domains") as progress:
+            return [result async for result in self.iter_results(domains, progress.update)]
+
+    async def check_domain(self, domain: str, semaphore: asyncio.Semaphore,
+                           use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """Check reputation for a single domain, cache first unless use_cache is False - the transport
+        must be open (`async with client.transport`) and semaphore bounds the concurrent lookups"""
+        return await self._check_single_domain(domain, semaphore, check_cache=use_cache)
+
+    async def iter_results(self, domains: Union[Iterable[str], asyncio.Queue],
+                           progress: Optional[Callable[[int], Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Check reputation for domains from an iterable, or from a queue (None ends the stream),
+        and yield the results as they finish.
+        A feeder serves the cached domains in bulk and hands the others to max_concurrent
+        long-lived lookup workers, through bounded queues - memory is O(concurrency), not O(domains).
+        progress is called with the number of domains done."""
         semaphore = asyncio.Semaphore(self.max_concurrent)
+        work = asyncio.Queue(maxsize=max(self.max_concurrent, self.batch_size))
+        self.lookup_queue = work
+        results = asyncio.Queue(maxsize=self.max_concurrent)
+
+        async def done(result):
+            if progress is not None:
+                progress(1)
+            if result is not None:
+                await results.put(result)
+
+        async def feeder():
+            async for chunk in self._chunks(domains):
+                # only the uncached domains are throttled
+                with tracer.span('cache.get_many', domains=len(chunk)):
+                    cached = await self.cache.get_many(chunk)
+                for domain in chunk:
+                    data = cached.get(domain)
+                    if data is None:
+                        await work.put(domain)
+                    elif data is NEGATIVE:
+                        await done(None)
+                    else:
+                        self.metrics.add_request(0, cached=True)
+                        await done(data)
+            for _ in range(self.max_concurrent):
+                await work.put(None)
+
+        async def lookup_worker():
+            while True:
+                domain = await work.get()
+                if domain is None:
+                    return
+                with tracer.span('lookup', domain=domain):
+                    result = await self._check_single_domain(domain, semaphore, check_cache=False)
+                await done(result)
+
+        async def batch_worker():
+            finished = False
+            while not finished:
+                domain = await work.get()
+                if domain is None:
+                    return
+                # flush the batch once it is full, or batch_timeout after its first domain
+                batch = [domain]
+                deadline = time.monotonic() + self.batch_timeout
+                while len(batch) < self.batch_size:
+                    try:
+                        domain = await asyncio.wait_for(work.get(), deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        break
+                    if domain is None:
+                        finished = True
+                        break
+                    batch.append(domain)
+                with tracer.span('lookup.batch', domains=len(batch)):
+                    batch_results = await self._check_batch(batch, semaphore)
+                for result in batch_results:
+                    await done(result)
+
+        worker = batch_worker if self.batch_size > 1 else lookup_worker
+
+        async def run():
+            async with self.transport:
+                try:
+                    await asyncio.gather(feeder(), *(worker() for _ in range(self.max_concurrent)))
+                except asyncio.CancelledError:
+                    # the consumer is gone, there is nobody to tell
+                    raise
+                except Exception:
+                    await results.put(None)
+                    raise
+            await results.put(None)
+
+        runner = asyncio.create_task(run())
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                yield result
+            # re-raise the error that stopped the workers, if any
+            await runner
+        finally:
+            runner.cancel()
+
+    @staticmethod
+    async def _chunks(domains: Union[Iterable[str], asyncio.Queue]) -> AsyncIterator[List[str]]:
+        """Read the domains in chunks of up to CACHE_BATCH, without waiting for a queue to fill up"""
+        if not isinstance(domains, asyncio.Queue):
+            iterator = iter(domains)
+            while chunk := list(itertools.islice(iterator, CACHE_BATCH)):
+                yield chunk
+            return
+
+        while True:
+            chunk = [await domains.get()]
+            while chunk[-1] is not None and len(chunk) < CACHE_BATCH and not domains.empty():
+                chunk.append(domains.get_nowait())
+            if chunk[-1] is None:
+                if len(chunk) > 1:
+                    yield chunk[:-1]
+                return
+            yield chunk
 
-        async with aiohttp.ClientSession() as session:
-            tasks = []
+    async def _check_batch(self, domains: List[str], semaphore: asyncio.Semaphore) -> List[Optional[Dict[str, Any]]]:
+        """Check reputation for a batch of domains in one request, falling back to a request
+        per domain if the server rejects the batch. A batch still throttled or failing once its
+        retries are over fails as a whole - a request per domain would only add to the load of
+        a struggling server. Cache and metrics are kept per domain."""
+        rejected = not self.batch_supported
+        for attempt in range(self.max_retries if self.batch_supported else 0):
+            delay = backoff_delay(attempt, self.retry_delay, self.max_backoff)
+            try:
+                async with tracer.wait(self.rate_controller, 'rate_control.wait'):
+                    request_time = time.time()
+                    status, data, headers = await self.transport.post_batch(domains)
+                latency = time.time() - request_time
+            except Exception as e:
+                self.rate_controller.on_error()
+                status = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+            else:
+                if status == 200 and isinstance(data, dict):
+                    self.rate_controller.on_success(latency)
+                    return await self._fan_out(domains, data, latency * 1000)
+                elif status == 429:  # Rate limited
+                    retry_after = parse_retry_after(headers.get('Retry-After'))
+                    self.rate_controller.on_throttled(retry_after)
+                    delay = max(delay, retry_after or 0)
+                elif status in (404, 405, 501):  # No batch endpoint
+                    self.batch_supported = False
+                    rejected = True
+                    break
+                elif status < 500:  # The batch was rejected (too large, bad request, unexpected body...)
+                    rejected = True
+                    break
+                else:
+                    self.rate_controller.on_error()
+            if attempt < self.max_retries - 1:
+                self.retries[str(status)] += 1
+                with tracer.span('lookup.backoff', status=str(status)):
+                    await asyncio.sleep(delay)
+
+        if not rejected:
+            # the domains are not retried before negative_ttl
+            self.batch_failures += 1
             for domain in domains:
-                task = self._check_single_domain(session, domain, semaphore)
-                tasks.append(task)
+                self.metrics.add_request(0, success=False)
+                await self.cache.set_negative(domain)
+            return [None] * len(domains)
+
+        self.batch_fallbacks += 1
+        return await asyncio.gather(*(self._check_single_domain(domain, semaphore, check_cache=False)
+                                      for domain in domains))
 
-            # Process domains with progress tracking
-            from tqdm.asyncio import tqdm
-            results = await tqdm.gather(*tasks, desc="Processing domains")
+    async def _fan_out(self, domains: List[str], rankings: Dict[str, Any],
+                       response_time: float) -> List[Optional[Dict[str, Any]]]:
+        """Turn the response to a batch into per-domain results, metrics and cache entries"""
+        results, found = [], {}
+        for domain in domains:
+            data = rankings.get(domain)
+            if data is None:
+                # the server does not know the domain
+                self.metrics.add_request(0, success=False)
+                await self.cache.set_negative(domain)
+                results.append(None)
+            else:
+                found[domain] = self._make_result(domain, data, response_time)
+                self.metrics.add_request(response_time, success=True)
+                results.append(found[domain])
+        await self.cache.set_many(found)
+        return results
 
-        return [r for r in results if r is not None]
+    def _make_result(self, domain: str, data: Dict[str, Any], response_time: float) -> Dict[str, Any]:
+        """Build the result of a domain from its ranking"""
+        return {
+            'domain': domain,
+            'reputation': data.get('reputation', 0),
+            'classification': self._classify_score(data.get('reputation', 0)),
+            'categories': data.get('categories', []),
+            'response_time': response_time,
+            'query_source': 'PCAP'
+        }
 
-    async def _check_single_domain(self, session: aiohttp.ClientSession,
-                                   domain: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    async def _check_single_domain(self, domain: str, semaphore: asyncio.Semaphore,
+                                   check_cache: bool = True) -> Dict[str, Any]:
         """Check reputation for a single domain"""
-        async with semaphore:
-            async with self.throttler:
-                # Check cache first
-                cached = await self.cache.get(domain)
-                # if the domain is cached
-                if cached:
-                    # add the response time for the queried domain to the metrics requests response times array
-                    self.metrics.add_request(cached['response_time'])
-                    return cached
-                # start timer for measuring query for uncached domain
-                start_time = time.time()
-                # manage max attempts for querying a domain
-                for attempt in range(self.max_retries):
-                    try:
-                        # construct the ranking request for the domain
-                        url = f"{self.base_url}/domain/ranking/{domain}"
-                        headers = {'Authorization': f'Token {self.auth_token}'}
-
-                        timeout = aiohttp.ClientTimeout(total=self.timeout)
-                        async with session.get(url, headers=headers, timeout=timeout) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                # calculate response time for queried domain
-                                response_time = (time.time() - start_time) * 1000  # ms
-
-                                result = {
-                                    'domain': domain,
-                                    'reputation': data.get('reputation', 0),
-                                    'classification': self._classify_score(data.get('reputation', 0)),
-                                    'categories': data.get('categories', []),
-                                    'response_time': response_time,
-                                    'query_source': 'PCAP'
-                                }
-
-                                # Cache result
-                                await self.cache.set(domain, result)
-
-                                # Update metrics for successful query
-                                self.metrics.add_request(response_time, success=True)
-
-                                return result
-
-                            elif response.status == 429:  # Rate limited
-                                await asyncio.sleep(self.retry_delay * (attempt + 1))
-                            else:
-                                self.metrics.add_request(0, success=False)
+        async with tracer.wait(semaphore, 'lookup.semaphore_wait'):
+            # Check cache first
+            cached = await self.cache.get(domain) if check_cache else None
+            # the lookup of the domain failed recently - don't retry it yet
+            if cached is NEGATIVE:
+                return None
+            # if the domain is cached
+            if cached:
+                # cache hits are counted apart from the API response times
+                self.metrics.add_request(0, cached=True)
+                return cached
+            # start timer for measuring query for uncached domain
+            start_time = time.time()
+            # manage max attempts for querying a domain
+            for attempt in range(self.max_retries):
+                delay = backoff_delay(attempt, self.retry_delay, self.max_backoff)
+                status = None
+                try:
+                    # every attempt takes a request slot of the adaptive rate
+                    async with tracer.wait(self.rate_controller, 'rate_control.wait'):
+                        request_time = time.time()
+                        status, data, headers = await self._get_ranking(domain)
+                    latency = time.time() - request_time
 
-                    except asyncio.TimeoutError:
-                        # Update metrics for unsuccessful query -  with timeout response time
-                        self.metrics.add_request(self.timeout * 1000, success=False)
+                    if status == 200:
+                        self.rate_controller.on_success(latency)
+                        # calculate response time for queried domain
+                        response_time = (time.time() - start_time) * 1000  # ms
+
+                        result = self._make_result(domain, data, response_time)
+
+                        # Cache result
+                        await self.cache.set(domain, result)
+
+                        # Update metrics for successful query
+                        self.metrics.add_request(response_time, success=True)
 
-                    except Exception as e:
-                        # Update metrics for unsuccessful query - with 0 response time - since we have encountered with an exception
+                        return result
+
+                    elif status == 429:  # Rate limited
+                        retry_after = parse_retry_after(headers.get('Retry-After'))
+                        self.rate_controller.on_throttled(retry_after)
+                        delay = max(delay, retry_after or 0)
+                    elif status == 404:  # Unknown domain, retrying won't help
+                        self.rate_controller.on_success(latency)
+                        self.metrics.add_request(0, success=False)
+                        await self.cache.set_negative(domain)
+                        return None
+                    else:
+                        if status >= 500:
+                            self.rate_controller.on_error()
                         self.metrics.add_request(0, success=False)
-                    # manage max attempts mechanism
-                    if attempt < self.max_retries - 1:
-                        await asyncio.sleep(self.retry_delay * (attempt + 1))
 
-                return None
+                except asyncio.TimeoutError:
+                    status = 'timeout'
+                    self.rate_controller.on_error()
+                    # Update metrics for unsuccessful query -  with timeout response time
+                    self.metrics.add_request(self.timeout * 1000, success=False)
+
+                except Exception as e:
+                    status = 'error'
+                    self.rate_controller.on_error()
+                    # Update metrics for unsuccessful query - with 0 response time - since we have encountered with an exception
+                    self.metrics.add_request(0, success=False)
+                # manage max attempts mechanism
+                if attempt < self.max_retries - 1:
+                    self.retries[str(status)] += 1
+                    with tracer.span('lookup.backoff', status=str(status)):
+                        await asyncio.sleep(delay)
+
+            # all attempts failed
+            await self.cache.set_negative(domain)
+            return None
+
+    async def _get_ranking(self, domain: str):
+        """Request the ranking of a domain - hedged, if enabled (the hedge takes a rate slot of its own)"""
+        if self.hedge_policy is None:
+            return await self.transport.get_ranking(domain)
+        return await self.hedge_policy.run(lambda: self.transport.get_ranking(domain),
+                                           lambda: tracer.wait(self.rate_controller, 'rate_control.wait'))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get lookup statistics"""
+        stats = {
+            'lookup_queue_depth': self.lookup_queue.qsize() if self.lookup_queue is not None else 0,
+            'retries_by_status': dict(self.retries),
+            'batch_fallbacks': self.batch_fallbacks,
+            'batch_failures': self.batch_failures
+        }
+        if self.hedge_policy is not None:
+            stats.update(self.hedge_policy.get_stats())
+        return stats
 
     def _classify_score(self, score: int) -> str:
         """Classify reputation score"""
@@ -1,39 +1,368 @@
 """Caching layer for reputation results"""
+import asyncio
+import json
+import sqlite3
+import sys
 import time
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Iterable, List, Tuple
+
+# Pending writes of the SQLite cache are flushed once there are that many of them...
+FLUSH_ROWS = 256
+# ...and at least that often (seconds)
+FLUSH_INTERVAL = 1.0
+# SQLite limits the number of host parameters of a statement
+SQL_BATCH = 500
+
+# Returned by get() for a domain whose lookup failed recently (negative caching)
+NEGATIVE = object()
+
+
+class CacheEntry:
+    """A cached result - data is None for a negative entry"""
+    __slots__ = ('data', 'expires', 'size')
+
+    def __init__(self, data: Optional[Dict[str, Any]], expires: float, size: int):
+        self.data = data
+        self.expires = expires
+        self.size = size
 
 
 class ReputationCache:
-    def __init__(self, ttl: int = 3600):
-        self.cache = {}
+    def __init__(self, ttl: int = 3600, max_entries: int = 0, max_bytes: int = 0,
+                 negative_ttl: int = 300):
+        # least recently used first - a hit moves the entry to the end
+        self.cache: 'OrderedDict[str, CacheEntry]' = OrderedDict()
         self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # 0 means unbounded
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     async def get(self, domain: str) -> Optional[Dict[str, Any]]:
-        """Get cached result for domain"""
-        # if the domain is indeed cached (we have already queried for it)
-        if domain in self.cache:
-            entry = self.cache[domain]
-            # if the cached entry hasn't passed the age TTL - return this entry
-            if time.time() - entry['timestamp'] < self.ttl:
-                return entry['data']
-            # delete slate entry from cache
-            else:
-                # Expired
-                del self.cache[domain]
-        # returning None in case the domain is not cached
-        return None
+        """Get cached result for domain, NEGATIVE if its lookup failed recently"""
+        data = self._get(domain)
+        self._count(data)
+        return data
+
+    async def get_many(self, domains: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Get the cached results of several domains, uncached domains are left out"""
+        found = {}
+        for domain in domains:
+            data = self._get(domain)
+            self._count(data)
+            if data is not None:
+                found[domain] = data
+        return found
 
     async def set(self, domain: str, data: Dict[str, Any]):
         """Cache result for domain"""
-        self.cache[domain] = {
-            'data': data,
-            'timestamp': time.time()
-        }
+        self._store(domain, data, time.time())
+
+    async def set_many(self, results: Dict[str, Dict[str, Any]]):
+        """Cache the results of several domains"""
+        for domain, data in results.items():
+            await self.set(domain, data)
+
+    async def set_negative(self, domain: str):
+        """Remember for negative_ttl that the lookup of domain failed"""
+        self._store(domain, None, time.time())
+
+    def _get(self, domain: str) -> Optional[Dict[str, Any]]:
+        """Look a domain up without counting hits/misses"""
+        entry = self.cache.get(domain)
+        # the domain is not cached (we haven't queried for it yet)
+        if entry is None:
+            return None
+        # delete stale entry from cache
+        if entry.expires <= time.time():
+            self._remove(domain)
+            self.expirations += 1
+            return None
+        self.cache.move_to_end(domain)
+        return NEGATIVE if entry.data is None else entry.data
+
+    def _store(self, domain: str, data: Optional[Dict[str, Any]], timestamp: float):
+        """Insert an entry cached at timestamp, evicting the least recently used entries over the caps"""
+        expires = timestamp + (self.ttl if data is not None else self.negative_ttl)
+        if expires <= time.time():
+            return
+        if domain in self.cache:
+            self._remove(domain)
+        entry = CacheEntry(data, expires, self._sizeof(domain, data))
+        self.cache[domain] = entry
+        self.bytes += entry.size
+
+        while self.cache and ((self.max_entries and len(self.cache) > self.max_entries) or
+                              (self.max_bytes and self.bytes > self.max_bytes)):
+            self._remove(next(iter(self.cache)))
+            self.evictions += 1
+
+    def _remove(self, domain: str):
+        """Delete an entry"""
+        self.bytes -= self.cache.pop(domain).size
+
+    @staticmethod
+    def _sizeof(domain: str, data: Optional[Dict[str, Any]]) -> int:
+        """Estimate the memory held by an entry, in bytes"""
+        size = sys.getsizeof(domain) + CacheEntry.__basicsize__
+        if data is not None:
+            size += sys.getsizeof(data)
+            for value in data.values():
+                size += sys.getsizeof(value)
+                if isinstance(value, list):
+                    size += sum(sys.getsizeof(item) for item in value)
+        return size
+
+    def _count(self, data):
+        """Count a cache hit or miss"""
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if data is NEGATIVE:
+                self.negative_hits += 1
+
+    def hit_ratio(self) -> float:
+        """Fraction of the lookups answered from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def expire(self) -> int:
+        """Drop the expired entries from memory, returns how many were dropped"""
+        now = time.time()
+        expired = [domain for domain, entry in self.cache.items() if entry.expires <= now]
+        for domain in expired:
+            self._remove(domain)
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def compact(self) -> int:
+        """Drop expired entries, returns how many were dropped"""
+        return self.expire()
+
+    async def sweep(self, interval: float):
+        """Expire entries in the background, so that entries which are never read again are dropped too"""
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+    def close(self):
+        """Release the resources of the cache"""
+        pass
 
     def clear(self):
         """Clear all cached entries"""
         self.cache.clear()
+        self.bytes = 0
 
     def size(self) -> int:
         """Get cache size"""
-        return len(self.cache)
\ No newline at end of file
+        return len(self.cache)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        return {
+            'cache_size': len(self.cache),
+            'cache_bytes': self.bytes,
+            'cache_hits': self.hits,
+            'cache_negative_hits': self.negative_hits,
+            'cache_misses': self.misses,
+            'cache_evictions': self.evictions,
+            'cache_expirations': self.expirations,
+            'cache_hit_ratio': self.hit_ratio()
+        }
+
+
+class SQLiteReputationCache(ReputationCache):
+    """Reputation cache persisted to a SQLite database, so it is kept across runs.
+    The database runs in WAL mode, so several analyzer processes can share it -
+    readers never block, and writers wait for each other up to busy_timeout.
+    Memory holds the recently used entries, within the caps of the base class.
+    The database is only used from a thread of its own: a write waiting for the lock
+    of another process holds up that thread, never the event loop."""
+
+    def __init__(self, path: str, ttl: int = 3600, compaction_interval: int = 600,
+                 busy_timeout: float = 5.0, **limits):
+        super().__init__(ttl, **limits)
+        self.path = path
+        self.compaction_interval = compaction_interval
+        self.pending: List[Tuple[str, str, float]] = []
+        self.last_flush = time.time()
+
+        # runs every statement after the start-up, in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-cache')
+        # autocommit - transactions are opened explicitly for batched writes
+        self.db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode, a commit is durable once the WAL is checkpointed, that's good enough for a cache
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # data is JSON null for a negative entry
+        self.db.execute('CREATE TABLE IF NOT EXISTS reputation ('
+                        'domain TEXT PRIMARY KEY, data TEXT NOT NULL, timestamp REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reputation_timestamp ON reputation (timestamp)')
+        self.last_compaction = time.time()
+        self._delete_expired()
+        self._warm_load()
+
+    def _warm_load(self):
+        """Load the unexpired entries into memory - the newest are kept if they exceed the caps"""
+        rows = self.db.execute('SELECT domain, data, timestamp FROM reputation WHERE timestamp > ? '
+                               'ORDER BY timestamp', (time.time() - self.ttl,))
+        for domain, data, timestamp in rows:
+            self._store(domain, json.loads(data), timestamp)
+        # the warm load is not the workload
+        self.evictions = 0
+
+    async def _run(self, function, *args):
+        """Run a database function in the database thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def get(self, domain: str) -> Optional[Dict[str, Any]]:
+        """Look a domain up in memory, then in the database (another process may have cached it)"""
+        data = super()._get(domain)
+        if data is None:
+            data = (await self._load([domain])).get(domain)
+        self._count(data)
+        return data
+
+    async def get_many(self, domains: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Get the cached results of several domains, uncached domains are left out"""
+        found, missing = {}, []
+        for domain in domains:
+            data = super()._get(domain)
+            if data is not None:
+                found[domain] = data
+            else:
+                missing.append(domain)
+        # the domains that are not in memory are read from the database in a few queries
+        loaded = await self._load(missing) if missing else {}
+        found.update(loaded)
+        for data in found.values():
+            self._count(data)
+        self.misses += len(missing) - len(loaded)
+        return found
+
+    async def _load(self, domains: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Read the unexpired entries of domains from the database into memory"""
+        found = {}
+        now = time.time()
+        for domain, data, timestamp in await self._run(self._select, domains, now):
+            data = json.loads(data)
+            if data is None and timestamp + self.negative_ttl <= now:
+                continue
+            found[domain] = NEGATIVE if data is None else data
+            self._store(domain, data, timestamp)
+        return found
+
+    def _select(self, domains: List[str], now: float) -> List[Tuple[str, str, float]]:
+        """The unexpired rows of domains - in the database thread"""
+        rows = []
+        for i in range(0, len(domains), SQL_BATCH):
+            batch = domains[i:i + SQL_BATCH]
+            rows += self.db.execute(
+                f"SELECT domain, data, timestamp FROM reputation "
+                f"WHERE timestamp > ? AND domain IN ({','.join('?' * len(batch))})",
+                (now - self.ttl, *batch)).fetchall()
+        return rows
+
+    async def set(self, domain: str, data: Dict[str, Any]):
+        """Cache result for domain, the write to the database is batched"""
+        self._write(domain, data, time.time())
+        if len(self.pending) >= FLUSH_ROWS or time.time() - self.last_flush >= FLUSH_INTERVAL:
+            await self.flush()
+
+    async def set_many(self, results: Dict[str, Dict[str, Any]]):
+        """Cache the results of several domains and write them right away"""
+        now = time.time()
+        for domain, data in results.items():
+            self._write(domain, data, now)
+        await self.flush()
+
+    async def set_negative(self, domain: str):
+        """Remember for negative_ttl that the lookup of domain failed, also across runs"""
+        await self.set(domain, None)
+
+    def _write(self, domain: str, data: Optional[Dict[str, Any]], timestamp: float):
+        """Store an entry in memory and queue its write to the database"""
+        self._store(domain, data, timestamp)
+        self.pending.append((domain, json.dumps(data, default=str), timestamp))
+
+    async def flush(self):
+        """Write the pending entries to the database in a single transaction, and compact it
+        once in a compaction_interval"""
+        self.last_flush = time.time()
+        if self.pending:
+            pending, self.pending = self.pending, []
+            await self._run(self._insert, pending)
+        if time.time() - self.last_compaction >= self.compaction_interval:
+            await self.compact()
+
+    def _insert(self, rows: List[Tuple[str, str, float]]):
+        """Write rows in a single transaction - in the database thread"""
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO reputation (domain, data, timestamp) '
+                                'VALUES (?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    async def compact(self) -> int:
+        """Delete the expired rows, returns how many were deleted"""
+        self.last_compaction = time.time()
+        self.expire()
+        return await self._run(self._delete_expired)
+
+    def _delete_expired(self) -> int:
+        now = time.time()
+        return self.db.execute("DELETE FROM reputation WHERE timestamp <= ? "
+                               "OR (data = 'null' AND timestamp <= ?)",
+                               (now - self.ttl, now - self.negative_ttl)).rowcount
+
+    def close(self):
+        """Write the pending entries and close the database - blocks, it runs once the event loop is done"""
+        if self.db is None:
+            return
+        self.executor.submit(self._close).result()
+        self.executor.shutdown()
+
+    def _close(self):
+        try:
+            if self.pending:
+                pending, self.pending = self.pending, []
+                self._insert(pending)
+            # fold the WAL back into the database file, unless another process is still using it
+            self.db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        finally:
+            self.db.close()
+            self.db = None
+
+    def clear(self):
+        """Clear all cached entries"""
+        super().clear()
+        self.pending.clear()
+        self.executor.submit(self.db.execute, 'DELETE FROM reputation').result()
+
+
+def create_cache(config) -> ReputationCache:
+    """Create the cache backend selected in the config"""
+    ttl = config.data['performance']['cache_ttl']
+    cache_config = config.data.get('cache', {})
+    limits = {
+        'max_entries': cache_config.get('max_entries', 0),
+        'max_bytes': cache_config.get('max_bytes', 0),
+        'negative_ttl': cache_config.get('negative_ttl', 300)
+    }
+    if cache_config.get('backend', 'memory') == 'sqlite':
+        return SQLiteReputationCache(cache_config.get('path', 'reputation_cache.db'), ttl,
+                                     cache_config.get('compaction_interval', 600), **limits)
+    return ReputationCache(ttl=ttl, **limits)
@@ -0,0 +1,15 @@
+"""Connection pool of the HTTP transport"""
+import aiohttp
+
+
+class CountingConnector(aiohttp.TCPConnector):
+    """TCPConnector that counts the connections it opens - cheaper than a TraceConfig,
+    which costs every request a trace context"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created = 0
+
+    async def _create_connection(self, *args, **kwargs):
+        self.created += 1
+        return await super()._create_connection(*args, **kwargs)
@@ -0,0 +1,116 @@
+"""Hedged requests - a second request for the lookups slower than usual"""
+import asyncio
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable, TypeVar
+
+from monitoring.histogram import LatencyHistogram
+
+T = TypeVar('T')
+
+# Request latencies recorded before their percentile is trusted as the hedge delay
+WARMUP_SAMPLES = 50
+# The hedge delay is recomputed from the latencies every that many requests
+DELAY_REFRESH = 64
+
+
+class HedgePolicy:
+    """Runs a request and, if it has not answered by the live `percentile` of the request
+    latencies, a second one - the first response wins and the other request is cancelled.
+    At most `budget` (0.05 for 5%) extra requests are sent, and each takes a slot of the
+    rate control like any other request, so hedging stays within the rate limit.
+    The latency the lookups would have had without hedging is tracked too: a first request
+    cancelled after t ms is recorded as t ms, so the unhedged tail is a lower bound."""
+
+    def __init__(self, percentile: float = 95, budget: float = 0.05):
+        self.percentile = percentile
+        self.budget = budget
+        # ms of every request (cancelled ones up to their cancellation) - the hedge delay source
+        self.latency = LatencyHistogram()
+        # ms from the first request to the response, with hedging and without
+        self.hedged = LatencyHistogram()
+        self.unhedged = LatencyHistogram()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._delay: Optional[float] = None
+        self._refresh = 0
+
+    def delay(self) -> Optional[float]:
+        """Seconds after which a request is hedged, None while too few latencies are known"""
+        if self.latency.count < WARMUP_SAMPLES:
+            return None
+        self._refresh -= 1
+        if self._delay is None or self._refresh <= 0:
+            self._delay = self.latency.percentile(self.percentile) / 1000
+            self._refresh = DELAY_REFRESH
+        return self._delay
+
+    async def run(self, request: Callable[[], Awaitable[T]], slot: Callable[[], Any]) -> T:
+        """Await request(), hedged by a second request() sent once `slot` (an async context
+        manager, the rate control) lets it through - returns the first successful response"""
+        self.requests += 1
+        start = time.monotonic()
+        first = asyncio.ensure_future(request())
+        tasks = [first]
+        try:
+            delay = self.delay()
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+            if delay is None or first.done() or self.hedges >= self.budget * self.requests:
+                try:
+                    return await first
+                finally:
+                    elapsed = (time.monotonic() - start) * 1000
+                    for histogram in (self.latency, self.hedged, self.unhedged):
+                        histogram.record(elapsed)
+
+            self.hedges += 1
+            tasks.append(asyncio.ensure_future(self._hedge(request, slot)))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # the first response wins - unless it failed and the other request may still answer
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        self.hedged.record((time.monotonic() - start) * 1000)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            elapsed = (time.monotonic() - start) * 1000
+            if len(tasks) > 1:
+                self.latency.record(elapsed)
+                # a cancelled first request would have taken at least that long
+                self.unhedged.record(elapsed)
+            for task in tasks:
+                task.cancel()
+
+    async def _hedge(self, request: Callable[[], Awaitable[T]], slot: Callable[[], Any]) -> T:
+        async with slot():
+            start = time.monotonic()
+            try:
+                return await request()
+            finally:
+                self.latency.record((time.monotonic() - start) * 1000)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hedging statistics"""
+        return {
+            'hedge_requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedge_rate': self.hedges / self.requests if self.requests else 0,
+            'hedge_delay': (self._delay or 0) * 1000,
+            'hedged_p99': self.hedged.percentile(99),
+            'unhedged_p99': self.unhedged.percentile(99)
+        }
+
+
+def create_hedge_policy(config) -> Optional[HedgePolicy]:
+    """Create the hedge policy of the config, None if hedging is disabled"""
+    hedging = config.data.get('hedging', {})
+    if not hedging.get('enabled', False):
+        return None
+    return HedgePolicy(hedging.get('percentile', 95), hedging.get('budget', 0.05))
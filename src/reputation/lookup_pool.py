@@ -0,0 +1,303 @@
+"""Reputation lookups spread over several worker processes"""
+import asyncio
+import copy
+import multiprocessing
+import signal
+import threading
+import traceback
+from collections import Counter
+from typing import List, Dict, Any, Union, Iterable, Optional, Callable, AsyncIterator, Tuple
+from zlib import crc32
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from reputation.cache import NEGATIVE
+from utils.config import Config
+from utils.event_loop import use_event_loop
+
+# A worker sends its results once it has that many...
+IPC_BATCH = 256
+# ...and at least that often (seconds), along with its metric deltas
+IPC_INTERVAL = 0.1
+# Domain chunks a worker holds before the parent has to wait for it to send more
+WORKER_BACKLOG = 4
+
+# Worker stats that are not summed over the workers - ratios are recomputed from the sums,
+# for latencies the highest of the workers is taken
+RATIO_STATS = ('connection_reuse_ratio', 'hedge_rate')
+MAX_STATS = ('hedge_delay', 'hedged_p99', 'unhedged_p99')
+
+
+class RecordingMetrics(MetricsCollector):
+    """The metrics of a worker process - the requests are also recorded, to be replayed
+    into the parent's MetricsCollector as they are, so its latency histogram and rates
+    are the same as if the lookups had run in the parent"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests: List[Tuple[float, bool]] = []
+
+    def add_request(self, response_time: float, success: bool = True, cached: bool = False):
+        super().add_request(response_time, success, cached)
+        self.requests.append((response_time, success))
+
+    def take(self) -> List[Tuple[float, bool]]:
+        """The requests recorded since the last call"""
+        requests, self.requests = self.requests, []
+        return requests
+
+
+def worker_config(client: ReputationClient, workers: int, index: int) -> Dict[str, Any]:
+    """The config of a lookup worker: its share of the request rate and concurrency, and no
+    cache - the parent answers the cached domains and caches the results"""
+    data = copy.deepcopy(client.config.data)
+    data['api']['batch_size'] = client.batch_size
+    performance = data['performance']
+    performance['requests_per_second'] = client.rps / workers
+    # the concurrency is split with the remainder spread over the first workers, at least 1 each
+    share, remainder = divmod(client.max_concurrent, workers)
+    performance['max_concurrent_requests'] = max(share + (index < remainder), 1)
+    # entries that expire at once are never stored
+    performance['cache_ttl'] = 0
+    rate_control = data.setdefault('rate_control', {})
+    for key in ('min_rps', 'initial_rps', 'additive_increase'):
+        if key in rate_control:
+            rate_control[key] /= workers
+    data['cache'] = {'backend': 'memory', 'negative_ttl': 0}
+    return data
+
+
+def lookup_worker(config_data: Dict[str, Any], domains_conn, results_conn):
+    """Process entry point - look up the domains received in chunks (None ends them) and send
+    back ('batch', results, domains done, requests, stats) messages, then ('end', failed domains, stats)"""
+    # the parent handles Ctrl+C, and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    use_event_loop(config_data['performance'].get('event_loop', 'asyncio'))
+    try:
+        asyncio.run(_serve(Config.from_dict(config_data), domains_conn, results_conn))
+    except Exception:
+        results_conn.send(('error', traceback.format_exc()))
+    finally:
+        results_conn.close()
+
+
+async def _serve(config: Config, domains_conn, results_conn):
+    metrics = RecordingMetrics()
+    client = ReputationClient(config, metrics)
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxsize=WORKER_BACKLOG)
+    domains = asyncio.Queue(maxsize=client.max_concurrent)
+
+    def receive():
+        while True:
+            try:
+                chunk = domains_conn.recv()
+            except EOFError:
+                chunk = None
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+            if chunk is None:
+                return
+
+    # the domains received and not answered yet - those left at the end failed
+    pending = set()
+
+    async def unpack():
+        while (chunk := await chunks.get()) is not None:
+            pending.update(chunk)
+            for domain in chunk:
+                await domains.put(domain)
+        await domains.put(None)
+
+    results = []
+    done = 0
+
+    def stats() -> Dict[str, Any]:
+        return {**client.rate_controller.get_stats(), **client.transport.get_stats(), **client.get_stats()}
+
+    def send():
+        nonlocal results, done
+        results_conn.send(('batch', results, done, metrics.take(), stats()))
+        results, done = [], 0
+
+    def progress(count: int):
+        nonlocal done
+        done += count
+
+    async def flusher():
+        while True:
+            await asyncio.sleep(IPC_INTERVAL)
+            if done or metrics.requests:
+                send()
+
+    threading.Thread(target=receive, name='lookup-receiver', daemon=True).start()
+    unpacker = asyncio.create_task(unpack())
+    flush_task = asyncio.create_task(flusher())
+    try:
+        async for result in client.iter_results(domains, progress):
+            pending.discard(result['domain'])
+            results.append(result)
+            if len(results) >= IPC_BATCH:
+                send()
+        await unpacker
+    finally:
+        flush_task.cancel()
+        unpacker.cancel()
+    send()
+    results_conn.send(('end', list(pending), stats()))
+
+
+class LookupPool:
+    """Runs the lookups of ReputationClient.iter_results in `workers` processes, each with its
+    own event loop, connection pool and 1/workers of the request rate - so that the parsing of
+    the responses is spread over several cores while requests_per_second still holds.
+    Domains are sharded by hash, the same domain always goes to the same worker. The parent
+    keeps the cache and the output: cached domains are answered without the workers, and the
+    results, the requests and the stats of the workers are merged back into its metrics."""
+
+    def __init__(self, client: ReputationClient, workers: int):
+        self.client = client
+        self.metrics = client.metrics
+        self.cache = client.cache
+        self.workers = workers
+        # the latest stats of every worker
+        self.worker_stats: List[Dict[str, Any]] = [{} for _ in range(workers)]
+        self.processes = []
+        self.senders = []
+        self.receivers = []
+
+    def start(self) -> 'LookupPool':
+        """Start the worker processes - they take a while to import, better early (e.g. before extraction)"""
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.workers):
+            domains_recv, domains_send = context.Pipe(duplex=False)
+            results_recv, results_send = context.Pipe(duplex=False)
+            process = context.Process(target=lookup_worker, name=f"lookup-worker-{index}", daemon=True,
+                                      args=(worker_config(self.client, self.workers, index),
+                                            domains_recv, results_send))
+            process.start()
+            domains_recv.close()
+            results_send.close()
+            self.processes.append(process)
+            self.senders.append(domains_send)
+            self.receivers.append(results_recv)
+        return self
+
+    def close(self):
+        """Stop the worker processes - the lookups in flight are lost"""
+        for sender in self.senders:
+            sender.close()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes, self.senders, self.receivers = [], [], []
+
+    async def iter_results(self, domains: Union[Iterable[str], asyncio.Queue],
+                           progress: Optional[Callable[[int], Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Check reputation for domains from an iterable, or from a queue (None ends the stream),
+        and yield the results as they finish - like ReputationClient.iter_results"""
+        loop = asyncio.get_running_loop()
+        # (kind, worker, payload) messages of the workers, and the cached results - the workers
+        # send at most every IPC_INTERVAL and the feeder waits for them, it stays short
+        output = asyncio.Queue()
+        if not self.processes:
+            self.start()
+        senders = self.senders
+
+        def receive(index: int, conn):
+            while True:
+                try:
+                    kind, *payload = conn.recv()
+                except (EOFError, OSError):
+                    kind, payload = 'error', ['the lookup worker exited']
+                try:
+                    loop.call_soon_threadsafe(output.put_nowait, (kind, index, payload))
+                except RuntimeError:
+                    # the run is over
+                    return
+                if kind != 'batch':
+                    return
+
+        for index, conn in enumerate(self.receivers):
+            threading.Thread(target=receive, args=(index, conn), name=f"lookup-results-{index}",
+                             daemon=True).start()
+
+        async def feeder():
+            try:
+                async for chunk in ReputationClient._chunks(domains):
+                    cached = await self.cache.get_many(chunk)
+                    shards = [[] for _ in senders]
+                    for domain in chunk:
+                        data = cached.get(domain)
+                        if data is None:
+                            shards[crc32(domain.encode()) % self.workers].append(domain)
+                        elif data is NEGATIVE:
+                            await output.put(('cached', None, None))
+                        else:
+                            self.metrics.add_request(0, cached=True)
+                            await output.put(('cached', None, data))
+                    for sender, shard in zip(senders, shards):
+                        if shard:
+                            # blocks while the worker is busy - parsing cannot race ahead of the lookups
+                            await loop.run_in_executor(None, sender.send, shard)
+                for sender in senders:
+                    await loop.run_in_executor(None, sender.send, None)
+            except Exception as e:
+                await output.put(('failed', None, e))
+                raise
+
+        feed = asyncio.create_task(feeder())
+        running = self.workers
+        try:
+            while running:
+                kind, index, payload = await output.get()
+                if kind == 'cached':
+                    if progress is not None:
+                        progress(1)
+                    if payload is not None:
+                        yield payload
+                elif kind == 'batch':
+                    results, done, requests, stats = payload
+                    for response_time, success in requests:
+                        self.metrics.add_request(response_time, success)
+                    self.worker_stats[index] = stats
+                    await self.cache.set_many({result['domain']: result for result in results})
+                    for result in results:
+                        yield result
+                    if progress is not None and done:
+                        progress(done)
+                elif kind == 'end':
+                    failed, self.worker_stats[index] = payload
+                    for domain in failed:
+                        await self.cache.set_negative(domain)
+                    running -= 1
+                elif kind == 'failed':
+                    raise payload
+                else:
+                    raise RuntimeError(f"lookup worker {index} failed: {payload[0]}")
+            await feed
+        finally:
+            feed.cancel()
+            # the workers end once they are done, or are stopped (on timeout)
+            self.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """The lookup stats (rate control, connections, retries...) summed over the workers"""
+        stats = {'lookup_workers': self.workers}
+        for worker in self.worker_stats:
+            for key, value in worker.items():
+                if key in RATIO_STATS:
+                    continue
+                if key in MAX_STATS:
+                    stats[key] = max(stats.get(key, 0), value)
+                elif isinstance(value, dict):
+                    stats[key] = dict(Counter(stats.get(key, {})) + Counter(value))
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        if 'http_requests' in stats:
+            requests = stats['http_requests']
+            stats['connection_reuse_ratio'] = stats['connections_reused'] / requests if requests else 0
+        if 'hedge_requests' in stats:
+            requests = stats['hedge_requests']
+            stats['hedge_rate'] = stats['hedges'] / requests if requests else 0
+        return stats
@@ -0,0 +1,128 @@
+"""Adaptive rate control for the reputation API"""
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional
+
+# Latency samples before the latency baseline is trusted to detect spikes
+WARMUP_SAMPLES = 20
+# Weight of a new latency sample in the recent and in the baseline averages
+RECENT_ALPHA = 0.2
+BASELINE_ALPHA = 0.02
+# Shortest time between two rate cuts (seconds) - the responses to the requests that
+# were in flight when the API got congested should not cut the rate again
+MIN_COOLDOWN = 0.5
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delay in seconds or HTTP date), None if missing/invalid"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class AdaptiveRateController:
+    """AIMD rate limiter, used as `async with controller:` around every request.
+    The rate grows additively (additive_increase requests/sec per second) while responses
+    are healthy, and is cut multiplicatively on 429s, 5xx, timeouts and latency spikes,
+    between min_rate and max_rate. Requests are paced evenly at the current rate."""
+
+    def __init__(self, max_rate: float, min_rate: float = 1, initial_rate: float = 0,
+                 additive_increase: float = 5, multiplicative_decrease: float = 0.5,
+                 latency_spike_factor: float = 3.0):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        # 0 means start at the ceiling
+        self.rate = min(initial_rate or max_rate, max_rate)
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.latency_spike_factor = latency_spike_factor
+
+        self.next_slot = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.recent_latency = 0
+        self.baseline_latency = 0
+        self.samples = 0
+        self.decreases = 0
+        self.throttled = 0
+
+    async def __aenter__(self):
+        """Wait for the next request slot at the current rate, and for the end of a Retry-After pause"""
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # a 429 may have paused the requests while waiting for the slot
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def on_success(self, latency: float):
+        """A healthy response took latency seconds - grow the rate, unless the latency spiked"""
+        self.samples += 1
+        if self.samples == 1:
+            self.recent_latency = self.baseline_latency = latency
+        else:
+            self.recent_latency += RECENT_ALPHA * (latency - self.recent_latency)
+            self.baseline_latency += BASELINE_ALPHA * (latency - self.baseline_latency)
+
+        if (self.samples > WARMUP_SAMPLES and
+                self.recent_latency > self.latency_spike_factor * self.baseline_latency):
+            self._decrease()
+        else:
+            # +additive_increase per second at the current rate of responses
+            self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+
+    def on_error(self):
+        """A 5xx response or a timeout - the API is degraded"""
+        self._decrease()
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        """A 429 response - cut the rate, and pause all requests for retry_after seconds"""
+        self.throttled += 1
+        self._decrease()
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def _decrease(self):
+        """Cut the rate multiplicatively, at most once per cooldown"""
+        now = time.monotonic()
+        if now - self.last_decrease < max(self.recent_latency, MIN_COOLDOWN):
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.multiplicative_decrease)
+        self.decreases += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get rate control statistics"""
+        return {
+            'rate_limit': self.rate,
+            'rate_ceiling': self.max_rate,
+            'rate_decreases': self.decreases,
+            'throttled_requests': self.throttled
+        }
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Jittered exponential backoff - half of the delay is fixed, half is random,
+    so that retries spread out instead of arriving in waves"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
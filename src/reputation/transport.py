@@ -0,0 +1,151 @@
+"""HTTP transport for the reputation API"""
+import json
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple
+
+from monitoring.tracing import tracer
+
+if TYPE_CHECKING:
+    import aiohttp
+    from reputation.connector import CountingConnector
+
+# orjson decodes several times faster than the json module, it is used when installed
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(data) -> bytes:
+        return json.dumps(data).encode()
+
+# Size of the reads of a response body with a size limit
+READ_CHUNK = 64 * 1024
+
+
+class ResponseTooLarge(Exception):
+    """The response body exceeded max_body_size"""
+
+
+class ReputationTransport:
+    """Owns the HTTP connection pool to the reputation API.
+    The pool is sized after max_concurrent_requests and keeps the connections alive
+    between requests, the per-request objects (headers, timeout) are built once.
+    It is opened by the first request, aiohttp is only imported then - a run answered
+    from the cache never pays for it."""
+
+    def __init__(self, config):
+        api = config.data['api']
+        performance = config.data['performance']
+        self.ranking_url = f"{api['base_url']}/domain/ranking/"
+        self.batch_url = f"{api['base_url']}{api.get('batch_path', '/domain/ranking/batch')}"
+        self.headers = {'Authorization': f"Token {api['auth_token']}"}
+        self.batch_headers = {'Content-Type': 'application/json'}
+        self.timeout = api['timeout']
+        self.max_concurrent = performance['max_concurrent_requests']
+        # 0 means a connection per lookup worker
+        self.connections_per_host = api.get('connections_per_host', 0) or self.max_concurrent
+        self.keepalive_timeout = api.get('keepalive_timeout', 30)
+        self.dns_cache_ttl = api.get('dns_cache_ttl', 300)
+        # 0 means unlimited
+        self.max_body_size = api.get('max_body_size', 1024 * 1024)
+
+        self.session: Optional['aiohttp.ClientSession'] = None
+        self.connector: Optional['CountingConnector'] = None
+        self.users = 0
+        self.requests = 0
+        self.in_flight = 0
+        # of the connection pools that were closed already
+        self.closed_connections = 0
+
+    async def __aenter__(self):
+        """Use the connection pool - it is opened by the first request"""
+        self.users += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the connection pool once its last user is done"""
+        self.users -= 1
+        if self.users == 0:
+            await self.close()
+
+    def _open(self) -> 'aiohttp.ClientSession':
+        """Open the connection pool"""
+        import aiohttp
+        from reputation.connector import CountingConnector
+
+        self.connector = CountingConnector(limit=self.max_concurrent,
+                                           limit_per_host=self.connections_per_host,
+                                           keepalive_timeout=self.keepalive_timeout,
+                                           ttl_dns_cache=self.dns_cache_ttl,
+                                           use_dns_cache=True)
+        self.session = aiohttp.ClientSession(connector=self.connector, headers=self.headers,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def close(self):
+        """Close the connection pool"""
+        if self.session is not None:
+            session, self.session = self.session, None
+            self.closed_connections += self.connector.created
+            await session.close()
+
+    async def get_ranking(self, domain: str) -> Tuple[int, Optional[Any], Dict[str, str]]:
+        """Request the ranking of a domain, returns (status, decoded JSON body or None, headers)"""
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            with tracer.span('http.request', domain=domain):
+                async with (self.session or self._open()).get(self.ranking_url + domain) as response:
+                    # the body is always read, so that the connection can be reused
+                    body = await self._read(response)
+        finally:
+            self.in_flight -= 1
+        with tracer.span('json.decode'):
+            data = _loads(body) if response.status == 200 else None
+        return response.status, data, response.headers
+
+    async def post_batch(self, domains: List[str]) -> Tuple[int, Optional[Any], Dict[str, str]]:
+        """Request the rankings of several domains at once, returns
+        (status, decoded JSON body or None, headers) - the body maps each domain to its ranking"""
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            with tracer.span('http.batch', domains=len(domains)):
+                async with (self.session or self._open()).post(self.batch_url, data=_dumps({'domains': domains}),
+                                                               headers=self.batch_headers) as response:
+                    body = await self._read(response)
+        finally:
+            self.in_flight -= 1
+        with tracer.span('json.decode'):
+            data = _loads(body) if response.status == 200 else None
+        return response.status, data, response.headers
+
+    async def _read(self, response: 'aiohttp.ClientResponse') -> bytes:
+        """Read a response body, within max_body_size"""
+        if not self.max_body_size:
+            return await response.read()
+        if response.content_length is not None:
+            if response.content_length > self.max_body_size:
+                raise ResponseTooLarge(f"{response.content_length} bytes body")
+            return await response.read()
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(READ_CHUNK):
+            body += chunk
+            if len(body) > self.max_body_size:
+                raise ResponseTooLarge(f"body over {self.max_body_size} bytes")
+        return bytes(body)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get connection reuse statistics"""
+        created = self.closed_connections + (self.connector.created if self.session is not None else 0)
+        # every request that did not open a connection reused a pooled one
+        reused = max(self.requests - created, 0)
+        return {
+            'http_requests': self.requests,
+            'in_flight_requests': self.in_flight,
+            'connections_created': created,
+            'connections_reused': reused,
+            'connection_reuse_ratio': reused / self.requests if self.requests else 0
+        }
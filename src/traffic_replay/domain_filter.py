@@ -0,0 +1,188 @@
+"""Filtering of the extracted domain names - reserved names and allow/deny lists"""
+import mmap
+import os
+from array import array
+from collections import Counter
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+from zlib import adler32, crc32
+
+# Special-use names that are never looked up (RFC 6761/6762, reverse lookups),
+# matched on whole labels: 'local' filters printer.local, not foo.localhost.example.com
+RESERVED_SUFFIXES = frozenset([b'localhost', b'localdomain', b'local', b'invalid', b'in-addr.arpa'])
+# Labels of the longest reserved suffix - without lists, no more of a name is looked at
+RESERVED_DEPTH = max(suffix.count(b'.') + 1 for suffix in RESERVED_SUFFIXES)
+
+# Compiled domain lists: magic, slot count, entry count, then the slots (native byte order)
+SUFFIX_TABLE_MAGIC = b'DNSSUFX1'
+HEADER_SIZE = 24
+# Compiled tables are at most half full, so that probe sequences stay short
+MAX_LOAD_FACTOR = 0.5
+# Extension of the compiled table cached next to a text list
+COMPILED_SUFFIX = '.idx'
+
+
+def suffix_hash(suffix: str) -> int:
+    """Stable 64-bit hash of a domain suffix, crc32 in the low bits (the slot index) - 0 marks
+    the empty slots of a table. A cryptographic hash would cost more than the rest of the match."""
+    data = suffix.encode()
+    return (adler32(data) << 32 | crc32(data)) or 1
+
+
+def read_domain_list(path: str) -> Iterator[str]:
+    """The domains of a text list: one per line, '#' comments, an optional '*.' or '.' prefix
+    (every entry matches its subdomains anyway) - hosts files work too, the last field is taken"""
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+            domain = line[-1].lower().rstrip('.')
+            if domain.startswith('*.'):
+                domain = domain[2:]
+            domain = domain.lstrip('.')
+            if domain:
+                yield domain
+
+
+def compile_suffix_table(domains: Iterable[str]) -> bytes:
+    """Build the binary form of a domain list - an open addressing hash table of the hashes of its domains"""
+    hashes = {suffix_hash(domain) for domain in domains}
+    size = 8
+    while size * MAX_LOAD_FACTOR < len(hashes):
+        size *= 2
+    mask = size - 1
+    slots = array('Q', bytes(8 * size))
+    for value in hashes:
+        i = value & mask
+        while slots[i]:
+            i = (i + 1) & mask
+        slots[i] = value
+    header = SUFFIX_TABLE_MAGIC + size.to_bytes(8, 'little') + len(hashes).to_bytes(8, 'little')
+    return header + slots.tobytes()
+
+
+class SuffixTable:
+    """A compiled domain list, matched by the suffixes of a name - one probe per label.
+    Compiled files are mmapped, so that the processes of a run share a single copy of
+    a list of millions of domains, and opening one costs no parsing at all."""
+
+    def __init__(self, data, path: Optional[str] = None, mapping: Optional[mmap.mmap] = None):
+        if bytes(data[:8]) != SUFFIX_TABLE_MAGIC:
+            raise ValueError(f"not a compiled domain list: {path}")
+        self.path = path
+        self._mapping = mapping
+        self.size = int.from_bytes(data[8:16], 'little')
+        self.entries = int.from_bytes(data[16:24], 'little')
+        self._mask = self.size - 1
+        self._slots = memoryview(data)[HEADER_SIZE:HEADER_SIZE + 8 * self.size].cast('Q')
+
+    @classmethod
+    def open(cls, path: str) -> 'SuffixTable':
+        """Open a domain list - compiled, or text (compiled once into a cached .idx file next to it)"""
+        with open(path, 'rb') as f:
+            compiled = f.read(len(SUFFIX_TABLE_MAGIC)) == SUFFIX_TABLE_MAGIC
+        if not compiled:
+            index = path + COMPILED_SUFFIX
+            if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(path):
+                data = compile_suffix_table(read_domain_list(path))
+                try:
+                    tmp = f"{index}.tmp"
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp, index)
+                except OSError:
+                    # a read-only location - the list is kept in memory
+                    return cls(data, path)
+            path = index
+
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping, path, mapping)
+
+    def __contains__(self, suffix: str) -> bool:
+        return self.contains_hash(suffix_hash(suffix))
+
+    def contains_hash(self, value: int) -> bool:
+        """Whether the list has the domain of that suffix_hash()"""
+        slots, mask = self._slots, self._mask
+        i = value & mask
+        while True:
+            slot = slots[i]
+            if slot == value:
+                return True
+            if not slot:
+                return False
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.entries
+
+
+class DomainFilter:
+    """Decides which extracted names are looked up. A name is filtered out as 'invalid' (empty,
+    a single label), 'reserved' (a special-use suffix), 'denylist' (already blocked) or
+    'allowlist' (known good) - a list entry matches the domain and all its subdomains.
+    Every name is matched in O(labels), and the filtered names are counted by reason."""
+
+    def __init__(self, allow_lists: Optional[List[str]] = None, deny_lists: Optional[List[str]] = None):
+        self.allow_lists = list(allow_lists or [])
+        self.deny_lists = list(deny_lists or [])
+        # deny first: a domain on both lists is reported as blocked
+        self.tables = [(SuffixTable.open(path), 'denylist') for path in self.deny_lists] + \
+                      [(SuffixTable.open(path), 'allowlist') for path in self.allow_lists]
+        # what the probes of match() need, without attribute lookups
+        self._probes = [(table._slots, table._mask, reason) for table, reason in self.tables]
+        self.filtered = Counter()
+
+    def match(self, domain: str) -> Optional[str]:
+        """The reason the name is filtered out, None if it is to be looked up"""
+        name = domain.lower().encode()
+        dot = name.rfind(b'.')
+        # a single label (or an empty name) is no domain
+        if dot <= 0 or dot == len(name) - 1:
+            return 'invalid'
+        probes = self._probes
+        labels = 1
+        # the suffixes of the name from its last label on, one hash for all the lists -
+        # SuffixTable.contains_hash() inlined, this runs for every extracted name
+        while True:
+            suffix = name[dot + 1:]
+            if labels <= RESERVED_DEPTH and suffix in RESERVED_SUFFIXES:
+                return 'reserved'
+            if probes:
+                value = (adler32(suffix) << 32 | crc32(suffix)) or 1
+                for slots, mask, reason in probes:
+                    i = value & mask
+                    while True:
+                        slot = slots[i]
+                        if slot == value:
+                            return reason
+                        if not slot:
+                            break
+                        i = (i + 1) & mask
+            elif labels >= RESERVED_DEPTH:
+                return None
+            if dot < 0:
+                return None
+            dot = name.rfind(b'.', 0, dot)
+            labels += 1
+
+    def accept(self, domain: str) -> bool:
+        """Whether the name is to be looked up - the names filtered out are counted"""
+        reason = self.match(domain)
+        if reason is None:
+            return True
+        self.filtered[reason] += 1
+        return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get filtering statistics"""
+        return {
+            'filtered_by_reason': dict(self.filtered)
+        }
+
+
+def create_filter(config) -> DomainFilter:
+    """Create the domain filter of the lists in the config"""
+    filter_config = config.data.get('filter', {})
+    return DomainFilter(filter_config.get('allow_lists') or [], filter_config.get('deny_lists') or [])
@@ -0,0 +1,577 @@
+"""Fast DNS name extraction straight from the wire format of capture files
+
+The capture is mmapped and walked with struct/memoryview - pcap record headers,
+Ethernet/VLAN/IPv4/IPv6/UDP headers and the DNS message itself - without building
+any scapy layer objects. Frames the fast path cannot fully validate are handed
+to scapy, so the extracted names are exactly those of the scapy dissection.
+"""
+import mmap
+import struct
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple, Union
+
+# pcap magic -> (endianness, timestamp fraction scale)
+PCAP_MAGICS = {
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+PCAPNG_BYTE_ORDER = {b'\x1a\x2b\x3c\x4d': '>', b'\x4d\x3c\x2b\x1a': '<'}
+
+LINKTYPE_ETHERNET = 1
+# scapy truncates every record to its MTU
+MTU = 65535
+# A shard resyncs on the first offset of its byte range that many records in a row parse
+# from (fewer when they run into the end of the capture)
+RESYNC_RECORDS = 8
+# pcap records a shard resyncs on are at most that many seconds apart from the first record
+RESYNC_TIME_SPAN = 366 * 86400
+# Largest pcap record a shard resyncs on
+RESYNC_MAX_CAPLEN = 262144
+PCAPNG_HEADER_BLOCKS = (0x0A0D0D0A, 1)
+
+ETH_IPV4 = 0x0800
+ETH_IPV6 = 0x86dd
+ETH_ARP = 0x0806
+ETH_VLAN = (0x8100, 0x88a8)
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+DNS_PORTS = (53, 5353)
+
+# resource record types whose rdata scapy decodes as a (compressible) name
+RR_NAME_TYPES = (2, 3, 4, 5, 12)
+RR_A, RR_AAAA, RR_SOA, RR_MX, RR_TXT, RR_OPT = 1, 28, 6, 15, 16, 41
+# EDNS0 client subnet options are decoded by scapy into a dedicated layer
+EDNS0_CLIENT_SUBNET = 8
+# longest chain of compression pointers followed before giving up
+MAX_POINTER_HOPS = 64
+
+_H = struct.Struct('!H')
+_DNS_HEADER = struct.Struct('!4H')
+_RR_HEADER = struct.Struct('!HHIH')
+
+
+class Unparseable(Exception):
+    """Raised for frames the fast path cannot decode - they go to scapy instead"""
+
+
+class _ScapyBindings:
+    """The layer bindings of the loaded scapy layers, used to know which frames may hold DNS"""
+
+    def __init__(self):
+        from scapy.layers.dns import DNSRR_DISPATCHER
+        from scapy.layers.inet import IP, TCP, UDP
+        from scapy.layers.inet6 import IPv6, ipv6nhcls
+        from scapy.layers.l2 import Ether
+
+        self.ether_types = self._bound_values(Ether, 'type')
+        self.ip_protos = self._bound_values(IP, 'proto')
+        self.ipv6_headers = self._bound_values(IPv6, 'nh') | set(ipv6nhcls)
+        udp_ports = self._bound_values(UDP, 'sport') | self._bound_values(UDP, 'dport')
+        self.udp_other_ports = udp_ports - set(DNS_PORTS)
+        self.tcp_ports = self._bound_values(TCP, 'sport') | self._bound_values(TCP, 'dport')
+        self.rr_classes = set(DNSRR_DISPATCHER)
+
+    @staticmethod
+    def _bound_values(layer, field: str) -> set:
+        """Values of a field for which scapy dissects a payload layer"""
+        return {fields[field] for fields, _ in layer.payload_guess if field in fields}
+
+
+class FastDNSParser:
+    def __init__(self):
+        self.bindings = _ScapyBindings()
+        self.records = 0
+        self.fallbacks = 0
+        self.position = 0
+        # offset of the first record of the last walk, and CaptureReader.state() where it stopped
+        self.start = None
+        self.state = None
+        # capture time of the last frame read (None for pcapng simple packet blocks)
+        self.timestamp = None
+        # whether the last decoded DNS message was a response
+        self.response = False
+
+    def iter_dns(self, pcap_file: Union[str, int], state: Optional[dict] = None, stop: Optional[int] = None,
+                 wire_format: bool = True, complete_only: bool = False) -> Iterator[Tuple[Optional[List[str]], object]]:
+        """Yield (names, None) for every DNS frame decoded on the fast path and
+        (None, packet) with a scapy packet for every frame it had to fall back on.
+        A plan_shards() state and stop offset restrict the walk to a byte range;
+        with wire_format=False every frame is dissected by scapy. Once the walk is
+        over, self.start is where its records began and self.state where it stopped -
+        see CaptureReader for complete_only."""
+        with open_capture(pcap_file) as buf:
+            reader = CaptureReader(buf, complete_only)
+            if state is not None:
+                reader.restore(state)
+                if state.get('resync') and not reader.resync(stop):
+                    reader.catch_up(reader.offset)
+            self.start = reader.offset
+            while True:
+                for linktype, timestamp, start, end in reader.records(stop):
+                    self.records += 1
+                    self.position = end
+                    self.timestamp = timestamp
+                    if wire_format:
+                        try:
+                            names = self.parse_frame(buf, linktype, start, end)
+                        except Unparseable:
+                            self.fallbacks += 1
+                        else:
+                            if names is not None:
+                                yield names, None
+                            continue
+                    packet = self._scapy_packet(linktype, bytes(buf[start:end]))
+                    if timestamp is not None:
+                        packet.time = timestamp
+                    yield None, packet
+                if not reader.stale:
+                    break
+                # a resynced pcapng walk met an interface described before its range
+                reader.catch_up(reader.offset)
+            self.position = len(buf) if stop is None else reader.offset
+            self.state = reader.state()
+
+    def parse_frame(self, buf, linktype: int, start: int, end: int) -> Optional[List[str]]:
+        """Return the DNS names of a frame (None when it holds no DNS message)"""
+        if linktype != LINKTYPE_ETHERNET or end - start < 14:
+            raise Unparseable()
+
+        # Ethernet and any stacked 802.1Q/802.1ad tags
+        ether_type = _H.unpack_from(buf, start + 12)[0]
+        offset = start + 14
+        while ether_type in ETH_VLAN:
+            if offset + 4 > end:
+                raise Unparseable()
+            ether_type = _H.unpack_from(buf, offset + 2)[0]
+            offset += 4
+
+        if ether_type == ETH_IPV4:
+            return self._parse_ipv4(buf, offset, end)
+        if ether_type == ETH_IPV6:
+            return self._parse_ipv6(buf, offset, end)
+        if ether_type == ETH_ARP or (ether_type > 1500 and ether_type not in self.bindings.ether_types):
+            return None
+        raise Unparseable()
+
+    def _parse_ipv4(self, buf, offset: int, end: int) -> Optional[List[str]]:
+        if offset + 20 > end or buf[offset] & 0x0f != 5:  # options are left to scapy
+            raise Unparseable()
+        total_length, _, flags_fragment, _, proto = struct.unpack_from('!HHHBB', buf, offset + 2)
+        if total_length < 20:
+            raise Unparseable()
+        payload_end = min(end, offset + total_length)
+        fragment_offset = flags_fragment & 0x1fff
+
+        if proto in (IP_PROTO_UDP, IP_PROTO_TCP):
+            if fragment_offset:
+                return None
+            if flags_fragment & 0x2000:  # first fragment of a fragmented datagram
+                raise Unparseable()
+            return self._parse_transport(buf, proto, offset + 20, payload_end)
+        if proto in self.bindings.ip_protos:
+            raise Unparseable()
+        return None
+
+    def _parse_ipv6(self, buf, offset: int, end: int) -> Optional[List[str]]:
+        if offset + 40 > end:
+            raise Unparseable()
+        payload_length = _H.unpack_from(buf, offset + 4)[0]
+        next_header = buf[offset + 6]
+        if payload_length == 0:
+            raise Unparseable()
+        payload_end = min(end, offset + 40 + payload_length)
+
+        if next_header in (IP_PROTO_UDP, IP_PROTO_TCP):
+            return self._parse_transport(buf, next_header, offset + 40, payload_end)
+        # extension headers and tunnels are left to scapy
+        if next_header in self.bindings.ipv6_headers:
+            raise Unparseable()
+        return None
+
+    def _parse_transport(self, buf, proto: int, offset: int, end: int) -> Optional[List[str]]:
+        if proto == IP_PROTO_TCP:
+            if offset + 20 > end:
+                raise Unparseable()
+            sport, dport = struct.unpack_from('!HH', buf, offset)
+            if sport in self.bindings.tcp_ports or dport in self.bindings.tcp_ports:
+                raise Unparseable()
+            return None
+
+        if offset + 8 > end:
+            raise Unparseable()
+        sport, dport, length = struct.unpack_from('!HHH', buf, offset)
+        if sport in self.bindings.udp_other_ports or dport in self.bindings.udp_other_ports:
+            raise Unparseable()
+        if sport not in DNS_PORTS and dport not in DNS_PORTS:
+            return None
+        if length < 8:
+            raise Unparseable()
+        dns_end = min(end, offset + length)
+        if dns_end <= offset + 8:
+            return None
+        return self.parse_dns(buf, offset + 8, dns_end)
+
+    def parse_dns(self, buf, start: int, end: int) -> List[str]:
+        """Return the question names of a query or the answer names of a response"""
+        if end - start < 12:
+            raise Unparseable()
+        qr = buf[start + 2] >> 7
+        self.response = qr == 1
+        qdcount, ancount, nscount, arcount = _DNS_HEADER.unpack_from(buf, start + 4)
+        offset = start + 12
+
+        names = []
+        for _ in range(qdcount):
+            labels, offset = _read_name(buf, start, offset, end, end)
+            offset += 4
+            if offset > end:
+                raise Unparseable()
+            if qr == 0:
+                names.append(_decode_name(labels))
+
+        # every record is validated since scapy drops the whole DNS layer on a malformed one
+        for section, count in enumerate((ancount, nscount, arcount)):
+            for _ in range(count):
+                labels, offset = _read_name(buf, start, offset, end, end)
+                if offset + 10 > end:
+                    raise Unparseable()
+                rr_type, _, _, rdlen = _RR_HEADER.unpack_from(buf, offset)
+                offset += 10
+                rdata_end = offset + rdlen
+                if rdata_end > end:
+                    raise Unparseable()
+                self._check_rdata(buf, start, rr_type, offset, rdata_end, end)
+                offset = rdata_end
+                if qr == 1 and section == 0:
+                    names.append(_decode_name(labels))
+        return names
+
+    def _check_rdata(self, buf, start: int, rr_type: int, offset: int, rdata_end: int, end: int):
+        """Make sure scapy decodes the rdata of a record without errors"""
+        if rr_type == RR_A:
+            valid = rdata_end - offset == 4
+        elif rr_type == RR_AAAA:
+            valid = rdata_end - offset == 16
+        elif rr_type in RR_NAME_TYPES:
+            valid = _read_name(buf, start, offset, rdata_end, end)[1] == rdata_end
+        elif rr_type == RR_SOA:
+            _, offset = _read_name(buf, start, offset, rdata_end, end)
+            _, offset = _read_name(buf, start, offset, rdata_end, end)
+            valid = rdata_end - offset == 20
+        elif rr_type == RR_MX:
+            valid = offset + 2 < rdata_end and \
+                _read_name(buf, start, offset + 2, rdata_end, end)[1] == rdata_end
+        elif rr_type == RR_OPT:
+            while offset + 4 <= rdata_end:
+                code, length = struct.unpack_from('!HH', buf, offset)
+                if code == EDNS0_CLIENT_SUBNET:
+                    raise Unparseable()
+                offset += 4 + length
+            valid = offset == rdata_end
+        else:
+            valid = rr_type == RR_TXT or rr_type not in self.bindings.rr_classes
+        if not valid:
+            raise Unparseable()
+
+    @staticmethod
+    def _scapy_packet(linktype: int, frame: bytes):
+        """Dissect a frame with scapy the way its PcapReader does"""
+        from scapy.config import conf
+        try:
+            return conf.l2types.num2layer[linktype](frame)
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            return conf.raw_layer(frame)
+
+
+def _read_name(buf, start: int, offset: int, limit: int, end: int) -> Tuple[list, int]:
+    """Read a (possibly compressed) name of the DNS message at start.
+    Returns its labels and the offset right after it. Labels before the first
+    compression pointer must not cross limit; pointed-to labels must not cross end."""
+    labels = []
+    after_pointer = None
+    hops = 0
+    while True:
+        if offset >= limit:
+            raise Unparseable()
+        length = buf[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length >= 0xc0:
+            if offset + 1 >= limit:
+                raise Unparseable()
+            target = ((length & 0x3f) << 8) | buf[offset + 1]
+            if after_pointer is None:
+                after_pointer = offset + 2
+            hops += 1
+            # pointers into the header or looping pointers are left to scapy
+            if target < 12 or hops > MAX_POINTER_HOPS:
+                raise Unparseable()
+            offset = start + target
+            limit = end
+            continue
+        if length > 63:
+            raise Unparseable()
+        offset += 1
+        if offset + length > limit:
+            raise Unparseable()
+        labels.append(buf[offset:offset + length])
+        offset += length
+    return labels, after_pointer if after_pointer is not None else offset
+
+
+def _decode_name(labels: list) -> str:
+    """Decode labels to the domain string the scapy path produces"""
+    try:
+        return b'.'.join(labels).decode('utf-8').rstrip('.')
+    except UnicodeDecodeError:
+        raise Unparseable()
+
+
+class CaptureReader:
+    """Walks the records of a pcap or pcapng buffer. The walk can be suspended at
+    any record boundary with state() and resumed elsewhere with restore() - or be
+    restored at any byte offset and resync() to the next record boundary itself.
+    With complete_only, the walk stops before a record that is cut short instead of
+    yielding what there is of it - the rest may still be written to a growing capture."""
+
+    def __init__(self, buf, complete_only: bool = False):
+        self.buf = buf
+        self.complete_only = complete_only
+        magic = bytes(buf[:4])
+        if magic in PCAP_MAGICS:
+            if len(buf) < 24:
+                raise ValueError("Invalid pcap file (too short)")
+            self.pcapng = False
+            self.endian, self.scale = PCAP_MAGICS[magic]
+            self.linktype = struct.unpack_from(self.endian + 'I', buf, 20)[0]
+            self.offset = 24
+        elif magic == PCAPNG_MAGIC:
+            self.pcapng = True
+            self.endian = '<'  # set by the section header block
+            self.offset = 0
+        else:
+            raise ValueError("Not a supported capture file")
+        # (linktype, snaplen, tsresol) as listed by pcapng interface description blocks
+        self.interfaces = []
+        # the state() of the capture header, when the walk was restored after it
+        self.header = None
+        # set when a resynced pcapng walk stopped at an interface it does not know of
+        self.stale = False
+
+    def state(self) -> dict:
+        """Where the walk currently is - enough to resume it from another reader"""
+        return {'offset': self.offset, 'endian': self.endian, 'interfaces': list(self.interfaces)}
+
+    def restore(self, state: dict):
+        """Resume the walk from a state() of a reader over the same capture - or from
+        a plan_shards() one, which has to resync() first when it says so. With the
+        'header' state of the capture, the walk can catch_up() on what it missed."""
+        self.offset = state['offset']
+        self.endian = state['endian']
+        self.interfaces = list(state['interfaces'])
+        self.header = state.get('header')
+
+    def read_header(self):
+        """Move past the pcapng section header and interface description blocks before the
+        first packet (the pcap header is read by the constructor)"""
+        while self.pcapng and self.offset + 8 <= len(self.buf):
+            block_type = struct.unpack_from(self.endian + 'I', self.buf, self.offset)[0]
+            if block_type not in PCAPNG_HEADER_BLOCKS:
+                break
+            offset = self.offset
+            for _ in self._pcapng_records(offset + 1):
+                pass
+            if self.offset == offset:
+                break
+
+    def resync(self, stop: Optional[int] = None) -> bool:
+        """Move to the first record boundary at or after the current offset and before
+        stop. Returns False when there is none the walk can be sure of."""
+        size = len(self.buf)
+        stop = size if stop is None else min(stop, size)
+        if self.pcapng:
+            # blocks are 32-bit aligned from the start of the capture
+            offsets, valid = range(self.offset + (-self.offset % 4), stop, 4), self._pcapng_chain
+        else:
+            offsets, valid = range(self.offset, stop), self._pcap_chain
+        for offset in offsets:
+            if valid(offset):
+                self.offset = offset
+                return True
+        return False
+
+    def catch_up(self, offset: int):
+        """Walk the records from the capture header to the first record boundary at or
+        after offset - for when resync() could not tell where the records are"""
+        self.restore(self.header)
+        for _ in self.records(offset):
+            pass
+        self.stale = False
+
+    def _pcap_chain(self, offset: int) -> bool:
+        """Whether RESYNC_RECORDS plausible pcap records follow each other from offset"""
+        buf, size = self.buf, len(self.buf)
+        header = struct.Struct(self.endian + 'IIII')
+        # the first record of the capture dates the others, the header caps their length
+        first_sec = header.unpack_from(buf, 24)[0] if size >= 40 else 0
+        max_caplen = max(struct.unpack_from(self.endian + 'I', buf, 16)[0], RESYNC_MAX_CAPLEN)
+        max_fraction = round(1 / self.scale)
+        for checked in range(RESYNC_RECORDS):
+            if offset + 16 > size:
+                return checked > 0
+            sec, fraction, caplen, wirelen = header.unpack_from(buf, offset)
+            if abs(sec - first_sec) > RESYNC_TIME_SPAN or fraction >= max_fraction or \
+                    not 0 < caplen <= max_caplen or wirelen < caplen:
+                return False
+            offset += 16 + caplen
+        return True
+
+    def _pcapng_chain(self, offset: int) -> bool:
+        """Whether RESYNC_RECORDS pcapng blocks with matching length trailers follow each other from offset"""
+        buf, size, endian = self.buf, len(self.buf), self.endian
+        for checked in range(RESYNC_RECORDS):
+            if offset + 12 > size:
+                return checked > 0
+            if bytes(buf[offset:offset + 4]) == PCAPNG_MAGIC:
+                # a new section, possibly in another byte order
+                return bytes(buf[offset + 8:offset + 12]) in PCAPNG_BYTE_ORDER
+            block_length = struct.unpack_from(endian + 'I', buf, offset + 4)[0]
+            tail = offset + block_length - 4 + (-block_length % 4)
+            if block_length < 12 or tail + 4 > size or \
+                    struct.unpack_from(endian + 'I', buf, tail)[0] != block_length:
+                return False
+            offset = tail + 4
+        return True
+
+    def records(self, stop: Optional[int] = None) -> Iterator[Tuple[int, Optional[float], int, int]]:
+        """Yield (linktype, timestamp, start, end) for every record starting before stop"""
+        if self.pcapng:
+            return self._pcapng_records(stop)
+        return self._pcap_records(stop)
+
+    def _pcap_records(self, stop: Optional[int]):
+        buf, size = self.buf, len(self.buf)
+        stop = size if stop is None else stop
+        header = struct.Struct(self.endian + 'IIII')
+        linktype, scale = self.linktype, self.scale
+
+        offset = self.offset
+        while offset + 16 <= size and offset < stop:
+            sec, fraction, caplen, _ = header.unpack_from(buf, offset)
+            start = offset + 16
+            if self.complete_only and start + caplen > size:
+                return
+            offset = self.offset = start + caplen
+            yield linktype, sec + fraction * scale, start, min(offset, size, start + MTU)
+
+    def _pcapng_records(self, stop: Optional[int]):
+        buf, size = self.buf, len(self.buf)
+        stop = size if stop is None else stop
+
+        while self.offset + 12 <= size and self.offset < stop:
+            offset = self.offset
+            if bytes(buf[offset:offset + 4]) == PCAPNG_MAGIC:
+                # section header block - sets the byte order of the blocks that follow
+                self.endian = PCAPNG_BYTE_ORDER.get(bytes(buf[offset + 8:offset + 12]))
+                if self.endian is None:
+                    return
+            endian = self.endian
+            block_type, block_length = struct.unpack_from(endian + 'II', buf, offset)
+            minimum = 16 if block_type == 0x0A0D0D0A else 12
+            tail = offset + block_length - 4 + (-block_length % 4)
+            if block_length < minimum or tail + 4 > size or \
+                    struct.unpack_from(endian + 'I', buf, tail)[0] != block_length:
+                return
+            body, body_end = offset + 8, offset + block_length - 4
+            self.offset = tail + 4
+
+            if block_type == 1:  # interface description block
+                if body_end - body < 8:
+                    return
+                linktype, snaplen = struct.unpack_from(endian + 'HxxI', buf, body)
+                self.interfaces.append((linktype, snaplen, _pcapng_tsresol(buf, endian, body + 8, body_end - 4)))
+            elif block_type in (2, 6):  # (obsolete) packet block / enhanced packet block
+                if body_end - body < 20:
+                    return
+                if block_type == 6:
+                    interface, ts_high, ts_low, caplen = struct.unpack_from(endian + '4I', buf, body)
+                else:
+                    interface, _, ts_high, ts_low, caplen = struct.unpack_from(endian + 'HH3I', buf, body)
+                if interface >= len(self.interfaces):
+                    if self.header is not None:
+                        self.offset, self.stale = offset, True
+                    return
+                linktype, _, tsresol = self.interfaces[interface]
+                start = body + 20
+                yield linktype, ((ts_high << 32) + ts_low) / tsresol, start, min(start + caplen, body_end, start + MTU)
+            elif block_type == 3:  # simple packet block
+                if body_end - body < 4 or not self.interfaces:
+                    return
+                wirelen = struct.unpack_from(endian + 'I', buf, body)[0]
+                linktype, snaplen, _ = self.interfaces[0]
+                start = body + 4
+                yield linktype, None, start, min(start + min(wirelen, snaplen), body_end, start + MTU)
+            elif block_type == 10:  # decryption secrets block - a malformed one ends the capture
+                if body_end - body < 8:
+                    return
+                secrets_length = struct.unpack_from(endian + 'I', buf, body + 4)[0]
+                if body_end - body - 8 < secrets_length + (-secrets_length % 4):
+                    return
+
+
+def plan_shards(buf, count: int) -> List[Tuple[dict, Optional[int]]]:
+    """Split a capture into count byte ranges - only its header is read, the walk of every
+    range but the first resyncs to the records itself. A record belongs to the range it starts in.
+    Record-like bytes in a payload can fool a resync: where the records of a range begin has to
+    match where the walk of the range before stopped (see PCAPManager._extract_parallel).
+    Returns (reader state at the range start, range stop offset) pairs."""
+    reader = CaptureReader(buf)
+    reader.read_header()
+    header = reader.state()
+    step = (len(buf) - header['offset']) // count
+    shards = []
+    for index in range(count):
+        start = header['offset'] + index * step
+        stop = start + step if index < count - 1 else None
+        state = header if index == 0 else dict(header, offset=start, resync=True, header=header)
+        shards.append((state, stop))
+    return shards
+
+
+@contextmanager
+def open_capture(pcap_file: Union[str, int]):
+    """mmap a capture file (a path, or a file descriptor that is left open) and provide it as a memoryview"""
+    with open(pcap_file, 'rb', closefd=not isinstance(pcap_file, int)) as f:
+        if f.seek(0, 2) == 0:
+            raise ValueError("No data could be read!")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    try:
+        yield buf
+    finally:
+        buf.release()
+        mm.close()
+
+
+def _pcapng_tsresol(buf, endian: str, offset: int, end: int) -> int:
+    """Read the if_tsresol option of an interface description block"""
+    tsresol = 1000000
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, offset)
+        if code == 0:
+            break
+        if code == 9 and length == 1 and offset + 4 < end:
+            value = buf[offset + 4]
+            tsresol = (2 if value & 128 else 10) ** (value & 127)
+        # like scapy, stop at a comment that is not newline terminated
+        if code == 1 and length >= 1 and offset + 4 + length < end and \
+                b'\n' not in bytes(buf[offset + 4:offset + 4 + length]):
+            break
+        offset += 4 + length + (-length % 4)
+    return tsresol
@@ -1,96 +1,749 @@
 """PCAP file manager for DNS traffic extraction"""
-from typing import Set
-from scapy.all import rdpcap, DNS
+import asyncio
+import gzip
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Iterator, List, Optional, Tuple, Dict, Any, Union
 import time
+from datetime import datetime, timezone
+
+from monitoring.metrics import MetricsCollector
+from monitoring.tracing import tracer
+from traffic_replay.domain_filter import DomainFilter
+from traffic_replay.fast_parser import FastDNSParser, open_capture, plan_shards
+
+# scapy and tqdm are imported where they are used - scapy takes a while to load its layers,
+# and extraction workers and runs with the fast parser may not need it at all
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
+# How many packets to process between two updates of the progress bar
+PROGRESS_INTERVAL = 1000
+# Captures are split in several shards per worker to balance the load
+SHARDS_PER_WORKER = 4
+# Smallest byte range worth a shard of its own
+MIN_SHARD_BYTES = 4 * 1024 * 1024
+# How often (seconds) a parsing thread blocked on a full lookup queue checks for cancellation
+PUBLISH_POLL_INTERVAL = 0.2
+# Pipelined mode: new domains are handed to the event loop that many at once...
+PUBLISH_BATCH = 256
+# ...or at least that often (seconds), so that lookups start early on slow captures
+PUBLISH_INTERVAL = 0.05
+# Replay mode: (timestamp, domain) pairs handed to the event loop at once
+REPLAY_BATCH = 256
+
+# Follow mode: a capture shorter than this has no complete file header yet
+MIN_CAPTURE_BYTES = 24
+
+PCAP_MAGICS = (b'\xa1\xb2\xc3\xd4', b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\x3c\x4d', b'\x4d\x3c\xb2\xa1',
+               b'\x0a\x0d\x0d\x0a')
+GZIP_MAGIC = b'\x1f\x8b'
+
+# How the extracted domains can be ordered for lookup - see order_domains()
+LOOKUP_ORDERS = ('count', 'queries', 'first_seen', 'capture')
+
+
+class DomainInfo:
+    """How often a domain was seen in the DNS traffic (as a question or an answer), and when"""
+    __slots__ = ('count', 'responses', 'first_seen', 'last_seen')
+
+    def __init__(self, timestamp: Optional[float] = None, response: bool = False):
+        self.count = 1
+        self.responses = int(response)
+        self.first_seen = self.last_seen = timestamp
+
+    @property
+    def queries(self) -> int:
+        return self.count - self.responses
+
+    def seen(self, timestamp: Optional[float], response: bool):
+        """Count another sighting"""
+        self.count += 1
+        self.responses += response
+        if timestamp is not None:
+            if self.first_seen is None or timestamp < self.first_seen:
+                self.first_seen = timestamp
+            if self.last_seen is None or timestamp > self.last_seen:
+                self.last_seen = timestamp
+
+    def merge(self, other: 'DomainInfo'):
+        """Add the sightings of a partial result (another shard)"""
+        self.count += other.count
+        self.responses += other.responses
+        for timestamp in (other.first_seen, other.last_seen):
+            if timestamp is not None:
+                self.first_seen = timestamp if self.first_seen is None else min(self.first_seen, timestamp)
+                self.last_seen = timestamp if self.last_seen is None else max(self.last_seen, timestamp)
+
+    def __eq__(self, other):
+        if not isinstance(other, DomainInfo):
+            return NotImplemented
+        return (self.count, self.responses, self.first_seen, self.last_seen) == \
+            (other.count, other.responses, other.first_seen, other.last_seen)
+
+    def __repr__(self):
+        return (f"DomainInfo(count={self.count}, responses={self.responses}, "
+                f"first_seen={self.first_seen}, last_seen={self.last_seen})")
+
+    def as_row(self) -> Dict[str, Any]:
+        """The output columns of the domain"""
+        return {
+            'query_count': self.count,
+            'first_seen': _isoformat(self.first_seen),
+            'last_seen': _isoformat(self.last_seen)
+        }
+
+
+def _isoformat(timestamp: Optional[float]) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else ''
+
+
+def order_domains(domains: Dict[str, DomainInfo], order: str = 'count') -> List[str]:
+    """The domains in lookup order, so that a run cut short by a timeout has covered the most
+    traffic: 'count' - the most seen first, 'queries' - the domains clients asked for before
+    those only seen in answers, then by count, 'first_seen' - by capture time, 'capture' - as extracted"""
+    if order == 'count':
+        return sorted(domains, key=lambda domain: -domains[domain].count)
+    if order == 'queries':
+        return sorted(domains, key=lambda domain: (domains[domain].queries == 0, -domains[domain].count))
+    if order == 'first_seen':
+        return sorted(domains, key=lambda domain: (domains[domain].first_seen is None,
+                                                   domains[domain].first_seen or 0))
+    if order == 'capture':
+        return list(domains)
+    raise ValueError(f"unknown lookup order: {order}")
+
+
+# The domain filter of an extraction worker process, opened by init_worker()
+_worker_filter: Optional[DomainFilter] = None
+
+
+def init_worker(allow_lists: List[str], deny_lists: List[str]):
+    """Process pool initializer - open the domain lists once per worker process, not per shard"""
+    global _worker_filter
+    _worker_filter = DomainFilter(allow_lists, deny_lists)
+
+
+def extract_shard(pcap_file: str, parser: str, state: Optional[dict] = None,
+                  stop: Optional[int] = None) -> Dict[str, Any]:
+    """Process pool entry point - extract the domains of a capture file, or of a
+    plan_shards() byte range of it, into a partial result. For a byte range, the result
+    also has the offset its records began at and the reader state its walk stopped at."""
+    domain_filter = _worker_filter or DomainFilter()
+    # the names filtered out are counted per shard
+    domain_filter.filtered = Counter()
+    manager = PCAPManager(MetricsCollector(), parser, domain_filter=domain_filter)
+    domains = {}
+    if state is None:
+        manager._extract_into(manager._iter_dns(pcap_file, None), domains)
+    else:
+        manager._extract_into(manager._iter_fast(pcap_file, None, state, stop, wire_format=parser == 'fast'),
+                              domains)
+
+    return {
+        'domains': domains,
+        'packets_sent': manager.packets_sent,
+        'errors': manager.errors,
+        'fallbacks': manager.fallbacks,
+        'queries': manager.metrics.queries_count,
+        'filtered': manager.domain_filter.filtered,
+        'start': manager._walk_start,
+        'end': manager._walk_end
+    }
+
+
+class RecentDomains:
+    """The domains seen within the last ttl seconds, at most max_entries of them (0 for no
+    limit) - the oldest are forgotten first, so memory stays flat however long it runs"""
+
+    def __init__(self, ttl: float, max_entries: int = 0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expires = OrderedDict()
+
+    def add(self, domain: str, now: Optional[float] = None) -> bool:
+        """Record a sighting of a domain, True if it was not seen within the ttl"""
+        now = time.monotonic() if now is None else now
+        expires = self.expires.get(domain)
+        if expires is not None and expires > now:
+            return False
+        self.expires[domain] = now + self.ttl
+        self.expires.move_to_end(domain)
+        # every entry has the same ttl, the oldest is the first to expire
+        while self.expires:
+            oldest, expires = next(iter(self.expires.items()))
+            if expires > now and not (self.max_entries and len(self.expires) > self.max_entries):
+                break
+            del self.expires[oldest]
+        return True
+
+    def __len__(self):
+        return len(self.expires)
 
 
 class PCAPManager:
-    def __init__(self, metrics):
+    def __init__(self, metrics, parser: str = 'scapy', workers: int = 1,
+                 domain_filter: Optional[DomainFilter] = None):
         self.metrics = metrics
+        self.parser = parser
+        self.workers = workers
+        # reserved names only, without allow/deny lists
+        self.domain_filter = domain_filter or DomainFilter()
         self.packets_sent = 0
         self.errors = 0
+        self.fallbacks = 0
         self.start_time = None
+        self.end_time = None
+        self.bytes_read = 0
+        self.bytes_total = 0
+        self._position = 0
+        # capture time and direction of the last frame read by the fast parser
+        self._timestamp = None
+        self._response = False
+        # where the records of the last fast parser walk began, and its state where it stopped
+        self._walk_start = None
+        self._walk_end = None
+        # shards extracted again after a resync on record-like payload bytes
+        self.reextracted = 0
+        # the domains of the current (or last) extraction, as they are found
+        self.domains: Dict[str, DomainInfo] = {}
+        # pipelined mode: the queue new domains are published to, as soon as they are extracted
+        self._queue = None
+        self._loop = None
+        self._aborted = threading.Event()
+        # the new domains not handed to the event loop yet, and the hand-off in progress
+        self._pending: List[Any] = []
+        self._handoff = None
+        self._handed_off = 0.0
 
-    async def extract_domains(self, pcap_file: str) -> Set[str]:
-        """Extract unique domains from PCAP file"""
-        domains = set()
+    async def extract_domains(self, pcap_file: str, queue: Optional[asyncio.Queue] = None) -> Dict[str, DomainInfo]:
+        """Extract the unique domains of a PCAP file or a directory of captures, with how often
+        and when each one was seen. With a queue, every new domain is also put into it as soon
+        as it is extracted, followed by None once the extraction is over."""
         self.start_time = time.time()
+        self.domains = {}
+        self.end_time = None
+        captures = self._capture_files(pcap_file)
+        self.bytes_total = sum(os.path.getsize(capture) for capture in captures)
+        self.bytes_read = 0
+        loop = asyncio.get_running_loop()
+        self._queue, self._loop = queue, loop
+        self._aborted.clear()
+        self._pending, self._handoff = [], None
 
+        from tqdm import tqdm
         try:
-            # Read PCAP file
-            packets = rdpcap(pcap_file)
-            # for each recorded packet in PCAP file
-            for packet in packets:
-                try:
-                    # Check if packet has DNS layer
-                    if packet.haslayer(DNS):
-                        # extract DNS information
-                        dns = packet[DNS]
-
-                        # Extract queries
-                        if dns.qr == 0:  # DNS query
-                            for i in range(dns.qdcount):
-                                # if the DNS query has a question section, and a name to query
-                                if dns.qd and dns.qd[i].qname:
-                                    # extract queried domain name
-                                    domain = dns.qd[i].qname.decode('utf-8').rstrip('.')
-                                    # check validity of extracted domain name
-                                    if self._is_valid_domain(domain):
-                                        domains.add(domain)
-                                        self.metrics.add_query()
-
-                        # Extract responses
-                        elif dns.qr == 1:  # DNS response
-                            if dns.an: # the answer section is not empty
-                                for i in range(dns.ancount):
-                                    if hasattr(dns.an[i], 'rrname'):
-                                        # extract rrname (domain name)
-                                        domain = dns.an[i].rrname.decode('utf-8').rstrip('.')
-                                        # check validity of extracted domain name
-                                        if self._is_valid_domain(domain):
-                                            domains.add(domain)
-                                            self.metrics.add_query()
-
-                        self.packets_sent += 1
-
-                except Exception as e:
-                    self.errors += 1
-                    continue
-
-            # Calculate QPS
-            elapsed = time.time() - self.start_time
-            if elapsed > 0:
-                qps = len(domains) / elapsed
-                self.metrics.current_qps = qps
+            with tracer.span('pcap.extract', captures=len(captures), bytes=self.bytes_total), \
+                    tqdm(total=self.bytes_total, unit='B', unit_scale=True, desc="Reading PCAP") as progress:
+                if self.workers > 1:
+                    domains = await self._extract_parallel(captures, progress)
+                else:
+                    # parsing runs off the event loop, so the live monitoring keeps updating
+                    domains = await loop.run_in_executor(None, self._extract_files, captures, progress)
 
+        except asyncio.CancelledError:
+            # stop the parsing thread, which may also be waiting on the queue
+            self._aborted.set()
+            raise
         except Exception as e:
             print(f"Error reading PCAP file: {e}")
             raise
+        finally:
+            self.end_time = time.time()
+            if queue is not None and not self._aborted.is_set():
+                await queue.put(None)
 
         return domains
 
-    def _is_valid_domain(self, domain: str) -> bool:
-        """Validate domain name"""
-        if not domain or domain == '.':
-            return False
+    async def stream_queries(self, pcap_file: str, queue: asyncio.Queue):
+        """Replay mode - put the DNS packets of a PCAP file or a directory of captures into
+        the queue in capture order, as lists of up to REPLAY_BATCH (capture timestamp, domain)
+        pairs, followed by None. Unlike extract_domains, repeated domains are all kept.
+        The queue is bounded, so reading stays a few batches ahead of the replay."""
+        self.start_time = time.time()
+        self.end_time = None
+        captures = self._capture_files(pcap_file)
+        self.bytes_total = sum(os.path.getsize(capture) for capture in captures)
+        self.bytes_read = 0
+        loop = asyncio.get_running_loop()
+        self._queue, self._loop = queue, loop
+        self._aborted.clear()
+        self._pending, self._handoff = [], None
 
-        # Filter out common invalid domains
-        invalid_patterns = ['localhost', 'localdomain', '.local', '.invalid', 'in-addr.arpa']
-        for pattern in invalid_patterns:
-            if pattern in domain.lower():
-                return False
+        from tqdm import tqdm
+        try:
+            with tqdm(total=self.bytes_total, unit='B', unit_scale=True, desc="Reading PCAP") as progress:
+                await loop.run_in_executor(None, self._stream_files, captures, progress)
+        except asyncio.CancelledError:
+            self._aborted.set()
+            raise
+        finally:
+            self.end_time = time.time()
+            if not self._aborted.is_set():
+                await queue.put(None)
 
-        # Basic domain validation
-        parts = domain.split('.')
-        if len(parts) < 2:
-            return False
+    async def follow(self, pcap_file: str, queue: asyncio.Queue, ttl: float, max_entries: int = 0,
+                     poll_interval: float = 1.0):
+        """Follow mode - tail a growing capture, or the captures of a directory as they are
+        rotated in, and put every domain not seen within the last ttl seconds into the queue.
+        Runs until cancelled. Files are tracked by inode and kept open, so a capture renamed
+        by the rotation is read on from where it was - a followed file renamed away, or deleted,
+        is read to its end before it is forgotten."""
+        self.start_time = time.time()
+        self.end_time = None
+        loop = asyncio.get_running_loop()
+        self._queue, self._loop = queue, loop
+        self._aborted.clear()
+        self._pending, self._handoff = [], None
+        # (device, inode) -> {'fd': open file descriptor, 'size': bytes seen,
+        #                     'state': CaptureReader.state() to resume from, 'done': gzip read}
+        files = {}
+        recent = RecentDomains(ttl, max_entries)
 
-        return True
+        try:
+            while True:
+                with tracer.span('pcap.follow_poll'):
+                    await loop.run_in_executor(None, self._follow_poll, pcap_file, files, recent)
+                await asyncio.sleep(poll_interval)
+        except asyncio.CancelledError:
+            self._aborted.set()
+            raise
+        finally:
+            self.end_time = time.time()
+            for followed in files.values():
+                os.close(followed['fd'])
+
+    def _follow_poll(self, pcap_file: str, files: Dict[tuple, dict], recent: RecentDomains):
+        """Read what was added to the followed captures since the previous poll"""
+        seen = set()
+        for capture in self._capture_files(pcap_file):
+            try:
+                stat = os.stat(capture)
+                key = (stat.st_dev, stat.st_ino)
+                if key not in files:
+                    fd = os.open(capture, os.O_RDONLY)
+                    stat = os.fstat(fd)
+                    key = (stat.st_dev, stat.st_ino)
+                    if key in files:
+                        os.close(fd)
+                    else:
+                        files[key] = {'fd': fd, 'size': 0, 'state': None, 'done': False}
+            except FileNotFoundError:
+                continue
+            seen.add(key)
+            self._read_followed(files[key], recent)
+
+        # the files renamed away or deleted are read to their end, then forgotten
+        for key in files.keys() - seen:
+            followed = files.pop(key)
+            try:
+                self._read_followed(followed, recent, final=True)
+            finally:
+                os.close(followed['fd'])
+        self._flush(wait=True)
+
+    def _read_followed(self, followed: dict, recent: RecentDomains, final: bool = False):
+        """Read what was added to a followed capture, through its open file descriptor.
+        final reads a gzipped capture even if its size has not settled."""
+        fd = followed['fd']
+        size = os.fstat(fd).st_size
+        if os.pread(fd, 2, 0) == GZIP_MAGIC:
+            # a gzipped capture cannot be tailed - it is read once, when its size has settled
+            if not followed['done'] and (size == followed['size'] or final):
+                followed['done'] = True
+                # _iter_packets() closes the file it reads - a duplicate, sharing the file offset
+                os.lseek(fd, 0, os.SEEK_SET)
+                self._extract_recent(self._iter_packets(os.dup(fd), None), recent)
+            followed['size'] = size
+            return
+
+        if size < followed['size']:
+            # truncated and written anew
+            followed.update(size=0, state=None)
+        if size == followed['size'] or size < MIN_CAPTURE_BYTES:
+            return
+        followed['size'] = size
+        self._extract_recent(self._iter_growing(fd, followed), recent)
+
+    def _iter_growing(self, fd: int, followed: dict) -> Iterator[Tuple[Optional[List[str]], object]]:
+        """The complete records of a capture past where the previous poll stopped"""
+        parser = FastDNSParser()
+        start = followed['state']['offset'] if followed['state'] else 0
+        try:
+            yield from parser.iter_dns(fd, followed['state'], wire_format=self.parser == 'fast',
+                                       complete_only=True)
+        except ValueError:
+            # the file header is not complete yet
+            return
+        finally:
+            if parser.state is not None:
+                followed['state'] = parser.state
+                self.bytes_read += parser.state['offset'] - start
+            self.fallbacks += parser.fallbacks
+
+    def _extract_recent(self, items: Iterator[Tuple[Optional[List[str]], object]], recent: RecentDomains):
+        """Publish the domains of the packets/decoded frames that were not seen recently"""
+        for names, packet in items:
+            if self._aborted.is_set():
+                raise asyncio.CancelledError()
+            try:
+                if packet is not None:
+                    names = self._packet_names(packet)
+                    if names is None:
+                        continue
+            except Exception:
+                self.errors += 1
+                continue
+            self.packets_sent += 1
+            for domain in names:
+                if self.domain_filter.accept(domain):
+                    self.metrics.add_query()
+                    if recent.add(domain):
+                        self._publish(domain)
+
+    def _stream_files(self, captures: List[str], progress: 'tqdm'):
+        """Publish the timestamped domains of the capture files in batches"""
+        batch = []
+        timestamp = 0.0
+        for capture in captures:
+            with tracer.span('pcap.parse', capture=capture, parser=self.parser):
+                for names, packet in self._iter_dns(capture, progress):
+                    if self._aborted.is_set():
+                        raise asyncio.CancelledError()
+                    try:
+                        if packet is not None:
+                            names = self._packet_names(packet)
+                            if names is None:
+                                continue
+                            timestamp = float(packet.time)
+                        # pcapng simple packet blocks have no timestamp, they keep the previous one
+                        elif self._timestamp is not None:
+                            timestamp = self._timestamp
+                    except Exception:
+                        self.errors += 1
+                        continue
+
+                    self.packets_sent += 1
+                    for domain in names:
+                        if self.domain_filter.accept(domain):
+                            self.metrics.add_query()
+                            batch.append((timestamp, domain))
+                    if len(batch) >= REPLAY_BATCH:
+                        self._hand_off([batch])
+                        batch = []
+        if batch:
+            self._hand_off([batch])
+        self._flush(wait=True)
+
+    def _extract_files(self, captures: List[str], progress: 'tqdm') -> Dict[str, DomainInfo]:
+        """Extract the domains of the capture files one after the other"""
+        domains = self.domains
+        for capture in captures:
+            with tracer.span('pcap.parse', capture=capture, parser=self.parser):
+                self._extract_into(self._iter_dns(capture, progress), domains)
+        if self._queue is not None:
+            self._flush(wait=True)
+        return domains
+
+    def _extract_into(self, items: Iterator[Tuple[Optional[List[str]], object]], domains: Dict[str, DomainInfo]):
+        """Add the domains of the packets/decoded frames of a capture to the domains"""
+        # Stream the PCAP file - packets are handled one at a time and never kept
+        for names, packet in items:
+            # the extraction was cancelled (e.g. on timeout)
+            if self._aborted.is_set():
+                raise asyncio.CancelledError()
+            try:
+                if packet is not None:
+                    self._process_packet(packet, domains)
+                else:
+                    self._process_names(names, domains)
+            except Exception as e:
+                self.errors += 1
+                continue
+
+    async def _extract_parallel(self, captures: List[str], progress: 'tqdm') -> Dict[str, DomainInfo]:
+        """Extract shards of the captures in a process pool and merge the partial results"""
+        loop = asyncio.get_running_loop()
+        with tracer.span('pcap.plan_shards'):
+            shards = await loop.run_in_executor(None, self._plan_shards, captures)
+        domains = self.domains
+
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                   initargs=(self.domain_filter.allow_lists, self.domain_filter.deny_lists))
+        try:
+            futures = []
+            for index, (capture, state, stop, size) in enumerate(shards):
+                future = loop.run_in_executor(pool, extract_shard, capture, self.parser, state, stop)
+                futures.append(self._with_index(future, index, capture, size))
+
+            # the shards are merged in capture order, each one once the walk of the one before
+            # it has shown where its records begin
+            done, merged, previous = {}, 0, None
+            for future in asyncio.as_completed(futures):
+                index, result = await future
+                done[index] = result
+                while merged in done:
+                    result = done.pop(merged)
+                    capture, state, stop, size = shards[merged]
+                    if state is not None and state.get('resync') and result['start'] != previous['offset']:
+                        # resynced on record-like bytes of a payload - extract the range again from
+                        # where the records really are
+                        self.reextracted += 1
+                        result = await loop.run_in_executor(pool, extract_shard, capture, self.parser,
+                                                            dict(previous, header=state['header']), stop)
+                    previous = result['end']
+                    await self._merge_shard(result, size, progress)
+                    merged += 1
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        return domains
+
+    async def _merge_shard(self, result: Dict[str, Any], size: int, progress: 'tqdm'):
+        """Merge the partial result of a shard, publishing its new domains"""
+        domains = self.domains
+        for domain, info in result['domains'].items():
+            known = domains.get(domain)
+            if known is not None:
+                known.merge(info)
+                continue
+            domains[domain] = info
+            if self._queue is not None:
+                await self._queue.put(domain)
+        self.packets_sent += result['packets_sent']
+        self.errors += result['errors']
+        self.fallbacks += result['fallbacks']
+        self.metrics.add_query(result['queries'])
+        self.domain_filter.filtered.update(result['filtered'])
+        self.bytes_read += size
+        progress.update(size)
+
+    @staticmethod
+    async def _with_index(future, index: int, capture: str, size: int):
+        """Pair the result of a shard with its index"""
+        # from the submission of the shard to its result - the parsing runs in a worker process
+        with tracer.span('pcap.shard', capture=capture, bytes=size):
+            return index, await future
+
+    def _plan_shards(self, captures: List[str]) -> List[Tuple[str, Optional[dict], Optional[int], int]]:
+        """Split large captures into byte ranges, smaller ones are a shard each.
+        Returns (capture, range start state, range stop, size in bytes) for every shard."""
+        shards = []
+        for capture in captures:
+            size = os.path.getsize(capture)
+            count = min(self.workers * SHARDS_PER_WORKER, size // MIN_SHARD_BYTES)
+            # gzipped captures cannot be split
+            if count < 2 or self._is_gzip(capture):
+                shards.append((capture, None, None, size))
+                continue
+            with open_capture(capture) as buf:
+                start = 0
+                for state, stop in plan_shards(buf, count):
+                    end = size if stop is None else stop
+                    shards.append((capture, state, stop, end - start))
+                    start = end
+        return shards
+
+    def _capture_files(self, pcap_file: str) -> List[str]:
+        """The capture file itself, or the capture files of a directory of (rotated) captures"""
+        if not os.path.isdir(pcap_file):
+            return [pcap_file]
+
+        captures = []
+        for name in sorted(os.listdir(pcap_file)):
+            path = os.path.join(pcap_file, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    magic = f.read(4)
+                if magic in PCAP_MAGICS or magic[:2] == GZIP_MAGIC:
+                    captures.append(path)
+        return captures
+
+    def _iter_dns(self, pcap_file: str, progress: Optional['tqdm']) -> Iterator[Tuple[Optional[List[str]], object]]:
+        """Yield (None, packet) for scapy dissected packets and (names, None) for
+        DNS frames decoded by the fast parser"""
+        self._position = 0
+        # gzipped captures cannot be mmapped, they are always read through scapy
+        if self.parser == 'fast' and not self._is_gzip(pcap_file):
+            return self._iter_fast(pcap_file, progress)
+        return ((None, packet) for packet in self._iter_packets(pcap_file, progress))
+
+    def _iter_fast(self, pcap_file: str, progress: Optional['tqdm'], state: Optional[dict] = None,
+                   stop: Optional[int] = None, wire_format: bool = True):
+        """Read DNS names with the fast wire-format parser (of a plan_shards() byte range)"""
+        parser = FastDNSParser()
+        try:
+            for count, item in enumerate(parser.iter_dns(pcap_file, state, stop, wire_format), 1):
+                self._timestamp = parser.timestamp
+                self._response = parser.response
+                yield item
+                if count % PROGRESS_INTERVAL == 0:
+                    self._update_progress(parser.position, progress)
+        finally:
+            self._update_progress(parser.position, progress)
+            self.fallbacks += parser.fallbacks
+            self._walk_start, self._walk_end = parser.start, parser.state
+
+    def _iter_packets(self, pcap_file: Union[str, int], progress: Optional['tqdm']) -> Iterator:
+        """Incrementally read packets from a pcap/pcapng file (optionally gzipped), by path
+        or by file descriptor"""
+        # the DNS layer also loads the Ethernet, IP, IPv6, UDP and TCP ones - those are all
+        # that is needed, scapy.all would load every layer scapy has
+        from scapy.layers import dns  # noqa: F401
+        from scapy.utils import PcapReader
+
+        with open(pcap_file, 'rb') as raw:
+            # progress is measured on the raw file, so it also works for gzipped captures
+            stream = gzip.GzipFile(fileobj=raw) if self._is_gzip(raw) else raw
+
+            # PcapReader detects pcap vs. pcapng from the magic number
+            reader = PcapReader(stream)
+            try:
+                for count, packet in enumerate(reader, 1):
+                    yield packet
+                    if count % PROGRESS_INTERVAL == 0:
+                        self._update_progress(raw.tell(), progress)
+            finally:
+                self._update_progress(raw.tell(), progress)
+                reader.close()
+
+    @staticmethod
+    def _is_gzip(capture) -> bool:
+        """Check for the gzip magic number of a capture file path or an open file"""
+        if isinstance(capture, str):
+            with open(capture, 'rb') as f:
+                return f.read(2) == GZIP_MAGIC
+        magic = capture.read(2)
+        capture.seek(0)
+        return magic == GZIP_MAGIC
+
+    def _update_progress(self, position: int, progress: Optional['tqdm']):
+        """Advance the progress to the given raw file position of the current capture"""
+        delta = position - self._position
+        self._position = position
+        self.bytes_read += delta
+        if progress is not None:
+            progress.update(delta)
+
+    def _process_names(self, names: List[str], domains: Dict[str, DomainInfo]):
+        """Add the domains of a DNS frame decoded by the fast parser"""
+        for domain in names:
+            self._add_domain(domain, domains)
+        self.packets_sent += 1
+
+    def _process_packet(self, packet, domains: Dict[str, DomainInfo]):
+        """Extract the domains of a single packet into the domains"""
+        names = self._packet_names(packet)
+        if names is not None:
+            from scapy.layers.dns import DNS
+            self._timestamp = float(packet.time)
+            self._response = packet[DNS].qr == 1
+            self._process_names(names, domains)
+
+    @staticmethod
+    def _packet_names(packet) -> Optional[List[str]]:
+        """The domain names of a scapy packet, None if it has no DNS layer"""
+        from scapy.layers.dns import DNS
+
+        # Check if packet has DNS layer
+        if not packet.haslayer(DNS):
+            return None
+        # extract DNS information
+        dns = packet[DNS]
+        names = []
+
+        # Extract queries
+        if dns.qr == 0:  # DNS query
+            for i in range(dns.qdcount):
+                # if the DNS query has a question section, and a name to query
+                if dns.qd and dns.qd[i].qname:
+                    # extract queried domain name
+                    names.append(dns.qd[i].qname.decode('utf-8').rstrip('.'))
+
+        # Extract responses
+        elif dns.qr == 1:  # DNS response
+            if dns.an: # the answer section is not empty
+                for i in range(dns.ancount):
+                    if hasattr(dns.an[i], 'rrname'):
+                        # extract rrname (domain name)
+                        names.append(dns.an[i].rrname.decode('utf-8').rstrip('.'))
+
+        return names
+
+    def _add_domain(self, domain: str, domains: Dict[str, DomainInfo]):
+        """Count a sighting of an extracted domain name"""
+        # reserved names and the allow/deny listed domains are not looked up
+        if self.domain_filter.accept(domain):
+            info = domains.get(domain)
+            if info is None:
+                domains[domain] = DomainInfo(self._timestamp, self._response)
+                if self._queue is not None:
+                    self._publish(domain)
+            else:
+                info.seen(self._timestamp, self._response)
+            self.metrics.add_query()
+
+    def _publish(self, domain: str):
+        """Queue a new domain for the lookups from the parsing thread - the domains are handed
+        to the event loop in batches, a round trip per domain would cost more than parsing it"""
+        self._pending.append(domain)
+        if len(self._pending) >= PUBLISH_BATCH or time.monotonic() - self._handed_off >= PUBLISH_INTERVAL:
+            self._flush()
+
+    def _flush(self, wait: bool = False):
+        """Hand the pending domains to the event loop - and wait until they are all in the
+        lookup queue, with wait (at the end of an extraction, before its None)"""
+        if self._pending:
+            items, self._pending = self._pending, []
+            self._hand_off(items)
+        if wait:
+            self._wait_handoff()
+
+    def _hand_off(self, items: List[Any]):
+        """Have the event loop put the items into the lookup queue. Only waits for the previous
+        hand-off, so parsing blocks only while the queue is full - which keeps it from racing
+        ahead of the lookups - and the items keep their order."""
+        self._wait_handoff()
+        self._handoff = asyncio.run_coroutine_threadsafe(self._put_all(items), self._loop)
+        self._handed_off = time.monotonic()
+
+    async def _put_all(self, items: List[Any]):
+        for item in items:
+            await self._queue.put(item)
+
+    def _wait_handoff(self):
+        """Wait for the hand-off in progress, if any"""
+        future, self._handoff = self._handoff, None
+        if future is None:
+            return
+        with tracer.span('pipeline.publish'):
+            while True:
+                try:
+                    return future.result(timeout=PUBLISH_POLL_INTERVAL)
+                except TimeoutError:
+                    if self._aborted.is_set():
+                        future.cancel()
+                        raise asyncio.CancelledError()
 
     def get_stats(self):
         """Get current statistics"""
         return {
             'packets_sent': self.packets_sent,
             'errors': self.errors,
-            'qps': self.metrics.current_qps
-        }
\ No newline at end of file
+            'fallbacks': self.fallbacks,
+            'shards_reextracted': self.reextracted,
+            'qps': self.metrics.current_qps,
+            'bytes_read': self.bytes_read,
+            'bytes_total': self.bytes_total,
+            'packets_per_second': self.get_packet_rate(),
+            'pipeline_queue_depth': self._queue.qsize() if self._queue is not None else 0
+        }
+
+    def get_packet_rate(self) -> float:
+        """Packets per second of the current (or last) extraction"""
+        if self.start_time is None:
+            return 0
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return self.packets_sent / elapsed if elapsed > 0 else 0
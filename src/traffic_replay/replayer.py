@@ -0,0 +1,156 @@
+"""Timed replay of the DNS traffic of a capture against the reputation API"""
+import asyncio
+import time
+from typing import Dict, Any, Optional, Callable
+
+from monitoring.histogram import LatencyHistogram
+from monitoring.tracing import tracer
+
+# Replayed lookups in flight at most - beyond that the schedule is not kept, the lookups are dropped
+MAX_OUTSTANDING = 10000
+# With speed max, the scheduler yields to the lookups every that many lookups
+MAX_SPEED_YIELD = 100
+
+
+def parse_speed(value) -> float:
+    """Replay speed from '1x', '10x', '0.5', 'max'... - 0 means as fast as possible"""
+    text = str(value).strip().lower()
+    if text == 'max':
+        return 0.0
+    speed = float(text[:-1] if text.endswith('x') else text)
+    if speed < 0:
+        raise ValueError(f"negative replay speed: {value}")
+    return speed
+
+
+class TrafficReplayer:
+    """Issues a reputation lookup for every DNS packet of a capture at its original time,
+    scaled by speed (0 for as fast as possible).
+    The load is open-loop: lookups are started on schedule whether or not the earlier ones
+    are done, and their latency is measured from the time they were due, not from the time
+    they got a connection - a slow API shows as latency instead of slowing the load down
+    (no coordinated omission). Unless use_cache, every lookup reaches the API - a repeated
+    domain answered from the cache would not replay the load of the capture."""
+
+    def __init__(self, pcap_manager, reputation_client, speed: float = 1.0,
+                 max_outstanding: int = MAX_OUTSTANDING, use_cache: bool = False, queue_size: int = 64):
+        self.pcap_manager = pcap_manager
+        self.reputation_client = reputation_client
+        self.speed = speed
+        self.max_outstanding = max_outstanding
+        self.use_cache = use_cache
+        self.queue_size = queue_size
+
+        self.scheduled = 0
+        # lookups started on schedule - they may still wait for the client's semaphore and
+        # rate control before a request is sent
+        self.issued = 0
+        # lookups answered (or failed for good) by the client
+        self.completed = 0
+        self.dropped = 0
+        self.capture_span = 0.0
+        self.start_time = None
+        # when the last lookup was issued, and when the last one completed
+        self.end_time = None
+        self.finish_time = None
+        # ms from the time a lookup was due to the time it was started / finished
+        self.lag = LatencyHistogram()
+        self.latency = LatencyHistogram()
+        self.outstanding = set()
+
+    async def replay(self, pcap_file: str, on_result: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        """Replay the capture, calling on_result with the result of every domain's first lookup"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        semaphore = asyncio.Semaphore(self.reputation_client.max_concurrent)
+        reader = asyncio.create_task(self.pcap_manager.stream_queries(pcap_file, queue))
+        written = set()
+        loop = asyncio.get_running_loop()
+
+        async def lookup(domain: str, due: float):
+            with tracer.span('replay.lookup', domain=domain):
+                result = await self.reputation_client.check_domain(domain, semaphore, self.use_cache)
+            self.completed += 1
+            self.latency.record((loop.time() - due) * 1000)
+            if result is not None and on_result is not None and domain not in written:
+                written.add(domain)
+                on_result(result)
+
+        async with self.reputation_client.transport:
+            try:
+                first = None
+                self.start_time = time.time()
+                start = loop.time()
+                while (batch := await queue.get()) is not None:
+                    for timestamp, domain in batch:
+                        if first is None:
+                            first = timestamp
+                        self.scheduled += 1
+                        self.capture_span = max(self.capture_span, timestamp - first)
+                        if self.speed:
+                            due = start + (timestamp - first) / self.speed
+                            delay = due - loop.time()
+                            if delay > 0:
+                                await asyncio.sleep(delay)
+                        else:
+                            due = loop.time()
+                            if self.scheduled % MAX_SPEED_YIELD == 0:
+                                await asyncio.sleep(0)
+                        self.lag.record((loop.time() - due) * 1000)
+
+                        # waiting for a slot would make the load closed-loop
+                        if len(self.outstanding) >= self.max_outstanding:
+                            self.dropped += 1
+                            continue
+                        task = asyncio.create_task(lookup(domain, due))
+                        self.outstanding.add(task)
+                        task.add_done_callback(self.outstanding.discard)
+                        self.issued += 1
+                self.end_time = time.time()
+                await reader
+                if self.outstanding:
+                    await asyncio.gather(*self.outstanding)
+                self.finish_time = time.time()
+            finally:
+                reader.cancel()
+                for task in self.outstanding:
+                    task.cancel()
+                if self.end_time is None:
+                    self.end_time = time.time()
+                if self.finish_time is None:
+                    self.finish_time = time.time()
+
+    def target_rate(self) -> float:
+        """Lookups per second of the capture's own timing, at the replay speed (0 for max)"""
+        if not self.speed or self.capture_span <= 0:
+            return 0
+        return self.scheduled / (self.capture_span / self.speed)
+
+    def issue_rate(self) -> float:
+        """Lookups per second started on schedule - not what reaches the API, see achieved_rate()"""
+        if self.start_time is None:
+            return 0
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return self.issued / elapsed if elapsed > 0 else 0
+
+    def achieved_rate(self) -> float:
+        """Lookups per second completed by the client, past its semaphore and rate control"""
+        if self.start_time is None:
+            return 0
+        elapsed = (self.finish_time or time.time()) - self.start_time
+        return self.completed / elapsed if elapsed > 0 else 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get replay statistics"""
+        return {
+            'replay_scheduled': self.scheduled,
+            'replay_issued': self.issued,
+            'replay_completed': self.completed,
+            'replay_dropped': self.dropped,
+            'replay_outstanding': len(self.outstanding),
+            'replay_target_rate': self.target_rate(),
+            'replay_issue_rate': self.issue_rate(),
+            'replay_achieved_rate': self.achieved_rate(),
+            'replay_lag_p99': self.lag.percentile(99),
+            'replay_latency_p50': self.latency.percentile(50),
+            'replay_latency_p99': self.latency.percentile(99)
+        }
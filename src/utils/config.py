@@ -8,6 +8,14 @@ class Config:
         self.config_path = Path(config_path)
         self.data = self._load_config()
 
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Config':
+        """A configuration of already loaded data, e.g. handed over to a worker process"""
+        config = cls.__new__(cls)
+        config.config_path = None
+        config.data = data
+        return config
+
     def _load_config(self) -> dict:
         """Load configuration from YAML file"""
         if not self.config_path.exists():
@@ -24,18 +32,82 @@ class Config:
                 'auth_token': 'I_am_under_stress_when_I_test',
                 'timeout': 5,
                 'max_retries': 3,
-                'retry_delay': 1
+                'retry_delay': 1,
+                'connections_per_host': 0,
+                'keepalive_timeout': 30,
+                'dns_cache_ttl': 300,
+                'max_body_size': 1024 * 1024,
+                'batch_size': 0,
+                'batch_timeout': 0.05,
+                'batch_path': '/domain/ranking/batch'
             },
             'performance': {
                 'max_concurrent_requests': 50,
                 'requests_per_second': 100,
-                'cache_ttl': 3600
+                'cache_ttl': 3600,
+                'pcap_parser': 'scapy',
+                'extraction_workers': 1,
+                'pipeline': False,
+                'pipeline_queue_size': 1000,
+                'lookup_order': 'count',
+                'lookup_workers': 1,
+                'event_loop': 'asyncio'
+            },
+            'filter': {
+                'allow_lists': [],
+                'deny_lists': []
+            },
+            'rate_control': {
+                'min_rps': 1,
+                'initial_rps': 0,
+                'additive_increase': 5,
+                'multiplicative_decrease': 0.5,
+                'latency_spike_factor': 3.0,
+                'max_backoff': 30
+            },
+            'hedging': {
+                'enabled': False,
+                'percentile': 95,
+                'budget': 0.05
+            },
+            'follow': {
+                'enabled': False,
+                'poll_interval': 1.0
+            },
+            'replay': {
+                'enabled': False,
+                'speed': '1x',
+                'max_outstanding': 10000,
+                'use_cache': False
+            },
+            'checkpoint': {
+                'enabled': False,
+                'journal_file': 'dns_checkpoint.jsonl',
+                'interval': 5.0
+            },
+            'cache': {
+                'backend': 'memory',
+                'path': 'reputation_cache.db',
+                'compaction_interval': 600,
+                'max_entries': 100000,
+                'max_bytes': 64 * 1024 * 1024,
+                'negative_ttl': 300,
+                'sweep_interval': 60
             },
             'monitoring': {
-                'update_interval': 1
+                'update_interval': 1,
+                'metrics_host': '127.0.0.1',
+                'metrics_port': 0,
+                'trace_file': 'dns_trace',
+                'profile_file': 'dns_profile',
+                'profile_interval': 0.005
             },
             'output': {
                 'results_file': 'dns_reputation_results',
-                'format': 'csv'
+                'format': 'csv',
+                'compress': False,
+                'rotate_bytes': 0,
+                'flush_rows': 500,
+                'flush_interval': 1.0
             }
         }
\ No newline at end of file
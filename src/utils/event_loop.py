@@ -0,0 +1,18 @@
+"""Event loop implementation - asyncio's own, or uvloop when it is installed"""
+import asyncio
+
+EVENT_LOOPS = ('asyncio', 'uvloop')
+
+
+def use_event_loop(name: str = 'asyncio') -> str:
+    """Make asyncio.run() create `name` event loops, returns the implementation in use -
+    'asyncio' if uvloop is asked for but not installed"""
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            return 'asyncio'
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return 'uvloop'
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
@@ -0,0 +1,144 @@
+"""Checkpoint journal of a run, for resuming it after a timeout or an interrupt"""
+import asyncio
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from traffic_replay.pcap_manager import DomainInfo
+
+# Extracted domains per journal line
+DOMAINS_PER_LINE = 10000
+
+
+class RunJournal:
+    """Append-only JSON lines file of the progress of a run: the capture it analyzes, the
+    extracted domains in lookup order (once extraction is over) and the results written so far.
+    Results are buffered and appended every `interval` seconds - a crash loses at most that
+    much work, and a graceful shutdown loses nothing. A torn last line is ignored on load."""
+
+    def __init__(self, path: str, interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        # what load() found - the state of the interrupted run
+        self.pcap = None
+        self.domains: Optional[Dict[str, DomainInfo]] = None
+        self.results: List[Dict[str, Any]] = []
+        self.done = set()
+        self.checkpoints = 0
+        self._pending = []
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Read the journal of an earlier run, returns whether there was one"""
+        if not os.path.exists(self.path):
+            return False
+        domains = None
+        results = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by a crash while it was written
+                    break
+                if 'run' in record:
+                    self.pcap = record['run']['pcap']
+                elif 'domains' in record:
+                    domains = domains or {}
+                    for domain, count, responses, first_seen, last_seen in record['domains']:
+                        info = domains[domain] = DomainInfo(first_seen)
+                        info.count, info.responses, info.last_seen = count, responses, last_seen
+                elif 'results' in record:
+                    for result in record['results']:
+                        results[result['domain']] = result
+        self.domains = domains
+        self.results = list(results.values())
+        self.done = set(results)
+        return True
+
+    def start(self, pcap_file: str):
+        """Start journaling a run of pcap_file - a loaded journal is kept, compacted into a new file"""
+        lines = [{'run': {'pcap': os.path.realpath(pcap_file), 'started': datetime.now().isoformat()}}]
+        if self.domains is not None:
+            lines.extend(self._domain_lines(self.domains, list(self.domains)))
+        if self.results:
+            lines.append({'results': self.results})
+
+        # the old journal stays whole until the new one is
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            self._dump(f, lines)
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def record_domains(self, domains: Dict[str, DomainInfo], order: List[str]):
+        """Journal the extracted domains - their lookup order is the order of the lookups left on resume"""
+        self.domains = domains
+        with self._lock:
+            if self._file is not None:
+                self._dump(self._file, self._domain_lines(domains, order))
+
+    def record_result(self, result: Dict[str, Any]):
+        """Journal a written result, at the next checkpoint - on the event loop thread"""
+        self._pending.append(result)
+
+    def flush(self, pending: Optional[List[Dict[str, Any]]] = None):
+        """Append the results recorded since the last checkpoint - or those already taken
+        from them by the caller, when flushing in another thread"""
+        if pending is None:
+            pending, self._pending = self._pending, []
+        with self._lock:
+            if self._file is None or not pending:
+                return
+            self._dump(self._file, [{'results': pending}])
+            self.checkpoints += 1
+
+    async def checkpoint(self):
+        """Flush the journal every interval, off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            # taken on the event loop, which record_result() appends on
+            pending, self._pending = self._pending, []
+            flushing = loop.run_in_executor(None, self.flush, pending)
+            try:
+                await asyncio.shield(flushing)
+            except asyncio.CancelledError:
+                # the results taken are in the journal before it is closed
+                await flushing
+                raise
+
+    def close(self, completed: bool = False) -> bool:
+        """Flush and close the journal - the journal of a completed run has nothing to resume, it is removed.
+        Returns whether a journal was kept."""
+        self.flush()
+        with self._lock:
+            if self._file is None:
+                return False
+            self._file.close()
+            self._file = None
+            if completed:
+                os.remove(self.path)
+            return not completed
+
+    @staticmethod
+    def _domain_lines(domains: Dict[str, DomainInfo], order: List[str]) -> List[Dict[str, Any]]:
+        rows = [[domain, domains[domain].count, domains[domain].responses,
+                 domains[domain].first_seen, domains[domain].last_seen] for domain in order]
+        return [{'domains': rows[i:i + DOMAINS_PER_LINE]} for i in range(0, len(rows), DOMAINS_PER_LINE)]
+
+    @staticmethod
+    def _dump(f, records: List[Dict[str, Any]]):
+        f.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get checkpoint statistics"""
+        return {
+            'journal_checkpoints': self.checkpoints,
+            'journal_pending': len(self._pending)
+        }
@@ -0,0 +1,69 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+# The application modules import each other relative to src/ (see src/main.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from utils.config import Config  # noqa: E402
+
+
+@pytest_asyncio.fixture
+async def reputation_api():
+    """A local stand-in for the reputation API, with a batch endpoint.
+    Every looked up domain is recorded in lookups (and every batch in batches),
+    failures maps a domain to the (status, headers) responses to return before its
+    ranking, batch_failures holds those of the batch endpoint, and clearing batch_enabled
+    makes the batch endpoint a 404."""
+    api = SimpleNamespace(url=None, lookups=[], batches=[], failures={}, batch_failures=[], batch_enabled=True)
+
+    def rank(domain):
+        return {'reputation': len(domain) * 7 % 100, 'categories': ['test']}
+
+    async def ranking(request):
+        domain = request.match_info['domain']
+        api.lookups.append(domain)
+        if api.failures.get(domain):
+            status, headers = api.failures[domain].pop(0)
+            return web.Response(status=status, headers=headers)
+        return web.json_response(rank(domain))
+
+    async def batch(request):
+        if not api.batch_enabled:
+            raise web.HTTPNotFound()
+        if api.batch_failures:
+            status, headers = api.batch_failures.pop(0)
+            return web.Response(status=status, headers=headers)
+        domains = (await request.json())['domains']
+        api.batches.append(domains)
+        api.lookups.extend(domains)
+        # unknown domains are left out of the response
+        return web.json_response({domain: rank(domain) for domain in domains
+                                  if not domain.startswith('unknown')})
+
+    app = web.Application()
+    app.router.add_get('/domain/ranking/{domain}', ranking)
+    app.router.add_post('/domain/ranking/batch', batch)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    api.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    try:
+        yield api
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture
+def config(tmp_path, reputation_api):
+    """The default configuration, pointed at the local reputation API"""
+    config = Config(str(tmp_path / 'missing.yaml'))
+    config.data['api']['base_url'] = reputation_api.url
+    config.data['api']['retry_delay'] = 0
+    config.data['performance']['requests_per_second'] = 10000
+    return config
@@ -0,0 +1,78 @@
+import pytest
+from scapy.layers.dns import DNS, DNSQR
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap
+
+from monitoring.metrics import MetricsCollector
+from traffic_replay import pcap_manager
+from traffic_replay.domain_filter import DomainFilter, SuffixTable, compile_suffix_table
+from traffic_replay.pcap_manager import PCAPManager, extract_shard, init_worker
+
+
+def test_reserved_names_match_whole_labels():
+    domain_filter = DomainFilter()
+    assert domain_filter.match('foo.localhost.example.com') is None
+    assert domain_filter.match('mylocal.com') is None
+    assert domain_filter.match('printer.LOCAL') == 'reserved'
+    assert domain_filter.match('localhost') == 'invalid'
+    assert domain_filter.match('app.localhost') == 'reserved'
+    assert domain_filter.match('4.3.2.1.in-addr.arpa') == 'reserved'
+    assert domain_filter.match('in-addr.arpa.example.com') is None
+    assert domain_filter.match('') == 'invalid'
+
+
+def test_allow_and_deny_lists(tmp_path):
+    deny = tmp_path / 'deny.txt'
+    deny.write_text('# blocked\nevil.com\n0.0.0.0 tracker.net\n*.ads.org\n')
+    allow = tmp_path / 'allow.txt'
+    allow.write_text('example.com\nevil.com\n')
+    # a precompiled list is used as it is
+    compiled = tmp_path / 'more-allowed.bin'
+    compiled.write_bytes(compile_suffix_table(['trusted.io']))
+
+    domain_filter = DomainFilter([str(allow), str(compiled)], [str(deny)])
+    for domain in ('a.b.evil.com', 'evil.com', 'tracker.net', 'x.ads.org'):
+        assert not domain_filter.accept(domain)
+    for domain in ('www.example.com', 'api.trusted.io'):
+        assert not domain_filter.accept(domain)
+    for domain in ('notevil.com', 'ads.org.example', 'example.org', 'foo.local'):
+        domain_filter.accept(domain)
+    assert domain_filter.get_stats()['filtered_by_reason'] == {'denylist': 4, 'allowlist': 2, 'reserved': 1}
+
+    # text lists are compiled once, the compiled table is mapped afterwards
+    assert (tmp_path / 'deny.txt.idx').exists()
+    assert len(SuffixTable.open(str(deny))) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('workers', [1, 2])
+async def test_extract_domains_filtered(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(pcap_manager, 'MIN_SHARD_BYTES', 1)
+    deny = tmp_path / 'deny.txt'
+    deny.write_text('blocked.com\n')
+    capture = tmp_path / 'capture.pcap'
+    wrpcap(str(capture), [Ether() / IP() / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname=name))
+                          for name in ('a.example.com', 'ads.blocked.com', 'nas.local', 'a.example.com')])
+
+    manager = PCAPManager(MetricsCollector(), 'fast', workers, DomainFilter(deny_lists=[str(deny)]))
+    domains = await manager.extract_domains(str(capture))
+    assert set(domains) == {'a.example.com'}
+    assert manager.domain_filter.filtered == {'denylist': 1, 'reserved': 1}
+
+
+def test_worker_opens_the_lists_once(tmp_path, monkeypatch):
+    """Extraction workers open the lists in their initializer, shards only count what they filter"""
+    deny = tmp_path / 'deny.txt'
+    deny.write_text('blocked.com\n')
+    capture = tmp_path / 'capture.pcap'
+    wrpcap(str(capture), [Ether() / IP() / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname='ads.blocked.com'))])
+
+    opened = []
+    monkeypatch.setattr(SuffixTable, 'open', classmethod(lambda cls, path: opened.append(path) or
+                                                         cls(compile_suffix_table(['blocked.com']), path)))
+    monkeypatch.setattr(pcap_manager, '_worker_filter', None)
+    init_worker([], [str(deny)])
+    for _ in range(3):
+        assert extract_shard(str(capture), 'fast')['filtered'] == {'denylist': 1}
+    assert opened == [str(deny)]
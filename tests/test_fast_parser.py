@@ -0,0 +1,131 @@
+import struct
+
+import pytest
+from scapy.layers.dns import DNS, DNSQR, DNSRR, DNSRROPT, DNSRRSOA, EDNS0TLV, dns_compress
+from scapy.layers.inet import ICMP, IP, UDP
+from scapy.layers.inet6 import IPv6
+from scapy.layers.l2 import ARP, Dot1Q, Ether
+from scapy.packet import Raw
+from scapy.utils import wrpcap, wrpcapng
+
+from monitoring.metrics import MetricsCollector
+from traffic_replay.fast_parser import CaptureReader, FastDNSParser, Unparseable, open_capture, plan_shards
+from traffic_replay.pcap_manager import PCAPManager
+
+
+def _capture():
+    """DNS traffic over the encapsulations the fast path decodes, plus frames it leaves to scapy"""
+    query = DNS(rd=1, qd=DNSQR(qname='www.example.com') / DNSQR(qname='mail.example.com'))
+    response = DNS(qr=1, qd=DNSQR(qname='www.example.org'),
+                   an=DNSRR(rrname='www.example.org', type='CNAME', rdata='cdn.example.net') /
+                   DNSRR(rrname='cdn.example.net', rdata='192.0.2.1'),
+                   ns=DNSRRSOA(rrname='example.net', mname='ns1.example.net', rname='admin.example.net'),
+                   ar=DNSRROPT(rdata=[EDNS0TLV(optcode=10, optdata=b'cookie!!')]))
+    compressed = dns_compress(Ether() / IP() / UDP(sport=53, dport=4000) / response)
+    return [
+        Ether() / IP() / UDP(sport=4000, dport=53) / query,
+        compressed,
+        Ether() / Dot1Q(vlan=10) / IPv6() / UDP(sport=53, dport=4000) /
+        DNS(qr=1, an=DNSRR(rrname='v6.example.com', type='AAAA', rdata='2001:db8::1')),
+        Ether() / IP() / UDP(sport=5353, dport=5353) / DNS(qd=DNSQR(qname='printer.example.com')),
+        # left to scapy: truncated DNS, a fragment and ICMP quoting a DNS packet
+        Ether() / IP() / UDP(sport=4000, dport=53) / Raw(bytes(query)[:20]),
+        Ether() / IP(flags='MF') / UDP(sport=4000, dport=53) / DNS(qd=DNSQR(qname='frag.example.com')),
+        Ether() / IP() / ICMP(type=3) / IP() / UDP(sport=53) / DNS(qr=1, an=DNSRR(rrname='icmp.example.com')),
+        # skipped without dissection
+        Ether() / ARP(),
+        Ether() / IP() / UDP(sport=1111, dport=2222) / Raw(bytes(query)),
+    ]
+
+
+async def _extract(pcap_file, parser):
+    manager = PCAPManager(MetricsCollector(), parser)
+    domains = await manager.extract_domains(str(pcap_file))
+    return manager, domains
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('writer', [wrpcap, wrpcapng])
+async def test_fast_parser_matches_scapy(tmp_path, writer):
+    """The fast path extracts exactly the domains and counters of the scapy path"""
+    pcap_file = tmp_path / 'capture.pcap'
+    writer(str(pcap_file), _capture())
+
+    scapy_manager, scapy_domains = await _extract(pcap_file, 'scapy')
+    fast_manager, fast_domains = await _extract(pcap_file, 'fast')
+
+    assert fast_domains == scapy_domains
+    assert 'www.example.org' in fast_domains and 'cdn.example.net' in fast_domains
+    assert fast_manager.packets_sent == scapy_manager.packets_sent
+    assert fast_manager.errors == scapy_manager.errors
+    assert fast_manager.metrics.queries_count == scapy_manager.metrics.queries_count
+    assert fast_manager.fallbacks == 3
+    assert fast_manager.bytes_read == fast_manager.bytes_total
+
+
+def test_parse_dns_compression_pointers():
+    """Compressed names are followed, pointer loops are left to scapy"""
+    parser = FastDNSParser()
+    response = DNS(qr=1, qd=DNSQR(qname='a.example.com'),
+                   an=DNSRR(rrname='a.example.com', type='CNAME', rdata='b.example.com'))
+    message = bytes(dns_compress(response))
+    assert len(message) < len(bytes(response))
+    assert parser.parse_dns(memoryview(message), 0, len(message)) == ['a.example.com']
+
+    looping = message[:12] + b'\xc0\x0c' + message[14:]
+    with pytest.raises(Unparseable):
+        parser.parse_dns(memoryview(looping), 0, len(looping))
+
+
+@pytest.mark.parametrize('writer', [wrpcap, wrpcapng])
+def test_shards_resync_to_every_record_once(tmp_path, writer):
+    """Shards split at arbitrary byte offsets read every record exactly once, even when
+    payloads look like record headers"""
+    packets = []
+    for i in range(300):
+        packet = Ether() / IP() / UDP(sport=4000, dport=53) / Raw(b'\0' * (i % 97) + bytes(range(i % 64)))
+        packet.time = 1700000000 + i
+        packets.append(packet)
+    pcap_file = tmp_path / 'capture.pcap'
+    writer(str(pcap_file), packets)
+
+    with open_capture(str(pcap_file)) as buf:
+        expected = [record[2:] for record in CaptureReader(buf).records()]
+        for count in (2, 3, 7, 50):
+            seen = []
+            for state, stop in plan_shards(buf, count):
+                reader = CaptureReader(buf)
+                reader.restore(state)
+                if state.get('resync') and not reader.resync(stop):
+                    reader.catch_up(reader.offset)
+                seen.extend(record[2:] for record in reader.records(stop))
+            assert seen == expected
+
+
+def test_shards_catch_up_on_interfaces_described_mid_capture(tmp_path):
+    """A pcapng shard reaching packets of an interface described before its range walks the
+    capture from its header to learn of it"""
+    packets = [Ether() / IP() / UDP(sport=4000, dport=53) / DNS(qd=DNSQR(qname=f'host{i}.example.com'))
+               for i in range(100)]
+    pcap_file = tmp_path / 'capture.pcapng'
+    wrpcapng(str(pcap_file), packets)
+    data = pcap_file.read_bytes()
+    blocks, offset = [], 0
+    while offset < len(data):
+        length = struct.unpack_from('<I', data, offset + 4)[0]
+        blocks.append(bytearray(data[offset:offset + length]))
+        offset += length
+    section, interface, records = blocks[0], blocks[1], blocks[2:]
+    # the second half of the packets is captured on a second interface
+    for block in records[50:]:
+        struct.pack_into('<I', block, 8, 1)
+    pcap_file.write_bytes(b''.join([section, interface] + records[:50] + [interface] + records[50:]))
+
+    expected = [names for names, _ in FastDNSParser().iter_dns(str(pcap_file))]
+    assert len(expected) == 100
+    with open_capture(str(pcap_file)) as buf:
+        shards = plan_shards(buf, 8)
+    seen = []
+    for state, stop in shards:
+        seen.extend(names for names, _ in FastDNSParser().iter_dns(str(pcap_file), state, stop))
+    assert seen == expected
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from reputation.hedging import HedgePolicy, WARMUP_SAMPLES
+
+
+class Slot:
+    """Stands in for the rate control - counts the hedges it lets through"""
+
+    def __init__(self):
+        self.entered = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        self.entered += 1
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def requests(*latencies):
+    """A request factory answering after the given latencies in turn - the last one is kept"""
+    calls = []
+
+    async def request():
+        index = len(calls)
+        calls.append('started')
+        try:
+            await asyncio.sleep(latencies[min(index, len(latencies) - 1)])
+        except asyncio.CancelledError:
+            calls[index] = 'cancelled'
+            raise
+        calls[index] = 'answered'
+        return index
+
+    return request, calls
+
+
+async def warm_up(policy, slot):
+    request, _ = requests(0.01)
+    for _ in range(WARMUP_SAMPLES):
+        await policy.run(request, slot)
+    assert policy.hedges == 0
+    # sleeps overshoot on a loaded machine
+    assert 0.005 < policy.delay() < 0.1
+
+
+@pytest.mark.asyncio
+async def test_hedge_wins_and_cancels_the_slow_request():
+    policy, slot = HedgePolicy(percentile=95, budget=0.05), Slot()
+    await warm_up(policy, slot)
+
+    request, calls = requests(5, 0.01)
+    assert await policy.run(request, slot) == 1
+    await asyncio.sleep(0)
+    assert calls == ['cancelled', 'answered']
+    assert (policy.hedges, policy.hedge_wins, slot.entered) == (1, 1, 1)
+    stats = policy.get_stats()
+    assert stats['hedged_p99'] < 1000
+    assert stats['hedge_rate'] == pytest.approx(1 / (WARMUP_SAMPLES + 1))
+
+
+@pytest.mark.asyncio
+async def test_hedges_stay_within_budget():
+    policy, slot = HedgePolicy(percentile=95, budget=0.01), Slot()
+    await warm_up(policy, slot)
+
+    for _ in range(4):
+        request, calls = requests(0.15, 0.3)
+        assert await policy.run(request, slot) == 0
+    # 1% of 54 requests - a single hedge, lost to the first request
+    assert (policy.hedges, policy.hedge_wins, slot.entered) == (1, 0, 1)
+    assert policy.get_stats()['hedge_requests'] == WARMUP_SAMPLES + 4
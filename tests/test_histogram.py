@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from monitoring import histogram
+from monitoring.histogram import LatencyHistogram, SlidingWindowRate
+from monitoring.metrics import MetricsCollector
+
+
+def test_percentiles_within_precision():
+    random.seed(1)
+    values = [random.lognormvariate(3, 1) for _ in range(100000)]
+    hist = LatencyHistogram()
+    for value in values:
+        hist.record(value)
+
+    values.sort()
+    for percent, value in hist.percentiles([50, 90, 99, 99.9]).items():
+        exact = values[int(percent / 100 * len(values)) - 1]
+        assert value == pytest.approx(exact, rel=0.02)
+    assert hist.mean() == pytest.approx(sum(values) / len(values))
+    assert (hist.min, hist.max) == (values[0], values[-1])
+
+
+def test_memory_is_bounded():
+    hist = LatencyHistogram()
+    buckets = len(hist.counts)
+    for value in (0.0001, 1, 10 ** 9):
+        hist.record(value)
+    assert len(hist.counts) == buckets
+    assert hist.percentile(100) == 10 ** 9
+
+
+def test_sliding_window_rate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(histogram.time, 'time', lambda: now[0])
+    rate = SlidingWindowRate(window=10)
+    now[0] = 1100.0
+    for _ in range(100):
+        rate.add(10)
+        now[0] += 0.1
+    # 100 events per second for the last 10 seconds
+    assert rate.rate() == pytest.approx(100, rel=0.1)
+
+    # nothing for a while - the old events drop out of the window
+    now[0] += 20
+    assert rate.rate() == 0
+
+
+def test_cache_hits_kept_apart():
+    metrics = MetricsCollector()
+    metrics.add_request(100)
+    metrics.add_request(0, cached=True)
+    metrics.add_request(0, success=False)
+
+    stats = metrics.get_stats()
+    assert (stats['total_requests'], stats['cached_requests']) == (3, 1)
+    assert stats['p50_response_time'] == pytest.approx(100, rel=0.01)
+    assert stats['avg_response_time'] == 100
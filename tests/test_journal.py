@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import pytest
+import yaml
+from scapy.layers.dns import DNS, DNSQR
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap
+
+from main import DNSReputationAnalyzer
+from traffic_replay.pcap_manager import DomainInfo
+from utils.journal import RunJournal
+
+
+def result(domain):
+    return {'domain': domain, 'reputation': 50, 'query_count': 1}
+
+
+def test_journal_round_trip_and_torn_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = RunJournal(path)
+    journal.start(str(tmp_path / 'capture.pcap'))
+    journal.record_domains({'b.com': DomainInfo(2.0), 'a.com': DomainInfo(1.0)}, ['b.com', 'a.com'])
+    journal.record_result(result('b.com'))
+    journal.flush()
+    journal.record_result(result('a.com'))
+    journal.close()
+    # a crash while a checkpoint was appended
+    with open(path, 'a') as f:
+        f.write('{"results":[{"domain":"c.c')
+
+    loaded = RunJournal(path)
+    assert loaded.load()
+    assert loaded.pcap == str(tmp_path / 'capture.pcap')
+    assert list(loaded.domains) == ['b.com', 'a.com']
+    assert loaded.domains['a.com'] == DomainInfo(1.0)
+    assert loaded.done == {'a.com', 'b.com'}
+
+    # resuming compacts the journal, and a completed run removes it
+    loaded.start(str(tmp_path / 'capture.pcap'))
+    assert len(open(path).readlines()) == 3
+    assert loaded.close(completed=True) is False
+    assert not RunJournal(path).load()
+
+
+@pytest.mark.asyncio
+async def test_resume_skips_domains_done(tmp_path, config, reputation_api):
+    pcap_file = str(tmp_path / 'capture.pcap')
+    wrpcap(pcap_file, [Ether() / IP() / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname=f"host{i}.com"))
+                       for i in range(5)])
+    config.data['checkpoint']['journal_file'] = str(tmp_path / 'journal.jsonl')
+    config.data['output']['results_file'] = str(tmp_path / 'results')
+    config.data['output']['format'] = 'jsonl'
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config.data))
+
+    # an earlier run checkpointed two domains before it was stopped
+    journal = RunJournal(config.data['checkpoint']['journal_file'])
+    journal.start(pcap_file)
+    domains = {f"host{i}.com": DomainInfo() for i in range(5)}
+    journal.record_domains(domains, list(domains))
+    journal.record_result(result('host0.com'))
+    journal.record_result(result('host3.com'))
+    journal.close()
+
+    analyzer = DNSReputationAnalyzer(str(config_path))
+    await analyzer.analyze(pcap_file, resume=True)
+
+    assert sorted(reputation_api.lookups) == ['host1.com', 'host2.com', 'host4.com']
+    written = [line for path in tmp_path.glob('results_*.jsonl') for line in open(path)]
+    assert len(written) == 5
+    assert not (tmp_path / 'journal.jsonl').exists()
+
+
+@pytest.mark.asyncio
+async def test_unfinished_journal_is_not_overwritten(tmp_path, config, reputation_api):
+    pcap_file = str(tmp_path / 'capture.pcap')
+    wrpcap(pcap_file, [Ether() / IP() / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname='host.com'))])
+    journal_file = tmp_path / 'journal.jsonl'
+    config.data['checkpoint']['journal_file'] = str(journal_file)
+    config.data['output']['results_file'] = str(tmp_path / 'results')
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config.data))
+
+    # checkpointing is opt-in
+    analyzer = DNSReputationAnalyzer(str(config_path))
+    await analyzer.analyze(pcap_file)
+    assert analyzer.journal is None and not journal_file.exists()
+
+    journal = RunJournal(str(journal_file))
+    journal.start(pcap_file)
+    journal.record_result(result('other.com'))
+    journal.close()
+    unfinished = journal_file.read_text()
+
+    config.data['checkpoint']['enabled'] = True
+    config_path.write_text(yaml.safe_dump(config.data))
+    analyzer = DNSReputationAnalyzer(str(config_path))
+    await analyzer.analyze(pcap_file)
+    analyzer.close_journal()
+    assert analyzer.shutdown_reason == 'error'
+    assert journal_file.read_text() == unfinished
+    assert reputation_api.lookups == ['host.com']
+
+
+@pytest.mark.asyncio
+async def test_checkpoints_keep_results_recorded_while_flushing(tmp_path, monkeypatch):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = RunJournal(path, interval=0)
+    journal.start(str(tmp_path / 'capture.pcap'))
+    dump = RunJournal._dump
+
+    def slow_dump(f, records):
+        time.sleep(0.01)
+        dump(f, records)
+
+    monkeypatch.setattr(RunJournal, '_dump', staticmethod(slow_dump))
+    checkpoint = asyncio.create_task(journal.checkpoint())
+    for i in range(200):
+        journal.record_result(result(f'host{i}.com'))
+        await asyncio.sleep(0.001)
+    checkpoint.cancel()
+    await asyncio.gather(checkpoint, return_exceptions=True)
+    journal.close()
+
+    loaded = RunJournal(path)
+    assert loaded.load()
+    assert loaded.done == {f'host{i}.com' for i in range(200)}
+    assert journal.checkpoints > 1
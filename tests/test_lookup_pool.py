@@ -0,0 +1,42 @@
+import pytest
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from reputation.cache import NEGATIVE
+from reputation.lookup_pool import LookupPool, worker_config
+
+
+def test_worker_config_shares(config):
+    config.data['performance']['max_concurrent_requests'] = 5
+    client = ReputationClient(config, MetricsCollector())
+    shares = [worker_config(client, 3, index)['performance'] for index in range(3)]
+    assert [share['max_concurrent_requests'] for share in shares] == [2, 2, 1]
+    assert sum(share['requests_per_second'] for share in shares) == pytest.approx(10000)
+    assert all(share['cache_ttl'] == 0 for share in shares)
+
+
+@pytest.mark.asyncio
+async def test_lookup_pool_merges_results_and_metrics(config, reputation_api):
+    metrics = MetricsCollector()
+    client = ReputationClient(config, metrics)
+    await client.cache.set('cached.com', {'domain': 'cached.com', 'reputation': 90})
+    reputation_api.failures['gone.com'] = [(404, {})]
+    domains = [f"host{i}.com" for i in range(20)] + ['cached.com', 'gone.com']
+
+    pool = LookupPool(client, 2)
+    done = []
+    results = [result async for result in pool.iter_results(domains, done.append)]
+
+    assert sorted(result['domain'] for result in results) == sorted(set(domains) - {'gone.com'})
+    assert sum(done) == len(domains)
+    # cached domains never reach the workers
+    assert sorted(reputation_api.lookups) == sorted(set(domains) - {'cached.com'})
+    # the requests of the workers are replayed into the parent's metrics, their results cached
+    assert metrics.total_requests == 22
+    assert (metrics.successful_requests, metrics.failed_requests, metrics.cached_requests) == (21, 1, 1)
+    assert await client.cache.get('host7.com') is not None
+    assert await client.cache.get('gone.com') is NEGATIVE
+    stats = pool.get_stats()
+    assert stats['lookup_workers'] == 2
+    assert stats['http_requests'] == 21
+    assert not pool.processes
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import struct
+
+import pytest
+import yaml
+from scapy.layers.dns import DNS, DNSQR, DNSRR
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap, wrpcapng
+
+from main import DNSReputationAnalyzer
+from monitoring.metrics import MetricsCollector
+from traffic_replay import pcap_manager
+from traffic_replay.pcap_manager import PCAPManager
+from reputation.api_client import ReputationClient
+
+
+def _query(name):
+    return Ether() / IP(dst='8.8.8.8') / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname=name))
+
+
+def _dns_packets():
+    """A query, a response and a non-DNS packet"""
+    query = _query('example.com')
+    response = Ether() / IP(src='8.8.8.8') / UDP(sport=53, dport=40000) / \
+        DNS(qr=1, qd=DNSQR(qname='example.org'),
+            an=DNSRR(rrname='example.org', rdata='93.184.216.34'))
+    other = Ether() / IP() / UDP(sport=1234, dport=5678) / b'payload'
+    return [query, response, other]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('writer', [wrpcap, wrpcapng])
+async def test_extract_domains_streaming(tmp_path, writer):
+    """Both pcap and pcapng captures are streamed and fully read"""
+    pcap_file = tmp_path / 'capture.pcap'
+    writer(str(pcap_file), _dns_packets())
+
+    manager = PCAPManager(MetricsCollector())
+    domains = await manager.extract_domains(str(pcap_file))
+
+    assert domains.keys() == {'example.com', 'example.org'}
+    assert manager.packets_sent == 2
+    assert manager.bytes_read == manager.bytes_total == pcap_file.stat().st_size
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('parser', ['scapy', 'fast'])
+async def test_extract_domains_sharded(tmp_path, monkeypatch, parser):
+    """Sharded extraction of one capture in a process pool matches a single pass"""
+    monkeypatch.setattr(pcap_manager, 'MIN_SHARD_BYTES', 256)
+    packets = [_query(f'host{i}.example.com') for i in range(200)]
+    pcap_file = tmp_path / 'capture.pcap'
+    wrpcap(str(pcap_file), packets)
+
+    single = PCAPManager(MetricsCollector(), parser)
+    expected = await single.extract_domains(str(pcap_file))
+
+    sharded = PCAPManager(MetricsCollector(), parser, workers=2)
+    assert await sharded.extract_domains(str(pcap_file)) == expected
+    assert sharded.packets_sent == single.packets_sent == 200
+    assert sharded.metrics.queries_count == 200
+    assert sharded.bytes_read == sharded.bytes_total
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('workers', [2, 4])
+async def test_sharded_extraction_survives_record_like_payloads(tmp_path, monkeypatch, workers):
+    """Shards resynced on pcap records carried in a payload are extracted again from the real records"""
+    monkeypatch.setattr(pcap_manager, 'MIN_SHARD_BYTES', 1000)
+    # a walk resynced on them is left misaligned after them
+    fake_records = b''.join(struct.pack('<IIII', 1_700_000_000, 0, 16, 16) + b'x' * 16 for _ in range(40)) + b'tail'
+    packets = []
+    for i in range(300):
+        packets.append(_query(f'host{i}.example.com'))
+        packets.append(Ether() / IP() / UDP(sport=1234, dport=5678) / fake_records)
+    for packet in packets:
+        packet.time = 1_700_000_000
+    pcap_file = tmp_path / 'capture.pcap'
+    wrpcap(str(pcap_file), packets)
+
+    manager = PCAPManager(MetricsCollector(), 'fast', workers)
+    domains = await manager.extract_domains(str(pcap_file))
+    assert len(domains) == 300
+    assert manager.packets_sent == 300
+    assert manager.reextracted > 0
+
+
+@pytest.mark.asyncio
+async def test_extract_domains_directory(tmp_path):
+    """Every rotated capture of a directory is read, other files are ignored"""
+    wrpcap(str(tmp_path / 'capture.pcap0'), [_query('first.example.com')])
+    wrpcapng(str(tmp_path / 'capture.pcap1'), [_query('second.example.com')])
+    (tmp_path / 'notes.txt').write_text('not a capture')
+
+    manager = PCAPManager(MetricsCollector(), 'fast', workers=2)
+    domains = await manager.extract_domains(str(tmp_path))
+
+    assert domains.keys() == {'first.example.com', 'second.example.com'}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('workers', [1, 2])
+async def test_extract_domains_pipelined(tmp_path, monkeypatch, config, reputation_api, workers):
+    """Lookups consume the domains while they are extracted, through a tiny queue"""
+    monkeypatch.setattr(pcap_manager, 'MIN_SHARD_BYTES', 256)
+    names = {f'host{i}.example.com' for i in range(50)}
+    pcap_file = tmp_path / 'capture.pcap'
+    # every domain is queried twice, but looked up once
+    wrpcap(str(pcap_file), [_query(name) for name in sorted(names) * 2])
+
+    manager = PCAPManager(MetricsCollector(), 'fast', workers)
+    client = ReputationClient(config, MetricsCollector())
+    queue = asyncio.Queue(maxsize=2)
+    extraction = asyncio.create_task(manager.extract_domains(str(pcap_file), queue))
+    results = await client.check_domains(queue)
+
+    assert (await extraction).keys() == names
+    assert {result['domain'] for result in results} == names
+    assert sorted(reputation_api.lookups) == sorted(names)
+
+
+@pytest.mark.asyncio
+async def test_pipelined_results_have_complete_counts(tmp_path, config, reputation_api):
+    """Results looked up during extraction are written with the sightings of the whole capture"""
+    names = [f'host{i}.example.com' for i in range(5)]
+    pcap_file = tmp_path / 'capture.pcap'
+    wrpcap(str(pcap_file), [_query(name) for name in names * 200])
+    config.data['performance'].update(pipeline=True, pipeline_queue_size=1)
+    config.data['checkpoint']['enabled'] = False
+    config.data['output'].update(results_file=str(tmp_path / 'results'), format='jsonl')
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(config.data))
+
+    analyzer = DNSReputationAnalyzer(str(config_path))
+    await analyzer.analyze(str(pcap_file))
+
+    rows = [json.loads(line) for path in tmp_path.glob('results_*.jsonl') for line in open(path)]
+    assert sorted(row['domain'] for row in rows) == names
+    assert all(row['query_count'] == 200 for row in rows)
+    assert analyzer.covered_queries == 1000
+
+
+def test_recent_domains_ttl_and_limit():
+    recent = pcap_manager.RecentDomains(ttl=10, max_entries=2)
+    assert recent.add('a.com', now=0)
+    assert not recent.add('a.com', now=5)
+    assert recent.add('a.com', now=10)
+    assert recent.add('b.com', now=11)
+    assert recent.add('c.com', now=12)
+    # over max_entries, the oldest is forgotten
+    assert len(recent) == 2
+    assert recent.add('a.com', now=13)
+
+
+async def _drain(queue, count):
+    return {await asyncio.wait_for(queue.get(), 5) for _ in range(count)}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('parser', ['scapy', 'fast'])
+async def test_follow_growing_and_rotated_captures(tmp_path, parser):
+    """A growing capture is tailed record by record, new rotated files are picked up,
+    and domains seen within the ttl are published once"""
+    whole = tmp_path / 'whole.pcap'
+    wrpcap(str(whole), [_query(f'host{i}.example.com') for i in range(4)] + [_query('host0.example.com')])
+    data = whole.read_bytes()
+    record = (len(data) - 24) // 5
+
+    capture = tmp_path / 'captures' / 'capture.pcap0'
+    capture.parent.mkdir()
+    # the header and a record and a half
+    capture.write_bytes(data[:24 + record + record // 2])
+
+    manager = PCAPManager(MetricsCollector(), parser)
+    queue = asyncio.Queue()
+    follower = asyncio.create_task(manager.follow(str(capture.parent), queue, ttl=60, poll_interval=0.02))
+    try:
+        assert await _drain(queue, 1) == {'host0.example.com'}
+        # the rest of the half written record, and the others - host0 is repeated
+        with open(capture, 'ab') as f:
+            f.write(data[24 + record + record // 2:])
+        assert await _drain(queue, 3) == {'host1.example.com', 'host2.example.com', 'host3.example.com'}
+
+        # a rotated capture, with a known and a new domain
+        wrpcap(str(capture.parent / 'capture.pcap1'), [_query('host1.example.com'), _query('new.example.com')])
+        assert await _drain(queue, 1) == {'new.example.com'}
+        await asyncio.sleep(0.1)
+        assert queue.empty()
+        assert manager.packets_sent == 7
+    finally:
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+
+
+@pytest.mark.asyncio
+async def test_follow_reads_the_tail_of_a_rotated_file(tmp_path):
+    """A single followed file renamed by the rotation is read to its end, then the new file is followed"""
+    whole = tmp_path / 'whole.pcap'
+    wrpcap(str(whole), [_query(f'host{i}.example.com') for i in range(3)])
+    data = whole.read_bytes()
+    record = (len(data) - 24) // 3
+    capture = tmp_path / 'capture.pcap'
+    capture.write_bytes(data[:24 + record])
+
+    manager = PCAPManager(MetricsCollector(), 'fast')
+    queue = asyncio.Queue()
+    follower = asyncio.create_task(manager.follow(str(capture), queue, ttl=60, poll_interval=0.3))
+    try:
+        assert await _drain(queue, 1) == {'host0.example.com'}
+        # written after the last poll, then rotated away before the next one
+        with open(capture, 'ab') as f:
+            f.write(data[24 + record:])
+        capture.rename(tmp_path / 'capture.pcap.1')
+        wrpcap(str(capture), [_query('new.example.com')])
+        assert await _drain(queue, 3) == {'host1.example.com', 'host2.example.com', 'new.example.com'}
+    finally:
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('parser', ['scapy', 'fast'])
+async def test_extract_domains_counts(tmp_path, parser):
+    """Every sighting of a domain is counted, with its capture times and its direction"""
+    packets = [_query('popular.example.com'), _query('rare.example.com'), _query('popular.example.com'),
+               _dns_packets()[1]]
+    for i, packet in enumerate(packets):
+        packet.time = 1_700_000_000 + i
+    pcap_file = tmp_path / 'capture.pcap'
+    wrpcap(str(pcap_file), packets)
+
+    domains = await PCAPManager(MetricsCollector(), parser).extract_domains(str(pcap_file))
+
+    popular = domains['popular.example.com']
+    assert (popular.count, popular.queries, popular.first_seen, popular.last_seen) == \
+        (2, 2, 1_700_000_000, 1_700_000_002)
+    assert domains['example.org'].responses == 1
+    assert popular.as_row() == {'query_count': 2, 'first_seen': '2023-11-14T22:13:20+00:00',
+                                'last_seen': '2023-11-14T22:13:22+00:00'}
+
+    assert pcap_manager.order_domains(domains, 'count')[0] == 'popular.example.com'
+    assert pcap_manager.order_domains(domains, 'queries')[-1] == 'example.org'
+    assert pcap_manager.order_domains(domains, 'first_seen') == \
+        ['popular.example.com', 'rare.example.com', 'example.org']
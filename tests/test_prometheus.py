@@ -0,0 +1,42 @@
+import aiohttp
+import pytest
+
+from monitoring.metrics import MetricsCollector
+from monitoring.prometheus import MetricsServer, CONTENT_TYPE
+
+
+class FakeClient:
+    def get_stats(self):
+        return {'retries_by_status': {'429': 3, 'timeout': 1}, 'lookup_queue_depth': 7}
+
+
+@pytest.mark.asyncio
+async def test_scrape_openmetrics():
+    metrics = MetricsCollector()
+    metrics.track(FakeClient())
+    for ms in (0.5, 3, 40, 40, 2000):
+        metrics.add_request(ms)
+    metrics.add_request(0, success=False)
+    metrics.add_request(0, cached=True)
+
+    server = MetricsServer(metrics, '127.0.0.1', 0)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{server.port}/metrics') as response:
+                assert response.headers['Content-Type'] == CONTENT_TYPE
+                body = await response.text()
+    finally:
+        await server.stop()
+
+    samples = dict(line.rsplit(' ', 1) for line in body.splitlines() if not line.startswith('#'))
+    assert body.endswith('# EOF\n')
+    assert samples['dns_analyzer_requests_total{result="success"}'] == '6'
+    assert samples['dns_analyzer_requests_total{result="failure"}'] == '1'
+    assert samples['dns_analyzer_requests_total{result="cached"}'] == '1'
+    assert samples['dns_analyzer_request_duration_seconds_bucket{le="0.001"}'] == '1'
+    assert samples['dns_analyzer_request_duration_seconds_bucket{le="0.05"}'] == '4'
+    assert samples['dns_analyzer_request_duration_seconds_bucket{le="+Inf"}'] == '5'
+    assert float(samples['dns_analyzer_request_duration_seconds_sum']) == pytest.approx(2.0835)
+    assert samples['dns_analyzer_retries_total{status="429"}'] == '3'
+    assert samples['dns_analyzer_lookup_queue_depth'] == '7'
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from reputation.rate_control import AdaptiveRateController, backoff_delay, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_aimd():
+    """The rate grows additively up to the ceiling and is cut multiplicatively, once per cooldown"""
+    controller = AdaptiveRateController(100, min_rate=10, initial_rate=20, additive_increase=5)
+    for _ in range(20):
+        controller.on_success(0.01)
+    # +5 rps per second of responses at ~20 rps
+    assert 24 < controller.rate < 26
+
+    controller.on_throttled()
+    controller.on_error()
+    assert 12 < controller.rate < 13
+    assert controller.decreases == 1
+
+    controller.last_decrease = 0
+    controller.on_error()
+    assert controller.rate == 10
+
+    controller.rate = 99.99
+    controller.on_success(0.01)
+    assert controller.rate == 100
+
+
+def test_latency_spike():
+    """A latency spike over the baseline cuts the rate"""
+    controller = AdaptiveRateController(100)
+    for _ in range(50):
+        controller.on_success(0.01)
+    assert controller.rate == 100
+    for _ in range(10):
+        controller.on_success(0.1)
+    assert controller.rate == 50
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_requests():
+    controller = AdaptiveRateController(1000)
+    controller.on_throttled(0.2)
+    start = time.monotonic()
+    async with controller:
+        pass
+    assert time.monotonic() - start >= 0.19
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        delay = backoff_delay(attempt, 1, 30)
+        assert min(30, 2 ** attempt) / 2 <= delay <= min(30, 2 ** attempt)
+
+
+@pytest.mark.asyncio
+async def test_client_honors_retry_after(config, reputation_api):
+    """A 429 is retried after Retry-After, a 404 is not retried at all"""
+    reputation_api.failures['busy.com'] = [(429, {'Retry-After': '0.3'})]
+    reputation_api.failures['unknown.com'] = [(404, {})]
+    client = ReputationClient(config, MetricsCollector())
+
+    start = time.monotonic()
+    results = await client.check_domains({'busy.com', 'unknown.com'})
+    assert time.monotonic() - start >= 0.3
+    assert [result['domain'] for result in results] == ['busy.com']
+    assert sorted(reputation_api.lookups) == ['busy.com', 'busy.com', 'unknown.com']
+    assert client.rate_controller.throttled == 1
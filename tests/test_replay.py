@@ -0,0 +1,100 @@
+import pytest
+from scapy.layers.dns import DNS, DNSQR
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from traffic_replay.pcap_manager import PCAPManager
+from traffic_replay.replayer import TrafficReplayer, parse_speed
+
+
+def _timed_capture(path, names, interval):
+    packets = []
+    for i, name in enumerate(names):
+        packet = Ether() / IP(dst='8.8.8.8') / UDP(sport=40000, dport=53) / DNS(rd=1, qd=DNSQR(qname=name))
+        packet.time = 1_700_000_000 + i * interval
+        packets.append(packet)
+    wrpcap(str(path), packets)
+
+
+def test_parse_speed():
+    assert parse_speed('1x') == 1
+    assert parse_speed('10X') == 10
+    assert parse_speed('0.5') == 0.5
+    assert parse_speed('max') == 0
+    with pytest.raises(ValueError):
+        parse_speed('fast')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('parser', ['scapy', 'fast'])
+async def test_replay_keeps_capture_timing(tmp_path, config, reputation_api, parser):
+    """20 queries over 1.9s of capture, replayed at 10x, take ~0.19s and all reach the API"""
+    names = [f'host{i % 10}.example.com' for i in range(20)]
+    pcap_file = tmp_path / 'capture.pcap'
+    _timed_capture(pcap_file, names, 0.1)
+
+    metrics = MetricsCollector()
+    replayer = TrafficReplayer(PCAPManager(metrics, parser), ReputationClient(config, metrics), speed=10)
+    results = []
+    await replayer.replay(str(pcap_file), results.append)
+
+    stats = replayer.get_stats()
+    assert stats['replay_scheduled'] == stats['replay_issued'] == 20
+    assert stats['replay_target_rate'] == pytest.approx(20 / 0.19)
+    assert stats['replay_achieved_rate'] == pytest.approx(stats['replay_target_rate'], rel=0.3)
+    assert stats['replay_latency_p50'] > 0
+    # every domain is written once, every packet is looked up
+    assert sorted(result['domain'] for result in results) == sorted(set(names))
+    assert sorted(reputation_api.lookups) == sorted(names)
+    assert metrics.cached_requests == 0
+
+
+@pytest.mark.asyncio
+async def test_replay_through_the_cache(tmp_path, config, reputation_api):
+    """With use_cache, repeated domains are answered by the cache"""
+    names = [f'host{i % 10}.example.com' for i in range(20)]
+    pcap_file = tmp_path / 'capture.pcap'
+    _timed_capture(pcap_file, names, 0.1)
+
+    metrics = MetricsCollector()
+    replayer = TrafficReplayer(PCAPManager(metrics), ReputationClient(config, metrics), speed=10, use_cache=True)
+    await replayer.replay(str(pcap_file))
+
+    assert sorted(reputation_api.lookups) == sorted(set(names))
+    assert metrics.cached_requests == 10
+
+
+@pytest.mark.asyncio
+async def test_replay_open_loop_drops_instead_of_waiting(tmp_path, config, reputation_api):
+    """Lookups over max_outstanding are dropped - waiting for them would slow the load down"""
+    pcap_file = tmp_path / 'capture.pcap'
+    _timed_capture(pcap_file, [f'host{i}.example.com' for i in range(50)], 0)
+
+    metrics = MetricsCollector()
+    replayer = TrafficReplayer(PCAPManager(metrics), ReputationClient(config, metrics), speed=0,
+                               max_outstanding=1)
+    await replayer.replay(str(pcap_file))
+
+    assert replayer.issued + replayer.dropped == 50
+    assert replayer.dropped > 0
+    assert not replayer.outstanding
+
+
+@pytest.mark.asyncio
+async def test_replay_achieved_rate_counts_completed_lookups(tmp_path, config, reputation_api):
+    """Lookups held back by the client's rate control are issued on time, but not achieved yet"""
+    pcap_file = tmp_path / 'capture.pcap'
+    _timed_capture(pcap_file, [f'host{i}.example.com' for i in range(30)], 0)
+    config.data['performance']['requests_per_second'] = 50
+
+    metrics = MetricsCollector()
+    replayer = TrafficReplayer(PCAPManager(metrics), ReputationClient(config, metrics), speed=0)
+    await replayer.replay(str(pcap_file))
+
+    stats = replayer.get_stats()
+    assert stats['replay_issued'] == stats['replay_completed'] == 30
+    assert stats['replay_achieved_rate'] < 60
+    assert stats['replay_issue_rate'] > 5 * stats['replay_achieved_rate']
@@ -1,6 +1,13 @@
+import asyncio
+import sqlite3
+import time
+
 import pytest
-from src.reputation.cache import ReputationCache
-from src.monitoring.metrics import MetricsCollector
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from reputation.cache import ReputationCache, SQLiteReputationCache, NEGATIVE
+from reputation.transport import ReputationTransport, ResponseTooLarge
 
 
 @pytest.mark.asyncio
@@ -20,6 +27,211 @@ async def test_cache():
     assert result == test_data
     assert cache.size() == 1
 
+@pytest.mark.asyncio
+async def test_cache_lru_eviction():
+    """The least recently used entries are evicted over the entry and byte caps"""
+    cache = ReputationCache(ttl=60, max_entries=2)
+    await cache.set('a.com', {'reputation': 1})
+    await cache.set('b.com', {'reputation': 2})
+    await cache.get('a.com')
+    await cache.set('c.com', {'reputation': 3})
+
+    assert await cache.get('b.com') is None
+    assert await cache.get('a.com') == {'reputation': 1}
+    assert cache.evictions == 1
+
+    cache = ReputationCache(ttl=60, max_bytes=2000)
+    for i in range(100):
+        await cache.set(f'host{i}.com', {'reputation': i, 'categories': ['test']})
+    assert cache.bytes <= 2000
+    assert cache.size() + cache.evictions == 100
+    assert await cache.get('host99.com') is not None
+
+
+@pytest.mark.asyncio
+async def test_cache_expiry_and_negative():
+    """Failed lookups are cached for the negative TTL, the sweep drops expired entries"""
+    cache = ReputationCache(ttl=60, negative_ttl=1)
+    metrics = MetricsCollector()
+    metrics.track(cache)
+
+    await cache.set_negative('bad.com')
+    await cache.set('good.com', {'reputation': 90})
+    assert await cache.get('bad.com') is NEGATIVE
+
+    cache.cache['bad.com'].expires = time.time() - 1
+    assert cache.expire() == 1
+    assert await cache.get('bad.com') is None
+
+    stats = metrics.get_stats()
+    assert (stats['cache_hits'], stats['cache_negative_hits'], stats['cache_misses']) == (1, 1, 1)
+    assert (stats['cache_expirations'], stats['cache_size']) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache(tmp_path):
+    """The SQLite cache persists across instances and is shared between them"""
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteReputationCache(path, ttl=60)
+    other = SQLiteReputationCache(path, ttl=60)
+
+    await cache.set_many({'example.com': {'reputation': 85}, 'example.org': {'reputation': 20}})
+    await cache.set('example.net', {'reputation': 50})
+    await cache.flush()
+
+    # another process sees the entries without reopening the database
+    assert await other.get('example.net') == {'reputation': 50}
+    other.close()
+    cache.close()
+
+    # a new run warm-loads the entries
+    cache = SQLiteReputationCache(path, ttl=60)
+    assert cache.size() == 3
+    found = await cache.get_many(['example.com', 'example.org', 'unknown.com'])
+    assert found == {'example.com': {'reputation': 85}, 'example.org': {'reputation': 20}}
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.hit_ratio() == pytest.approx(2 / 3)
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_expiry(tmp_path):
+    """Expired entries are neither warm-loaded nor returned, and compaction deletes them"""
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteReputationCache(path, ttl=60)
+    await cache.set_many({'old.com': {'reputation': 1}, 'new.com': {'reputation': 2}})
+    cache.db.execute("UPDATE reputation SET timestamp = ? WHERE domain = 'old.com'", (time.time() - 120,))
+    cache.close()
+
+    cache = SQLiteReputationCache(path, ttl=60)
+    assert cache.size() == 1
+    assert await cache.get('old.com') is None
+
+    # negative entries are persisted too
+    await cache.set_negative('bad.com')
+    cache.close()
+    cache = SQLiteReputationCache(path, ttl=60)
+    assert await cache.get('bad.com') is NEGATIVE
+    assert cache.db.execute('SELECT COUNT(*) FROM reputation').fetchone() == (2,)
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_waits_for_the_lock_off_the_event_loop(tmp_path):
+    """A write held up by another process's lock leaves the event loop running"""
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteReputationCache(path, ttl=60)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+
+    write = asyncio.create_task(cache.set_many({'example.com': {'reputation': 85}}))
+    for _ in range(10):
+        await asyncio.sleep(0.02)
+    assert not write.done()
+
+    other.execute('COMMIT')
+    await write
+    assert other.execute('SELECT COUNT(*) FROM reputation').fetchone() == (1,)
+    other.close()
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_iter_results_bounded(config, reputation_api):
+    """Domains are pulled lazily from the iterator and results are yielded as they finish"""
+    config.data['performance']['max_concurrent_requests'] = 4
+    client = ReputationClient(config, MetricsCollector())
+    pulled = 0
+
+    def domains():
+        nonlocal pulled
+        for i in range(1000):
+            pulled += 1
+            yield f'host{i}.example.com'
+
+    done = []
+    async for result in client.iter_results(domains(), done.append):
+        # the scheduler never runs far ahead of the consumer
+        assert pulled - len(done) <= 256 + 3 * 4
+    assert len(done) == 1000
+    assert len(reputation_api.lookups) == 1000
+
+    # the second time around, everything is served from the cache
+    results = await client.check_domains({f'host{i}.example.com' for i in range(1000)})
+    assert len(results) == 1000
+    assert len(reputation_api.lookups) == 1000
+
+
+@pytest.mark.asyncio
+async def test_transport_reuses_connections(config, reputation_api):
+    """The connection pool is sized after the concurrency and reused across requests"""
+    config.data['performance']['max_concurrent_requests'] = 2
+    async with ReputationTransport(config) as transport:
+        for i in range(10):
+            status, data, _ = await transport.get_ranking(f'host{i}.example.com')
+            assert status == 200 and data['categories'] == ['test']
+
+    stats = transport.get_stats()
+    assert stats['connections_created'] == 1
+    assert stats['connections_reused'] == 9
+
+    config.data['api']['max_body_size'] = 10
+    async with ReputationTransport(config) as transport:
+        with pytest.raises(ResponseTooLarge):
+            await transport.get_ranking('example.com')
+
+
+@pytest.mark.asyncio
+async def test_batch_lookups(config, reputation_api):
+    """Domains are looked up in batches, and results/cache/metrics are kept per domain"""
+    config.data['api']['batch_size'] = 10
+    config.data['performance']['max_concurrent_requests'] = 2
+    metrics = MetricsCollector()
+    client = ReputationClient(config, metrics)
+    domains = {f'host{i}.example.com' for i in range(45)} | {'unknown.example.com'}
+
+    results = await client.check_domains(domains)
+    assert {result['domain'] for result in results} == domains - {'unknown.example.com'}
+    assert all(len(batch) <= 10 for batch in reputation_api.batches)
+    assert len(reputation_api.batches) >= 5
+    assert (metrics.successful_requests, metrics.failed_requests) == (45, 1)
+    assert await client.cache.get('host1.example.com') is not None
+    # negatively cached
+    assert client.cache.cache['unknown.example.com'].data is None
+
+
+@pytest.mark.asyncio
+async def test_batch_fallback(config, reputation_api):
+    """Without a batch endpoint, every domain is looked up on its own"""
+    reputation_api.batch_enabled = False
+    config.data['api']['batch_size'] = 10
+    client = ReputationClient(config, MetricsCollector())
+    domains = {f'host{i}.example.com' for i in range(25)}
+
+    results = await client.check_domains(domains)
+    assert {result['domain'] for result in results} == domains
+    assert not client.batch_supported
+    assert sorted(reputation_api.lookups) == sorted(domains)
+
+
+@pytest.mark.asyncio
+async def test_batch_failure_is_not_split(config, reputation_api):
+    """A batch still failing after its retries fails as a whole, without a request per domain"""
+    reputation_api.batch_failures = [(503, {})] * 3
+    config.data['api']['batch_size'] = 10
+    # a single batch of all the domains
+    config.data['performance']['max_concurrent_requests'] = 1
+    metrics = MetricsCollector()
+    client = ReputationClient(config, metrics)
+    domains = [f'host{i}.example.com' for i in range(5)]
+
+    assert await client.check_domains(domains) == []
+    assert reputation_api.lookups == []
+    assert client.batch_supported and client.batch_failures == 1
+    assert metrics.failed_requests == 5
+    assert await client.cache.get('host1.example.com') is NEGATIVE
+
+
 def test_metrics():
     """Test metrics collection"""
     metrics = MetricsCollector()
@@ -0,0 +1,65 @@
+import csv
+import gzip
+import json
+
+import pytest
+
+from monitoring.result_writer import ResultWriter
+
+
+def _results(count):
+    return [{'domain': f'host{i}.example.com', 'reputation': i, 'classification': 'Untrusted',
+             'categories': ['a', 'b'], 'query_source': 'PCAP', 'response_time': 1.5}
+            for i in range(count)]
+
+
+def test_csv_does_not_mutate_results(tmp_path):
+    results = _results(3)
+    writer = ResultWriter(str(tmp_path / 'results')).start()
+    for result in results:
+        writer.write(result)
+    writer.close()
+
+    assert results[0]['categories'] == ['a', 'b']
+    with open(writer.files[0], newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['domain'] for row in rows] == [result['domain'] for result in results]
+    assert rows[0]['categories'] == 'a, b'
+
+
+@pytest.mark.parametrize('format_type', ['json', 'jsonl'])
+def test_gzip_rotation(tmp_path, format_type):
+    """Every rotated file is complete and valid on its own"""
+    results = _results(200)
+    writer = ResultWriter(str(tmp_path / 'results'), format_type, compress=True,
+                          rotate_bytes=1024, flush_rows=10).start()
+    for result in results:
+        writer.write(result)
+    writer.close()
+
+    assert len(writer.files) > 1
+    read = []
+    for filename in writer.files:
+        with gzip.open(filename, 'rt') as f:
+            if format_type == 'json':
+                read.extend(json.load(f))
+            else:
+                read.extend(json.loads(line) for line in f)
+    assert read == results
+
+
+def test_partial_results_are_flushed(tmp_path):
+    """Rows are on disk after flush_interval, before the writer is closed"""
+    writer = ResultWriter(str(tmp_path / 'results'), 'jsonl', flush_interval=0.05).start()
+    writer.write(_results(1)[0])
+    writer.thread.join(0.5)
+
+    with open(writer.files[0]) as f:
+        assert json.loads(f.readline())['domain'] == 'host0.example.com'
+    writer.close()
+
+
+def test_no_results_no_file(tmp_path):
+    writer = ResultWriter(str(tmp_path / 'results')).start()
+    writer.close()
+    assert writer.files == []
@@ -0,0 +1,55 @@
+import asyncio
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from monitoring.metrics import MetricsCollector
+from reputation.api_client import ReputationClient
+from utils.event_loop import use_event_loop
+
+SRC = Path(__file__).resolve().parent.parent / 'src'
+# Seconds `import main` may take in a fresh interpreter - it took 0.8s while scapy.all and
+# aiohttp were imported eagerly, under 0.2s without them
+IMPORT_BUDGET = 0.5
+HEAVY_MODULES = ('scapy', 'aiohttp', 'tqdm', 'uvloop')
+
+PROBE = f"""
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(elapsed, *sorted({{name.split('.')[0] for name in sys.modules}} & set({HEAVY_MODULES!r})))
+"""
+
+
+def test_import_time_budget():
+    runs = []
+    for _ in range(3):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=SRC, capture_output=True, text=True,
+                                check=True).stdout.split()
+        runs.append(float(output[0]))
+        # the heavy dependencies are imported by the first run that needs them, not by main
+        assert output[1:] == []
+    assert min(runs) < IMPORT_BUDGET
+
+
+@pytest.mark.asyncio
+async def test_cached_lookups_do_not_open_the_connection_pool(config):
+    client = ReputationClient(config, MetricsCollector())
+    await client.cache.set('cached.com', {'domain': 'cached.com', 'reputation': 90})
+    results = [result async for result in client.iter_results(['cached.com'])]
+    assert [result['domain'] for result in results] == ['cached.com']
+    assert client.transport.session is None
+    assert client.metrics.first_request_time is not None
+
+
+def test_event_loop_falls_back_without_uvloop(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'uvloop', None)
+    try:
+        assert use_event_loop('uvloop') == 'asyncio'
+        assert use_event_loop('asyncio') == 'asyncio'
+        assert not type(asyncio.get_event_loop_policy()).__module__.startswith('uvloop')
+    finally:
+        asyncio.set_event_loop_policy(None)
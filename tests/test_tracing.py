@@ -0,0 +1,72 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from monitoring.profiler import SamplingProfiler
+from monitoring.tracing import Tracer, NULL_SPAN
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    semaphore = asyncio.Semaphore()
+    assert tracer.span('stage', key='value') is NULL_SPAN
+    assert tracer.wait(semaphore, 'stage.wait') is semaphore
+    with tracer.span('stage'):
+        pass
+    assert tracer.events == []
+
+
+@pytest.mark.asyncio
+async def test_spans_exported_per_task_lane(tmp_path):
+    tracer = Tracer()
+    tracer.enable()
+    semaphore = asyncio.Semaphore(1)
+
+    async def lookup(domain):
+        with tracer.span('lookup', domain=domain):
+            async with tracer.wait(semaphore, 'lookup.semaphore_wait'):
+                with tracer.span('http.request'):
+                    await asyncio.sleep(0.01)
+
+    await asyncio.gather(lookup('a.com'), lookup('b.com'))
+    with pytest.raises(ValueError):
+        with tracer.span('failing'):
+            raise ValueError()
+
+    path = tmp_path / 'trace.json'
+    tracer.export(str(path))
+    events = json.loads(path.read_text())['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    lanes = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+
+    assert len(spans) == 7
+    # the two lookups ran in tasks of their own, their spans nest within their lanes
+    lookups = [span for span in spans if span['name'] == 'lookup']
+    assert len({span['tid'] for span in lookups}) == 2
+    assert all(span['tid'] in lanes for span in spans)
+    for lookup_span in lookups:
+        inner = [span for span in spans if span['tid'] == lookup_span['tid'] and span is not lookup_span]
+        assert {span['name'] for span in inner} == {'lookup.semaphore_wait', 'http.request'}
+        assert all(lookup_span['ts'] <= span['ts'] and
+                   span['ts'] + span['dur'] <= lookup_span['ts'] + lookup_span['dur'] + 1 for span in inner)
+    # the second lookup waited for the semaphore while the first one held it
+    assert max(span['dur'] for span in spans if span['name'] == 'lookup.semaphore_wait') >= 5000
+    assert [span['args'] for span in spans if span['name'] == 'failing'] == [{'error': 'ValueError'}]
+    assert {span['cat'] for span in spans} == {'lookup', 'http', 'failing'}
+
+
+def test_profiler_finds_hot_spot():
+    def busy_loop():
+        end = time.perf_counter() + 0.3
+        while time.perf_counter() < end:
+            sum(range(100))
+
+    profiler = SamplingProfiler(interval=0.002).start()
+    busy_loop()
+    profiler.stop()
+
+    assert profiler.samples > 0
+    assert any('busy_loop' in function for function, own, total in profiler.hot_spots(5))
+    assert 'busy_loop' in profiler.report()